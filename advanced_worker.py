@@ -2,23 +2,46 @@ import os
 import asyncio
 import logging
 import json
-import subprocess
-import base64
-import requests
 import shutil
 import re
+import socket
+import time
+import itertools
+import random
+import threading
+import queue
+from collections import deque
 from datetime import datetime, timezone
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
-import yt_dlp
+# startup قبل از بقیه import می‌شود تا زمان import کتابخانه‌ها هم در گزارش راه‌اندازی بیاید
+from startup import LazyModule, StartupProfile, preload_in_background
 from telethon import TelegramClient
-from telethon.tl.types import DocumentAttributeVideo
-import instaloader
-from instagrapi import Client as InstagrapiClient
+from telethon.network import MTProtoSender
+from telethon.tl.types import DocumentAttributeVideo, InputFile, InputFileBig
+from telethon.tl.functions.upload import SaveFilePartRequest, SaveBigFilePartRequest
 
 from config import (TELEGRAM_API_ID, TELEGRAM_API_HASH, TELEGRAM_PHONE,
-                    GROUP_ID, ORDER_TOPIC_ID, MAJID_API_TOKEN,
-                    INSTAGRAM_USERNAME, INSTAGRAM_PASSWORD, NESTCODE_API_KEY)
+                    GROUP_ID, ORDER_TOPIC_ID, MAJID_API_TOKEN, NESTCODE_API_KEY,
+                    JOB_TRANSPORT, JOB_QUEUE_SWEEP_SECONDS, ADMIN_IDS,
+                    MAX_CONCURRENT_JOBS, PLATFORM_CONCURRENCY,
+                    WORKER_ID, JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS,
+                    CAROUSEL_DOWNLOAD_CONCURRENCY, CAROUSEL_UPLOAD_CONCURRENCY,
+                    STREAM_UPLOADS, STREAM_PART_SIZE_KB, STREAM_BUFFER_PARTS,
+                    PARALLEL_UPLOAD_CONNECTIONS, PARALLEL_UPLOAD_PART_SIZE_KB, PARALLEL_UPLOAD_MIN_MB,
+                    ROUTER_WINDOW, ROUTER_FAILURE_THRESHOLD, ROUTER_COOLDOWN_SECONDS,
+                    ROUTER_MAX_COOLDOWN_SECONDS, ROUTER_RACE_TOP_TWO, MEDIA_THUMBNAILS,
+                    FORMAT_MANIFEST_TTL_MINUTES, QUALITY_HEIGHTS, METRICS_HOST, WORKER_METRICS_PORT)
+from database import PostgresDB, job_platform
+from instagram_pool import InstagramPool, error_kind
+from metrics import Metrics, JobTrace, SPEED_BUCKETS
+from http_downloader import HttpDownloader
+from job_protocol import encode_result, encode_failure, encode_formats_ready, parse_message, ProtocolError
+
+# --- کتابخانه‌های سنگین دانلود فقط در اولین استفاده import می‌شوند ---
+yt_dlp = LazyModule("yt_dlp")
+instaloader = LazyModule("instaloader")
 
 # --- سیستم لاگ‌گیری ---
 logger = logging.getLogger(__name__)
@@ -36,81 +59,374 @@ logging.getLogger("yt_dlp").setLevel(logging.WARNING)
 logging.getLogger("instaloader").setLevel(logging.WARNING)
 logging.getLogger("instagrapi").setLevel(logging.WARNING)
 
+class JobScheduler:
+    def __init__(self, global_limit, platform_limits):
+        self.global_limit = global_limit
+        self.platform_limits = platform_limits
+        self.global_slots = asyncio.Semaphore(global_limit)
+        self.queues = {platform: asyncio.PriorityQueue() for platform in platform_limits}
+        self.running = {platform: 0 for platform in platform_limits}
+        self.counter = itertools.count()
+        self.slot_freed = asyncio.Event()
+        self.stats = {'submitted': 0, 'completed': 0, 'total_wait': 0.0, 'max_wait': 0.0}
+
+    def start(self):
+        for platform, limit in self.platform_limits.items():
+            for _ in range(limit): asyncio.create_task(self._consume(platform))
+
+    def submit(self, platform, priority, job_factory):
+        self.stats['submitted'] += 1
+        self.queues[platform].put_nowait((priority, next(self.counter), time.monotonic(), job_factory))
+
+    def pending(self):
+        return sum(q.qsize() for q in self.queues.values()) + sum(self.running.values())
+
+    def open_platforms(self):
+        # platform ای که job های در حال اجرا و در صفش به سهمیه‌اش رسیده job جدید نمی‌گیرد تا بقیه پشت سرش گیر نکنند
+        if self.pending() >= self.global_limit: return []
+        return [p for p, limit in self.platform_limits.items() if self.running[p] + self.queues[p].qsize() < limit]
+
+    async def wait_for_capacity(self):
+        while self.pending() >= self.global_limit:
+            self.slot_freed.clear()
+            await self.slot_freed.wait()
+
+    async def _consume(self, platform):
+        queue = self.queues[platform]
+        while True:
+            _, _, queued_at, job_factory = await queue.get()
+            async with self.global_slots:
+                waited = time.monotonic() - queued_at
+                self.stats['total_wait'] += waited
+                self.stats['max_wait'] = max(self.stats['max_wait'], waited)
+                self.running[platform] += 1
+                try:
+                    await job_factory()
+                except Exception as e:
+                    logger.error(f"Unhandled error in {platform} job: {e}", exc_info=True)
+                finally:
+                    self.running[platform] -= 1
+                    self.stats['completed'] += 1
+                    queue.task_done()
+                    self.slot_freed.set()
+
+    def summary(self):
+        busy = sum(self.running.values())
+        platforms = " | ".join(f"{p}: {self.running[p]}/{limit} (q {self.queues[p].qsize()})" for p, limit in self.platform_limits.items())
+        avg_wait = self.stats['total_wait'] / self.stats['completed'] if self.stats['completed'] else 0
+        return f"Slots: {busy}/{self.global_limit} | {platforms} | Wait avg {avg_wait:.1f}s max {self.stats['max_wait']:.1f}s"
+
+VIDEO_EXTENSIONS = ('.mp4', '.mkv', '.mov', '.webm')
+DEFAULT_FORMAT = 'bestvideo[height<=720][ext=mp4]+bestaudio[ext=m4a]/best[height<=720][ext=mp4]/best'
+AUDIO_FORMAT = 'bestaudio[ext=m4a]/bestaudio/best'
+# کلیدهای حجیمی که برای انتخاب کیفیت لازم نیستند در manifest ذخیره نمی‌شوند
+MANIFEST_SKIP_KEYS = ('automatic_captions', 'subtitles', 'heatmap', 'thumbnails', 'requested_formats', 'requested_downloads')
+
+def format_selector(option):
+    if option == 'audio': return AUDIO_FORMAT
+    if option and option.startswith('v') and option[1:].isdigit():
+        height = int(option[1:])
+        return f'bestvideo[height<={height}][ext=mp4]+bestaudio[ext=m4a]/bestvideo[height<={height}]+bestaudio/best[height<={height}]/best'
+    return DEFAULT_FORMAT
+
+def _format_size(fmt, duration):
+    return int(fmt.get('filesize') or fmt.get('filesize_approx') or (fmt['tbr'] * 125 * duration if fmt.get('tbr') and duration else 0))
+
+def format_options(info):
+    formats, duration = info.get('formats') or [], info.get('duration') or 0
+    videos = [f for f in formats if f.get('vcodec') not in (None, 'none') and f.get('height')]
+    audios = [f for f in formats if f.get('acodec') not in (None, 'none') and f.get('vcodec') == 'none']
+    audio_size = max((_format_size(f, duration) for f in audios), default=0)
+    options, seen_heights = [], set()
+    for height in sorted(QUALITY_HEIGHTS, reverse=True):
+        candidates = [f for f in videos if f['height'] <= height]
+        if not candidates: continue
+        best_height = max(f['height'] for f in candidates)
+        if best_height in seen_heights: continue
+        seen_heights.add(best_height)
+        best = max((f for f in candidates if f['height'] == best_height), key=lambda f: _format_size(f, duration))
+        size = _format_size(best, duration) + (audio_size if best.get('acodec') in (None, 'none') else 0)
+        options.append({'id': f'v{height}', 'height': best_height, 'size': size})
+    if audios: options.append({'id': 'audio', 'height': None, 'size': audio_size})
+    return options
+
+class ProviderRouter:
+    def __init__(self, window, failure_threshold, cooldown, max_cooldown):
+        self.window, self.failure_threshold = window, failure_threshold
+        self.cooldown, self.max_cooldown = cooldown, max_cooldown
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def _entry(self, kind, method):
+        return self.stats.setdefault((kind, method), {"results": deque(maxlen=self.window), "failures": 0, "trips": 0, "open_until": 0.0})
+
+    def _score(self, kind, method):
+        results = self._entry(kind, method)["results"]
+        successes = sum(1 for ok, _ in results if ok)
+        latency = sum(l for _, l in results) / len(results) if results else float('inf')
+        return -round((successes + 1) / (len(results) + 2), 1), latency
+
+    def order(self, kind, methods):
+        now = time.monotonic()
+        with self.lock:
+            ranked = sorted(methods, key=lambda m: self._score(kind, m))
+            available = [m for m in ranked if self._entry(kind, m)["open_until"] <= now]
+        return available or ranked[:1]
+
+    def record(self, kind, method, ok, latency, rate_limited=False):
+        with self.lock:
+            entry = self._entry(kind, method)
+            entry["results"].append((ok, latency))
+            if ok:
+                entry["failures"], entry["trips"] = 0, 0
+                return
+            entry["failures"] += 1
+            if rate_limited or entry["failures"] >= self.failure_threshold:
+                entry["trips"] += 1
+                cooldown = min(self.cooldown * 2 ** (entry["trips"] - 1), self.max_cooldown)
+                entry["open_until"], entry["failures"] = time.monotonic() + cooldown, 0
+                logger.warning(f"Circuit opened for {method} ({kind}) for {cooldown}s.")
+
+    def summary(self):
+        now, lines = time.monotonic(), []
+        with self.lock:
+            for (kind, method), entry in sorted(self.stats.items()):
+                results = entry["results"]
+                if not results: continue
+                successes = sum(1 for ok, _ in results if ok)
+                line = f"{kind:<9} {method.replace('_try_', ''):<16} {successes}/{len(results)} ok | avg {sum(l for _, l in results) / len(results):.1f}s"
+                if entry["open_until"] > now: line += f" | open {int(entry['open_until'] - now)}s"
+                lines.append(line)
+        return "\n".join(lines) or "No provider stats yet."
+
+class StreamedMedia:
+    def __init__(self, response, name, size):
+        self.response, self.name, self.size = response, name, size
+        self.cancelled = False
+
+    def produce(self, queue, loop, part_size):
+        def put(item): asyncio.run_coroutine_threadsafe(asyncio.wait_for(queue.put(item), 120), loop).result()
+        buffer = bytearray()
+        try:
+            for chunk in self.response.iter_content(chunk_size=part_size):
+                if self.cancelled: return
+                buffer.extend(chunk)
+                while len(buffer) >= part_size:
+                    put(bytes(buffer[:part_size]))
+                    del buffer[:part_size]
+            if buffer: put(bytes(buffer))
+        finally:
+            if not self.cancelled:
+                try: put(None)
+                except Exception: pass
+
+    def close(self):
+        self.cancelled = True
+        self.response.close()
+
+class ParallelUploader:
+    # چند اتصال اضافه به DC اصلی با همان auth key باز می‌شود و قسمت‌های فایل همزمان روی آن‌ها ارسال می‌شوند
+    def __init__(self, client, connections, part_size):
+        self.client, self.connections = client, connections
+        self.part_size = part_size if part_size and 512 * 1024 % part_size == 0 and part_size % 1024 == 0 else 512 * 1024
+        self.senders = []
+        self.lock = asyncio.Lock()
+
+    async def _ensure_senders(self):
+        async with self.lock:
+            if len(self.senders) >= self.connections: return
+            dc = await self.client._get_dc(self.client.session.dc_id)
+            while len(self.senders) < self.connections:
+                sender = MTProtoSender(self.client.session.auth_key, loggers=self.client._log)
+                await sender.connect(self.client._connection(dc.ip_address, dc.port, dc.id, loggers=self.client._log, proxy=self.client._proxy))
+                self.senders.append(sender)
+
+    async def _drop_sender(self, sender):
+        async with self.lock:
+            if sender in self.senders: self.senders.remove(sender)
+        try: await sender.disconnect()
+        except Exception: pass
+
+    async def upload(self, file_path, progress_callback):
+        size, name = os.path.getsize(file_path), os.path.basename(file_path)
+        total_parts = (size + self.part_size - 1) // self.part_size
+        file_id, pending = random.randrange(-2**63, 2**63), deque(range(total_parts))
+        try: await self._ensure_senders()
+        except Exception as e: logger.warning(f"Could not open extra upload connections, using {len(self.senders)}. Error: {e}")
+        progress = {'sent': 0}
+
+        async def send_parts(sender):
+            with open(file_path, 'rb') as f:
+                while pending:
+                    part_index = pending.popleft()
+                    f.seek(part_index * self.part_size)
+                    part = f.read(self.part_size)
+                    request = SaveBigFilePartRequest(file_id, part_index, total_parts, part)
+                    try:
+                        ok = await sender.send(request) if sender else await self.client(request)
+                    except (ConnectionError, asyncio.TimeoutError, OSError) as e:
+                        pending.append(part_index)
+                        if not sender: raise
+                        logger.warning(f"Upload connection failed while sending part {part_index} of {name}, continuing on the others. Error: {e}")
+                        await self._drop_sender(sender)
+                        return
+                    if not ok: raise Exception(f"Telegram rejected part {part_index} of {name}")
+                    progress['sent'] += len(part)
+                    progress_callback(min(progress['sent'], size), size)
+
+        await asyncio.gather(*(send_parts(sender) for sender in list(self.senders) + [None]))
+        if pending: await send_parts(None)
+        if pending: raise Exception(f"Upload of {name} stopped with {len(pending)} part(s) left")
+        return InputFileBig(file_id, total_parts, name)
+
+def discard_item(item):
+    if isinstance(item, StreamedMedia): item.close()
+    elif os.path.exists(item): os.remove(item)
+
+class UploadPipeline:
+    def __init__(self, worker, job):
+        self.worker, self.job, self.code = worker, job, job['code']
+        self.loop = asyncio.get_running_loop()
+        self.upload_slots = asyncio.Semaphore(CAROUSEL_UPLOAD_CONCURRENCY)
+        self.metadata_lock = asyncio.Lock()
+        self.metadata_saved = False
+        self.accepted_indexes, self.accepted_paths = set(), set()
+        self.tasks = []
+        self.started = time.monotonic()
+        self.first_upload_at = None
+
+    def emit(self, index, total, path, method, caption):
+        self.loop.call_soon_threadsafe(self.accept, index, total, path, method, caption)
+
+    def accept(self, index, total, path, method, caption):
+        if index in self.accepted_indexes or path in self.accepted_paths:
+            if path not in self.accepted_paths: discard_item(path)
+            return
+        self.accepted_indexes.add(index)
+        self.accepted_paths.add(path)
+        self.tasks.append(asyncio.create_task(self.upload(index, total, path, method, caption)))
+
+    async def save_metadata(self, method, caption):
+        async with self.metadata_lock:
+            if self.metadata_saved: return
+            meta = self.worker.active_jobs.get(self.code, {}).get("meta") or {}
+            description = meta.get('description') or (caption if method != "Instagram Profile" else "") or ""
+            title = meta.get('title') or (caption or "").split('\n')[0][:200]
+            await self.worker.db.set_job_metadata(self.code, title, description, method)
+            profile = self.worker.active_jobs.get(self.code, {}).get("profile")
+            if profile: await self.worker.db.save_profile(profile)
+            self.metadata_saved = True
+
+    async def upload(self, index, total, path, method, caption):
+        await self.save_metadata(method, caption)
+        async with self.upload_slots:
+            await self.worker.upload_single_file(self.job, path, self.code, method, index + 1, total, caption)
+        if self.first_upload_at is None: self.first_upload_at = time.monotonic() - self.started
+
+    async def finish(self):
+        results = await asyncio.gather(*self.tasks, return_exceptions=True)
+        errors = [r for r in results if isinstance(r, Exception)]
+        if errors: raise errors[0]
+        if not self.tasks: raise Exception("All download methods failed.")
+        elapsed = time.monotonic() - self.started
+        logger.info(f"[{self.code}] Delivered {len(self.tasks)} item(s) in {elapsed:.2f}s (first upload after {self.first_upload_at or 0:.2f}s).")
+        return elapsed
+
 class TelethonWorker:
     def __init__(self, api_id, api_hash, phone):
+        self.startup = StartupProfile()
+        self.startup.mark("imports")
         self.app = TelegramClient("telethon_session", api_id, api_hash)
         self.phone = phone
-        self.download_dir = "downloads"
-        os.makedirs(self.download_dir, exist_ok=True)
+        # شناسه باید بعد از restart ثابت بماند تا job ها و فایل‌های .part پروسه قبلی دوباره پیدا شوند
+        self.worker_id = (WORKER_ID or "{hostname}").format(hostname=socket.gethostname(), pid=os.getpid())
+        self.base_download_dir = os.path.join("downloads", self.worker_id)
+        self._local = threading.local()
         self.processed_ids = set()
         self.start_time = datetime.now(timezone.utc)
         self.active_jobs = {}
-        self.instagrapi_client = self.setup_instagrapi_client()
-        self.instaloader_client = self.setup_instaloader_client()
+        self.live_workers = []
+        self.db = PostgresDB()
+        self.startup.mark("database")
+        self.job_signal = asyncio.Event()
+        self.scheduler = JobScheduler(MAX_CONCURRENT_JOBS, PLATFORM_CONCURRENCY)
+        self.http = HttpDownloader()
+        self.uploader = ParallelUploader(self.app, PARALLEL_UPLOAD_CONNECTIONS - 1, PARALLEL_UPLOAD_PART_SIZE_KB * 1024) if PARALLEL_UPLOAD_CONNECTIONS > 1 else None
+        self.router = ProviderRouter(ROUTER_WINDOW, ROUTER_FAILURE_THRESHOLD, ROUTER_COOLDOWN_SECONDS, ROUTER_MAX_COOLDOWN_SECONDS)
+        self.metrics = Metrics("downloader_worker")
+        self.metrics.gauge_callback("queue_depth", self.scheduler.pending, "Jobs queued or running in the local scheduler")
+        self.metrics.gauge_callback("active_jobs", lambda: sum(1 for data in self.active_jobs.values() if data.get('status') not in ["Completed", "Failed"]), "Jobs currently being processed")
+        self.instagram = InstagramPool()
+        self.instagram.warm_up_in_background(("instagrapi", "instaloader"))
 
-    def setup_instagrapi_client(self):
-        try:
-            client = InstagrapiClient()
-            session_file = f"instagrapi_session_{INSTAGRAM_USERNAME}.json"
-            if os.path.exists(session_file): client.load_settings(session_file)
-            client.login(INSTAGRAM_USERNAME, INSTAGRAM_PASSWORD)
-            client.dump_settings(session_file)
-            logger.info("✅ Instagrapi session loaded/created successfully.")
-            return client
-        except Exception as e:
-            logger.error(f"❌ Could not login with Instagrapi. Error: {e}")
-            return None
+    @property
+    def download_dir(self):
+        return getattr(self._local, "download_dir", self.base_download_dir)
 
-    def setup_instaloader_client(self):
-        try:
-            L = instaloader.Instaloader(download_videos=True, download_pictures=True, download_video_thumbnails=False, save_metadata=False, compress_json=False)
-            session_file = f"instaloader_session_{INSTAGRAM_USERNAME}"
-            if os.path.exists(session_file):
-                L.load_session_from_file(INSTAGRAM_USERNAME, session_file)
-            else:
-                L.login(INSTAGRAM_USERNAME, INSTAGRAM_PASSWORD)
-                L.save_session_to_file(session_file)
-            logger.info("✅ Instaloader session loaded/created successfully.")
-            return L
-        except Exception as e:
-            logger.error(f"❌ Could not login with Instaloader. Error: {e}")
-            return None
-            
-    def _download_from_url(self, url, file_path):
-        with requests.get(url, stream=True, timeout=300) as r:
-            r.raise_for_status()
-            with open(file_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192): f.write(chunk)
-        return file_path
+    def _download_from_url(self, url, file_path, allow_stream=False):
+        if not (allow_stream and STREAM_UPLOADS) or os.path.exists(file_path + ".part.json"):
+            return self.http.download(url, file_path)
+        r = self.http.open(url)
+        size = int(r.headers.get('Content-Length') or 0)
+        if size and r.headers.get('Content-Encoding', 'identity') == 'identity':
+            return StreamedMedia(r, os.path.basename(file_path), size)
+        return self.http.download(url, file_path, response=r)
+
+    def _emit_item(self, code, index, total, path, method, caption, racer=None):
+        job = self.active_jobs.get(code, {})
+        race = job.get("race")
+        if race and racer:
+            with race["lock"]:
+                if race["owner"] is None and not race["settled"]:
+                    race["owner"] = racer
+                    race["owned"].add(racer)
+                if race["owner"] != racer: return
+        pipeline = job.get("pipeline")
+        if pipeline: pipeline.emit(index, total, path, method, caption)
+
+    def _download_items(self, code, fetchers, method, caption):
+        total, racer = len(fetchers), getattr(self._local, "racer", None)
+        def fetch(i):
+            path = fetchers[i]()
+            self._emit_item(code, i, total, path, method, caption, racer)
+            return path
+        with ThreadPoolExecutor(max_workers=CAROUSEL_DOWNLOAD_CONCURRENCY) as pool:
+            return list(pool.map(fetch, range(total)))
+
+    def _url_fetcher(self, code, index, media_url):
+        ext = ".mp4" if "video" in media_url or ".mp4" in media_url else ".jpg"
+        output_path = os.path.join(self.download_dir, f"{code}_{index}{ext}")
+        return partial(self._download_from_url, media_url, output_path, allow_stream=ext == ".jpg")
 
     def _try_instagrapi_post(self, url, code):
         logger.info(f"[{code}] Attempt 1: Instagrapi (Post/Reel)")
-        if not self.instagrapi_client: raise Exception("Instagrapi client not logged in.")
-        media_pk = self.instagrapi_client.media_pk_from_url(url)
-        media_info = self.instagrapi_client.media_info(media_pk).dict()
+        with self.instagram.checkout("instagrapi") as client:
+            media_info = client.media_info(client.media_pk_from_url(url)).dict()
         caption = media_info.get("caption_text", "")
-        resources = media_info.get("resources", []) or [media_info]
-        downloaded_files = []
-        for i, res in enumerate(resources):
-            dl_path, ext = None, ".jpg"
-            if res.get("media_type") == 2:
-                dl_path, ext = self.instagrapi_client.video_download(res['pk'], self.download_dir), ".mp4"
-            elif res.get("media_type") == 1:
-                dl_path, ext = self.instagrapi_client.photo_download(res['pk'], self.download_dir), ".jpg"
-            if dl_path:
-                final_path = os.path.join(self.download_dir, f"{code}_{i}{ext}")
+        resources = [res for res in (media_info.get("resources", []) or [media_info]) if res.get("media_type") in (1, 2)]
+        download_dir = self.download_dir
+        def fetcher(i, res):
+            def fetch():
+                is_video = res.get("media_type") == 2
+                final_path = os.path.join(download_dir, f"{code}_{i}{'.mp4' if is_video else '.jpg'}")
+                media_url = res.get("video_url") if is_video else res.get("thumbnail_url")
+                if media_url: return self._download_from_url(str(media_url), final_path, allow_stream=not is_video)
+                with self.instagram.checkout("instagrapi") as client:
+                    dl_path = client.video_download(res['pk'], download_dir) if is_video else client.photo_download(res['pk'], download_dir)
                 os.rename(dl_path, final_path)
-                downloaded_files.append(final_path)
+                return final_path
+            return fetch
+        downloaded_files = self._download_items(code, [fetcher(i, res) for i, res in enumerate(resources)], "Instagrapi", caption)
         if downloaded_files: return downloaded_files, caption, "Instagrapi"
         return [], None, None
 
     def _try_instaloader_post(self, url, code):
         logger.info(f"[{code}] Attempt 2: Instaloader (Post/Reel)")
-        if not self.instaloader_client: raise Exception("Instaloader client not logged in.")
         shortcode = url.split('/')[-2]
-        post = instaloader.Post.from_shortcode(self.instaloader_client.context, shortcode)
         downloaded_files, temp_dir = [], os.path.join(self.download_dir, code)
-        self.instaloader_client.download_post(post, target=temp_dir)
+        with self.instagram.checkout("instaloader") as loader:
+            post = instaloader.Post.from_shortcode(loader.context, shortcode)
+            loader.download_post(post, target=temp_dir)
         caption = post.caption or ""
         for i, filename in enumerate(sorted(os.listdir(temp_dir))):
             if not filename.endswith(('.jpg', '.mp4')): continue
@@ -130,71 +446,113 @@ class TelethonWorker:
     def _try_majidapi(self, url, code):
         logger.info(f"[{code}] Attempt 4: MajidAPI")
         api_url = f"https://api.majidapi.ir/instagram/download?url={url}&out=url&token={MAJID_API_TOKEN}"
-        data = requests.get(api_url, timeout=30).json()
+        data = self.http.get(api_url, timeout=30).json()
         if data.get("status") != 200: raise Exception(f"MajidAPI Error: {data.get('result')}")
         result = data.get("result", {})
         caption = result.get("caption", "")
         media_urls = result.get("carousel") or ([result.get("video")] if result.get("video") else []) or result.get("images")
-        downloaded_files = []
-        for i, media_url in enumerate(media_urls):
-            ext = ".mp4" if "video" in media_url or ".mp4" in media_url else ".jpg"
-            output_path = os.path.join(self.download_dir, f"{code}_{i}{ext}")
-            self._download_from_url(media_url, output_path)
-            downloaded_files.append(output_path)
+        downloaded_files = self._download_items(code, [self._url_fetcher(code, i, media_url) for i, media_url in enumerate(media_urls)], "MajidAPI", caption)
         if downloaded_files: return downloaded_files, caption, "MajidAPI"
         return [], None, None
 
     def _try_nestcode_api(self, url, code):
         logger.info(f"[{code}] Attempt 5: NestCode API")
         api_url = f"https://open.nestcode.org/apis-1/InstagramDownloader?url={url}&key={NESTCODE_API_KEY}"
-        data = requests.get(api_url, timeout=30).json()
+        data = self.http.get(api_url, timeout=30).json()
         if data.get("status") != "success": raise Exception(f"NestCode API Error: {data.get('data')}")
         result = data.get("data", {})
         caption = result.get("caption", "")
         media_urls = result.get("medias", [])
-        downloaded_files = []
-        for i, media_url in enumerate(media_urls):
-            ext = ".mp4" if "video" in media_url or ".mp4" in media_url else ".jpg"
-            output_path = os.path.join(self.download_dir, f"{code}_{i}{ext}")
-            self._download_from_url(media_url, output_path)
-            downloaded_files.append(output_path)
+        downloaded_files = self._download_items(code, [self._url_fetcher(code, i, media_url) for i, media_url in enumerate(media_urls)], "NestCode API", caption)
         if downloaded_files: return downloaded_files, caption, "NestCode API"
         return [], None, None
 
-    def download_instagram_post(self, url, code):
-        methods = [self._try_instagrapi_post, self._try_instaloader_post, self._try_yt_dlp_insta, self._try_majidapi, self._try_nestcode_api]
-        for method_func in methods:
+    def _run_method(self, kind, method_func, url, code):
+        started = time.monotonic()
+        try:
+            file_paths, caption, method_name = method_func(url, code)
+        except Exception as e:
+            self.router.record(kind, method_func.__name__, False, time.monotonic() - started, rate_limited=error_kind(e) in ("rate_limit", "challenge"))
+            self.metrics.inc("provider_attempts_total", help_text="Download provider attempts by outcome", kind=kind, provider=method_func.__name__, outcome="failure")
+            raise
+        self.router.record(kind, method_func.__name__, bool(file_paths), time.monotonic() - started)
+        self.metrics.inc("provider_attempts_total", kind=kind, provider=method_func.__name__, outcome="success" if file_paths else "empty")
+        return file_paths, caption, method_name
+
+    def _race_methods(self, kind, methods, url, code):
+        race = {"owner": None, "settled": False, "owned": set(), "lock": threading.Lock()}
+        self.active_jobs[code]["race"] = race
+        results = queue.Queue()
+        def racer(method_func):
+            name = method_func.__name__
+            racer_dir = os.path.join(self.base_download_dir, f"{code}_{name}")
+            os.makedirs(racer_dir, exist_ok=True)
+            self._local.download_dir, self._local.racer = racer_dir, name
             try:
-                file_paths, caption, method_name = method_func(url, code)
-                if file_paths:
-                    logger.info(f"✅ [{code}] Successfully downloaded post using {method_name}.")
-                    return file_paths, caption, method_name
+                outcome = self._run_method(kind, method_func, url, code)
             except Exception as e:
-                logger.warning(f"⚠️ [{code}] Method {method_func.__name__} failed: {e}")
+                logger.warning(f"⚠️ [{code}] Method {name} failed: {e}")
+                outcome = None
+            finally:
+                del self._local.download_dir, self._local.racer
+            with race["lock"]:
+                won = bool(outcome and outcome[0]) and not race["settled"] and race["owner"] in (None, name)
+                if won: race["owner"], race["settled"] = name, True
+                elif race["owner"] == name: race["owner"] = None
+                owned = name in race["owned"] or won
+            if not owned:
+                for item in (outcome[0] if outcome else []): discard_item(item)
+                shutil.rmtree(racer_dir, ignore_errors=True)
+            results.put(outcome if won else None)
+        for method_func in methods:
+            threading.Thread(target=racer, args=(method_func,), daemon=True).start()
+        for _ in methods:
+            outcome = results.get()
+            if outcome: return outcome
         return [], None, None
 
-    def download_instagram_story_or_highlight(self, url, code):
-        methods = [self._try_instagrapi_post, self._try_instaloader_post, self._try_majidapi, self._try_nestcode_api]
-        for method_func in methods:
+    def _download_with_router(self, kind, methods, url, code):
+        by_name = {method_func.__name__: method_func for method_func in methods}
+        ordered = [by_name[name] for name in self.router.order(kind, list(by_name))]
+        if ROUTER_RACE_TOP_TWO and len(ordered) > 1:
+            logger.info(f"[{code}] Racing {ordered[0].__name__} and {ordered[1].__name__} ({kind})")
+            file_paths, caption, method_name = self._race_methods(kind, ordered[:2], url, code)
+            if file_paths: return file_paths, caption, method_name
+            ordered = ordered[2:]
+        for method_func in ordered:
             try:
-                file_paths, caption, method_name = method_func(url, code)
-                if file_paths:
-                    logger.info(f"✅ [{code}] Successfully downloaded story/highlight using {method_name}.")
-                    if not caption: caption = f"Story/Highlight content"
-                    return file_paths, caption, method_name
+                file_paths, caption, method_name = self._run_method(kind, method_func, url, code)
+                if file_paths: return file_paths, caption, method_name
             except Exception as e:
                 logger.warning(f"⚠️ [{code}] Method {method_func.__name__} failed: {e}")
         return [], None, None
 
+    def download_instagram_post(self, url, code):
+        kind = "reel" if "/reel/" in url.lower() else "post"
+        methods = [self._try_instagrapi_post, self._try_instaloader_post, self._try_yt_dlp_insta, self._try_majidapi, self._try_nestcode_api]
+        file_paths, caption, method_name = self._download_with_router(kind, methods, url, code)
+        if file_paths: logger.info(f"✅ [{code}] Successfully downloaded post using {method_name}.")
+        return file_paths, caption, method_name
+
+    def download_instagram_story_or_highlight(self, url, code):
+        kind = "story" if "/stories/" in url.lower() and "/stories/highlights/" not in url.lower() else "highlight"
+        methods = [self._try_instagrapi_post, self._try_instaloader_post, self._try_majidapi, self._try_nestcode_api]
+        file_paths, caption, method_name = self._download_with_router(kind, methods, url, code)
+        if file_paths:
+            logger.info(f"✅ [{code}] Successfully downloaded story/highlight using {method_name}.")
+            if not caption: caption = f"Story/Highlight content"
+        return file_paths, caption, method_name
+
     def download_instagram_profile(self, url, code):
         logger.info(f"[{code}] Starting profile info download")
-        if not self.instagrapi_client: raise Exception("Instagrapi client not logged in.")
         username = re.search(r'instagram\.com/([a-zA-Z0-9\._]+)', url).group(1)
-        user_info = self.instagrapi_client.user_info_by_username(username).dict()
+        with self.instagram.checkout("instagrapi") as client:
+            user_info = client.user_info_by_username(username).dict()
         profile_pic_url = user_info.get('profile_pic_url_hd') or user_info.get('profile_pic_url')
         output_path = os.path.join(self.download_dir, f"{code}_profile.jpg")
-        self._download_from_url(profile_pic_url, output_path)
+        output_path = self._download_from_url(str(profile_pic_url), output_path, allow_stream=True)
         caption = user_info.get('username', '')
+        if code in self.active_jobs: self.active_jobs[code]["profile"] = user_info
         logger.info(f"✅ [{code}] Successfully fetched profile pic. Username: {caption}")
         return [output_path], caption, "Instagram Profile"
 
@@ -205,104 +563,233 @@ class TelethonWorker:
         elif d['status'] == 'finished':
             if code in self.active_jobs: self.active_jobs[code]["status"] = "Download Finished, Merging..."
 
-    def download_other_platforms(self, url, code):
+    def extract_formats(self, url, code):
+        logger.info(f"[{code}] Extracting formats for URL: {url}")
+        with yt_dlp.YoutubeDL({'cookiefile': 'cookies.txt', 'no_warnings': True, 'quiet': True}) as ydl:
+            info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+        if not info: raise Exception("yt-dlp could not extract any formats.")
+        return {k: v for k, v in info.items() if k not in MANIFEST_SKIP_KEYS}
+
+    def _downloaded_files(self, code):
+        return [path for path in (os.path.join(self.download_dir, f) for f in os.listdir(self.download_dir) if f.startswith(code)) if os.path.isfile(path)]
+
+    def download_other_platforms(self, url, code, format_option=None, manifest_info=None):
         try:
-            logger.info(f"[{code}] Starting download for URL: {url}")
+            logger.info(f"[{code}] Starting download for URL: {url}" + (f" (format {format_option})" if format_option else ""))
             output_path = os.path.join(self.download_dir, f"{code}.%(ext)s")
             ydl_opts = {'outtmpl': output_path, 'cookiefile': 'cookies.txt', 'ignoreerrors': True, 
                         'no_warnings': True, 'quiet': True,
-                        'format': 'bestvideo[height<=720][ext=mp4]+bestaudio[ext=m4a]/best[height<=720][ext=mp4]/best',
+                        'format': format_selector(format_option),
                         'merge_output_format': 'mp4',
                         'progress_hooks': [partial(self.yt_dlp_progress_hook, code=code)]}
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl: info_dict = ydl.extract_info(url, download=True)
-            downloaded_files = [os.path.join(self.download_dir, f) for f in os.listdir(self.download_dir) if f.startswith(code)]
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                info_dict = None
+                if manifest_info:
+                    # فرمت‌ها از manifest ذخیره شده انتخاب می‌شوند و صفحه دوباره استخراج نمی‌شود
+                    try: info_dict = ydl.process_ie_result(manifest_info, download=True)
+                    except Exception as e: logger.warning(f"[{code}] Could not download from the cached format manifest. Error: {e}")
+                    if not self._downloaded_files(code): logger.warning(f"[{code}] Cached format manifest is stale, re-extracting.")
+                if not self._downloaded_files(code): info_dict = ydl.extract_info(url, download=True)
+            downloaded_files = self._downloaded_files(code)
             if not downloaded_files: raise Exception("yt-dlp finished but no files were found.")
+            videos = [path for path in downloaded_files if path.lower().endswith(VIDEO_EXTENSIONS)]
+            if info_dict and len(videos) == 1 and all(info_dict.get(k) for k in ('duration', 'width', 'height')) and code in self.active_jobs:
+                self.active_jobs[code].setdefault("media_meta", {})[videos[0]] = {'duration': int(info_dict['duration']), 'width': int(info_dict['width']), 'height': int(info_dict['height'])}
             caption = info_dict.get('title', '') if info_dict else ""
+            if info_dict and code in self.active_jobs:
+                self.active_jobs[code]["meta"] = {'title': info_dict.get('title') or "", 'description': info_dict.get('description') or ""}
             return downloaded_files, caption, "yt-dlp"
         except Exception as e:
             logger.error(f"[{code}] Error in download_other_platforms: {e}", exc_info=True)
             raise e
 
-    def get_video_metadata(self, file_path):
+    async def _run_probe(self, command):
+        process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=60)
+        except asyncio.TimeoutError:
+            process.kill()
+            raise Exception(f"{command[0]} timed out")
+        return process.returncode, stdout.decode(errors='ignore'), stderr.decode(errors='ignore')
+
+    async def probe_video(self, file_path, code):
+        metadata = self.active_jobs.get(code, {}).get("media_meta", {}).get(file_path)
+        thumb_path = f"{os.path.splitext(file_path)[0]}_thumb.jpg" if MEDIA_THUMBNAILS else None
         try:
-            command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=width,height,duration', '-of', 'json', file_path]
-            result = subprocess.run(command, capture_output=True, text=True, check=True, timeout=30)
-            data = json.loads(result.stdout)['streams'][0]
-            return {'duration': int(float(data.get('duration', 0))), 'width': int(data.get('width', 0)), 'height': int(data.get('height', 0))}
+            if thumb_path:
+                command = ['ffmpeg', '-hide_banner', '-nostdin', '-y', '-i', file_path, '-vf', 'thumbnail=50,scale=320:320:force_original_aspect_ratio=decrease',
+                           '-frames:v', '1', '-q:v', '5', thumb_path]
+                _, _, stderr = await self._run_probe(command)
+                if not metadata:
+                    duration, size = re.search(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)', stderr), re.search(r'Stream #.*?Video: .*?(\d{2,5})x(\d{2,5})', stderr)
+                    if duration and size:
+                        h, m, sec = duration.groups()
+                        metadata = {'duration': int(int(h) * 3600 + int(m) * 60 + float(sec)), 'width': int(size.group(1)), 'height': int(size.group(2))}
+            elif not metadata:
+                command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=width,height,duration', '-of', 'json', file_path]
+                _, stdout, _ = await self._run_probe(command)
+                data = json.loads(stdout)['streams'][0]
+                metadata = {'duration': int(float(data.get('duration', 0))), 'width': int(data.get('width', 0)), 'height': int(data.get('height', 0))}
         except Exception as e:
-            logger.warning(f"[{os.path.basename(file_path)}] Could not get video metadata. Reason: {e}")
-            return None
+            logger.warning(f"[{os.path.basename(file_path)}] Could not probe video. Reason: {e}")
+        return metadata, thumb_path if thumb_path and os.path.exists(thumb_path) else None
+
+    async def stream_upload(self, media, progress_callback):
+        part_size = STREAM_PART_SIZE_KB * 1024
+        total_parts = (media.size + part_size - 1) // part_size
+        is_big = media.size > 10 * 1024 * 1024
+        file_id = random.randrange(-2**63, 2**63)
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=STREAM_BUFFER_PARTS)
+        producer = loop.run_in_executor(None, media.produce, queue, loop, part_size)
+        sent, part_index = 0, 0
+        try:
+            while True:
+                part = await queue.get()
+                if part is None: break
+                request = SaveBigFilePartRequest(file_id, part_index, total_parts, part) if is_big else SaveFilePartRequest(file_id, part_index, part)
+                if not await self.app(request): raise Exception(f"Telegram rejected part {part_index} of {media.name}")
+                part_index, sent = part_index + 1, sent + len(part)
+                progress_callback(sent, media.size)
+            await producer
+        finally:
+            media.close()
+        if part_index != total_parts: raise Exception(f"Stream of {media.name} ended after {part_index}/{total_parts} parts")
+        return InputFileBig(file_id, total_parts, media.name) if is_big else InputFile(file_id, total_parts, media.name, '')
 
-    async def upload_single_file(self, message, file_path, code, download_method, index, total_files, original_caption):
+    async def upload_single_file(self, job, file_path, code, download_method, index, total_files, original_caption):
+        is_stream, thumb_path = isinstance(file_path, StreamedMedia), None
         try:
-            if not os.path.exists(file_path): raise Exception(f"File vanished: {os.path.basename(file_path)}")
-            file_size = os.path.getsize(file_path)
+            if not is_stream and not os.path.exists(file_path): raise Exception(f"File vanished: {os.path.basename(file_path)}")
+            file_name = file_path.name if is_stream else os.path.basename(file_path)
+            file_size = file_path.size if is_stream else os.path.getsize(file_path)
             self.active_jobs[code]["status"] = f"Uploading {index}/{total_files}..."
-            logger.info(f"[{code}] Uploading {index}/{total_files}: {os.path.basename(file_path)} ({file_size / 1024**2:.2f} MB)")
-            attributes, caption_to_group = [], f"✅ Uploaded ({index}/{total_files})\nCODE: {code}\nSIZE: {file_size}\nMETHOD: {download_method}"
-            if file_path.lower().endswith(('.mp4', '.mkv', '.mov')):
-                metadata = self.get_video_metadata(file_path)
+            logger.info(f"[{code}] Uploading {index}/{total_files}: {file_name} ({file_size / 1024**2:.2f} MB{', streamed' if is_stream else ''})")
+            profile = self.active_jobs.get(code, {}).get("profile")
+            attributes, caption_to_group = [], encode_result(code, index, total_files, file_size, download_method, profile=profile and profile.get('username'))
+            trace = self.active_jobs[code]["trace"]
+            if not is_stream and file_path.lower().endswith(VIDEO_EXTENSIONS):
+                with trace.span("probe"): metadata, thumb_path = await self.probe_video(file_path, code)
                 if metadata: attributes.append(DocumentAttributeVideo(duration=metadata['duration'], w=metadata['width'], h=metadata['height'], supports_streaming=True))
-            if original_caption and index == total_files:
-                truncated_caption = original_caption[:700]
-                encoded_caption = base64.b64encode(truncated_caption.encode('utf-8')).decode('utf-8')
-                caption_to_group += f"\nCAPTION:{encoded_caption}"
-            await self.app.send_file(message.chat_id, file_path, caption=caption_to_group, reply_to=message.id, attributes=attributes,
-                                     progress_callback=lambda s, t: self.update_upload_status(s, t, code, index, total_files))
+            upload_started = time.monotonic()
+            progress = lambda s, t: self.update_upload_status(s, t, code, index, total_files, upload_started)
+            with trace.span("upload"):
+                if is_stream: file_to_send = await self.stream_upload(file_path, progress)
+                elif self.uploader and file_size >= PARALLEL_UPLOAD_MIN_MB * 1024 * 1024: file_to_send = await self.uploader.upload(file_path, progress)
+                else: file_to_send = file_path
+                await self.app.send_file(GROUP_ID, file_to_send, caption=caption_to_group, reply_to=job['reply_to'], attributes=attributes,
+                                         thumb=thumb_path, progress_callback=None if file_to_send is not file_path else progress)
+            self.metrics.observe("upload_bytes_per_second", file_size / max(time.monotonic() - upload_started, 0.001), SPEED_BUCKETS, "Upload throughput per file")
+            self.metrics.inc("uploaded_bytes_total", file_size, "Bytes uploaded to the group")
+            trace.bytes += file_size
         except Exception as e:
             raise e
         finally:
-            if os.path.exists(file_path): os.remove(file_path)
+            discard_item(file_path)
+            if thumb_path: discard_item(thumb_path)
 
-    def update_upload_status(self, sent, total, code, index, total_files):
+    def update_upload_status(self, sent, total, code, index, total_files, started=None):
         if code in self.active_jobs:
             percentage = int(sent * 100 / total)
-            self.active_jobs[code]["status"] = f"Uploading {index}/{total_files}: {percentage}%"
+            speed = f" @ {sent / max(time.monotonic() - started, 0.001) / 1024 ** 2:.1f} MB/s" if started else ""
+            self.active_jobs[code]["status"] = f"Uploading {index}/{total_files}: {percentage}%{speed}"
     
-    async def process_job(self, message):
-        code, url, user_id = "N/A", "N/A", 0
+    def parse_job_message(self, message):
+        job = parse_message(message.text)
+        if job['kind'] != 'job': raise ProtocolError(f"Expected a job message, got {job['kind']}")
+        return {'code': job['code'], 'url': job['url'], 'user_id': job['user_id']}
+
+    def enqueue_job(self, job):
+        self.active_jobs[job['code']] = {"user_id": job['user_id'], "status": "Queued", "error": None, "trace": JobTrace(self.metrics, job['code'])}
+        priority = 0 if job['user_id'] in ADMIN_IDS else 1
+        self.scheduler.submit(job_platform(job['url']), priority, partial(self.process_job, job))
+
+    async def process_job(self, job):
+        code, url, user_id = job['code'], job['url'], job['user_id']
+        pipeline = UploadPipeline(self, job)
+        trace, outcome, method = self.active_jobs[code]["trace"], "failure", None
+        trace.add("queue_wait", time.monotonic() - trace.started)
         try:
-            lines = message.text.split('\n')
-            url = next(l.split(":", 1)[1].strip() for l in lines if l.startswith("URL:"))
-            code = next(l.split(":", 1)[1].strip() for l in lines if l.startswith("CODE:"))
-            user_id = int(next(l.split(":", 1)[1].strip() for l in lines if l.startswith("USER_ID:")))
-            self.active_jobs[code] = {"user_id": user_id, "status": "Queued", "error": None}
+            self.active_jobs[code].update({"status": "Starting...", "pipeline": pipeline})
             logger.info(f"[{code}] Job received for user [{user_id}].")
             
             file_paths, caption_text, method = [], None, None
             url_lower = url.lower().strip('/')
             
-            if "instagram.com" in url_lower:
-                if "/stories/highlights/" in url_lower or "/s/" in url_lower:
-                    self.active_jobs[code]["status"] = "Downloading (Insta Highlight)..."
-                    file_paths, caption_text, method = await asyncio.to_thread(self.download_instagram_story_or_highlight, url, code)
-                elif "/stories/" in url_lower:
-                    self.active_jobs[code]["status"] = "Downloading (Insta Story)..."
-                    file_paths, caption_text, method = await asyncio.to_thread(self.download_instagram_story_or_highlight, url, code)
-                elif "/p/" in url_lower or "/reel/" in url_lower:
-                    self.active_jobs[code]["status"] = "Downloading (Insta Post)..."
-                    file_paths, caption_text, method = await asyncio.to_thread(self.download_instagram_post, url, code)
+            if job.get('kind') == 'extract':
+                await self.extract_format_manifest(job)
+                outcome = "extracted"
+                return
+            with trace.span("download"):
+                if "instagram.com" in url_lower:
+                    if "/stories/highlights/" in url_lower or "/s/" in url_lower:
+                        self.active_jobs[code]["status"] = "Downloading (Insta Highlight)..."
+                        file_paths, caption_text, method = await asyncio.to_thread(self.download_instagram_story_or_highlight, url, code)
+                    elif "/stories/" in url_lower:
+                        self.active_jobs[code]["status"] = "Downloading (Insta Story)..."
+                        file_paths, caption_text, method = await asyncio.to_thread(self.download_instagram_story_or_highlight, url, code)
+                    elif "/p/" in url_lower or "/reel/" in url_lower:
+                        self.active_jobs[code]["status"] = "Downloading (Insta Post)..."
+                        file_paths, caption_text, method = await asyncio.to_thread(self.download_instagram_post, url, code)
+                    else:
+                        self.active_jobs[code]["status"] = "Fetching (Insta Profile)..."
+                        file_paths, caption_text, method = await asyncio.to_thread(self.download_instagram_profile, url, code)
                 else:
-                    self.active_jobs[code]["status"] = "Fetching (Insta Profile)..."
-                    file_paths, caption_text, method = await asyncio.to_thread(self.download_instagram_profile, url, code)
-            else:
-                file_paths, caption_text, method = await asyncio.to_thread(self.download_other_platforms, url, code)
+                    manifest = None
+                    if job.get('format_option'):
+                        self.active_jobs[code]["status"] = f"Downloading ({job['format_option']})..."
+                        manifest = await self.db.get_format_manifest(job['cache_key'].rsplit('|', 1)[0], FORMAT_MANIFEST_TTL_MINUTES, with_info=True)
+                    file_paths, caption_text, method = await asyncio.to_thread(self.download_other_platforms, url, code, job.get('format_option'), manifest and manifest['info'])
             
             if code in self.active_jobs: self.active_jobs[code]["status"] = "Processing..."
             for i, path in enumerate(file_paths):
-                await self.upload_single_file(message, path, code, method, i + 1, len(file_paths), caption_text)
-            if code in self.active_jobs: self.active_jobs[code]["status"] = "Completed"
+                pipeline.accept(i, len(file_paths), path, method, caption_text)
+            elapsed = await pipeline.finish()
+            await self.db.finish_job(code)
+            outcome = "success"
+            if code in self.active_jobs: self.active_jobs[code].update({"status": "Completed", "elapsed": elapsed})
         except Exception as e:
             error_short = str(e).strip().split('\n')[0]
-            if "CODE:" in error_short: error_short = "Could not parse job message"
+            for task in pipeline.tasks: task.cancel()
             if code in self.active_jobs:
                 self.active_jobs[code].update({"status": "Failed", "error": error_short[:70]})
             logger.error(f"[{code}] Job failed entirely. Error: {error_short}")
             try:
-                failure_message = f"❌ JOB FAILED\nCODE: {code}\nREASON: {error_short}"
-                await self.app.send_message(message.chat_id, failure_message, reply_to=message.id)
+                await self.db.fail_job(code, error_short)
+            except Exception as db_e:
+                logger.error(f"[{code}] Could not mark job as failed in database. Error: {db_e}")
+            try:
+                failure_message = encode_failure(code, error_short)
+                await self.app.send_message(GROUP_ID, failure_message, reply_to=job['reply_to'])
             except Exception as notify_e:
                 logger.error(f"[{code}] Could not notify main bot about failure. Error: {notify_e}")
+        finally:
+            for leftover in [f for f in os.listdir(self.base_download_dir) if f.startswith(code)]:
+                leftover_path = os.path.join(self.base_download_dir, leftover)
+                if os.path.isfile(leftover_path): os.remove(leftover_path)
+                elif os.path.isdir(leftover_path): shutil.rmtree(leftover_path, ignore_errors=True)
+            await self.finish_trace(job, trace, outcome, method)
+
+    async def finish_trace(self, job, trace, outcome, method):
+        processing = time.monotonic() - trace.started - trace.stages.get("queue_wait", 0)
+        trace.add("processing", processing)
+        self.metrics.inc("jobs_total", help_text="Jobs processed by platform, method and outcome", platform=job_platform(job['url']), method=method or "-", outcome=outcome)
+        if trace.bytes: self.metrics.observe("job_bytes_per_second", trace.bytes / max(processing, 0.001), SPEED_BUCKETS, "End-to-end worker throughput per job")
+        try:
+            await self.db.add_job_timings(job['code'], trace.stages)
+        except Exception as e:
+            logger.error(f"[{job['code']}] Could not save stage timings. Error: {e}")
+
+    async def extract_format_manifest(self, job):
+        code, url = job['code'], job['url']
+        self.active_jobs[code]["status"] = "Extracting formats..."
+        with self.active_jobs[code]["trace"].span("extract"): info = await asyncio.to_thread(self.extract_formats, url, code)
+        options = format_options(info)
+        await self.db.save_format_manifest((job.get('cache_key') or url).rsplit('|', 1)[0], url, info.get('title'), options, json.dumps(info))
+        await self.db.finish_job(code)
+        await self.app.send_message(GROUP_ID, encode_formats_ready(code), reply_to=job['reply_to'])
+        self.active_jobs[code]["status"] = "Completed"
+        logger.info(f"[{code}] Format manifest saved with {len(options)} option(s).")
 
     async def display_dashboard(self):
         while True:
@@ -319,26 +806,129 @@ class TelethonWorker:
                         await asyncio.sleep(10)
                         self.active_jobs.pop(code, None)
             print("-" * 80)
+            print(self.scheduler.summary())
+            print("-" * 80)
+            print(self.router.summary())
+            print("-" * 80)
+            print(self.instagram.summary())
+            print("-" * 80)
+            print(self.http.summary())
+            print("-" * 80)
+            print(f"Worker: {self.worker_id} | Live workers: {', '.join(f'{w} ({n})' for w, n in self.live_workers) or 'N/A'}")
             print(f"Last Update: {datetime.now().strftime('%H:%M:%S')} | Logs: tail -f bot.log")
             await asyncio.sleep(1)
 
+    async def claim_worker_id(self):
+        # دو پروسه با یک شناسه job ها و lease های همدیگر را requeue و تمدید می‌کنند؛ شناسه‌ای که زنده است با پسوند عوض می‌شود
+        hostname, base_id = socket.gethostname(), self.worker_id
+        def is_previous_run(owner_host, owner_pid):
+            # پروسه قبلی همین host که دیگر وجود ندارد (crash و restart قبل از تمام شدن lease)
+            if owner_host != hostname: return False
+            if not owner_pid: return True
+            try: os.kill(owner_pid, 0)
+            except ProcessLookupError: return True
+            except PermissionError: pass
+            return False
+        for number in itertools.count(1):
+            worker_id = base_id if number == 1 else f"{base_id}-{number}"
+            if await self.db.register_worker(worker_id, hostname, os.getpid(), JOB_LEASE_SECONDS, is_previous_run): break
+        if worker_id != base_id: logger.warning(f"Worker id {base_id} is used by another live process, running as {worker_id}. Set a distinct WORKER_ID for each worker.")
+        self.worker_id, self.base_download_dir = worker_id, os.path.join("downloads", worker_id)
+        os.makedirs(self.base_download_dir, exist_ok=True)
+
     async def run(self):
         try:
             await self.app.start(phone=self.phone)
             me = await self.app.get_me()
+            self.startup.mark("telegram")
             logger.info(f"Worker (Final) successfully logged in as {me.first_name}")
+            await self.claim_worker_id()
         except Exception as e:
             logger.critical(f"Could not start the worker. Error: {e}")
             return
+        self.scheduler.start()
+        try: await self.metrics.serve(METRICS_HOST, WORKER_METRICS_PORT)
+        except OSError as e: logger.error(f"Could not start the metrics endpoint. Error: {e}")
         dashboard_task = asyncio.create_task(self.display_dashboard())
-        logger.info(f"Worker started listening for new jobs...")
+        heartbeat_task = asyncio.create_task(self.heartbeat_loop())
+        requeued, failed = await self.db.requeue_interrupted_jobs(self.worker_id, JOB_MAX_ATTEMPTS)
+        if requeued: logger.info(f"Re-queued {requeued} job(s) interrupted by the previous run.")
+        for code in failed:
+            logger.warning(f"[{code}] Job interrupted {JOB_MAX_ATTEMPTS} times, giving up.")
+            await self.app.send_message(GROUP_ID, encode_failure(code, "Worker lost the job too many times"), reply_to=ORDER_TOPIC_ID)
+        self.startup.mark("requeue")
+        logger.info(f"⏱ Startup: {self.startup.report()}")
+        preload_in_background(yt_dlp, instaloader)
+        logger.info(f"Worker started listening for new jobs (transport: {JOB_TRANSPORT})...")
+        if JOB_TRANSPORT == "telegram": await self.poll_order_topic()
+        else: await self.consume_job_queue()
+
+    async def heartbeat_loop(self):
+        hostname = socket.gethostname()
+        while True:
+            try:
+                active = sum(1 for data in self.active_jobs.values() if data.get('status') not in ["Completed", "Failed"])
+                await self.db.heartbeat(self.worker_id, hostname, active, JOB_LEASE_SECONDS)
+                self.live_workers = await self.db.get_live_workers(JOB_LEASE_SECONDS)
+                for code in await self.db.fail_abandoned_jobs(JOB_MAX_ATTEMPTS):
+                    logger.warning(f"[{code}] Job abandoned after {JOB_MAX_ATTEMPTS} attempts.")
+                    await self.app.send_message(GROUP_ID, encode_failure(code, "Worker lost the job too many times"), reply_to=ORDER_TOPIC_ID)
+            except Exception as e:
+                logger.error(f"Heartbeat failed: {e}")
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+
+    async def consume_job_queue(self):
+        await self.db.listen('new_job', lambda payload: self.job_signal.set())
+        while True:
+            try:
+                await self.scheduler.wait_for_capacity()
+                self.job_signal.clear()
+                self.scheduler.slot_freed.clear()
+                await self.claim_pending_jobs()
+                # job جدید یا آزاد شدن slot یک platform (که شاید job هایش در صف دیتابیس منتظرند)
+                waiters = [asyncio.ensure_future(self.job_signal.wait()), asyncio.ensure_future(self.scheduler.slot_freed.wait())]
+                await asyncio.wait(waiters, timeout=JOB_QUEUE_SWEEP_SECONDS, return_when=asyncio.FIRST_COMPLETED)
+                for waiter in waiters: waiter.cancel()
+            except Exception as e:
+                logger.error(f"An error occurred in the job queue loop: {e}", exc_info=True)
+                await asyncio.sleep(30)
+
+    async def claim_pending_jobs(self):
+        # تا پر شدن ظرفیت job های pending جدول (شامل job های lease منقضی و restart) را claim می‌کند
+        while True:
+            platforms = self.scheduler.open_platforms()
+            if not platforms: return
+            job = await self.db.claim_next_job(self.worker_id, JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS, platforms)
+            if not job: return
+            if job['attempts'] > 1: logger.info(f"[{job['code']}] Re-claimed job from an expired lease (attempt {job['attempts']}).")
+            if job['coalesced']: logger.info(f"[{job['code']}] Coalesced {job['coalesced']} identical pending job(s) into this download.")
+            job['reply_to'] = ORDER_TOPIC_ID
+            self.enqueue_job(job)
+
+    async def poll_order_topic(self):
+        # پیام‌های topic فقط راه سریع پیدا کردن job جدید است؛ منبع اصلی جدول jobs است که هر JOB_QUEUE_SWEEP_SECONDS بررسی می‌شود
+        last_sweep = 0
         while True:
             try:
                 async for message in self.app.iter_messages(GROUP_ID, reply_to=ORDER_TOPIC_ID, limit=10):
                     if message.date < self.start_time: break
                     if message.text and "⬇️ NEW JOB" in message.text and message.id not in self.processed_ids:
+                        if self.scheduler.pending() >= self.scheduler.global_limit: break
+                        try: order = self.parse_job_message(message)
+                        except ProtocolError as e:
+                            self.processed_ids.add(message.id)
+                            logger.error(f"Could not parse job message {message.id}: {e}")
+                            continue
+                        # platform پر است؛ پیام بعداً دوباره دیده می‌شود یا sweep جدول jobs آن را برمی‌دارد
+                        if job_platform(order['url']) not in self.scheduler.open_platforms(): continue
                         self.processed_ids.add(message.id)
-                        asyncio.create_task(self.process_job(message))
+                        job = await self.db.claim_job_by_code(order['code'], self.worker_id, JOB_LEASE_SECONDS)
+                        if not job: continue
+                        job['reply_to'] = message.id
+                        self.enqueue_job(job)
+                if time.monotonic() - last_sweep >= JOB_QUEUE_SWEEP_SECONDS:
+                    last_sweep = time.monotonic()
+                    await self.claim_pending_jobs()
                 await asyncio.sleep(3)
             except Exception as e:
                 logger.error(f"An error occurred in the main loop: {e}", exc_info=True)
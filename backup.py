@@ -0,0 +1,81 @@
+import io
+import os
+import sys
+import json
+import asyncio
+import tarfile
+import fnmatch
+import argparse
+
+from config import DB_NAME, DB_USER, DB_PASS
+
+# --- ابزار ساخت و بازگردانی بکاپ ---
+# بازگردانی زنجیره بکاپ: python backup.py restore bot-backup-full-....tar.gz bot-backup-inc-....tar.gz ...
+
+PROJECT_EXCLUDES = ('.git', 'venv', '__pycache__', 'downloads', '*.log', '*.session*', '*.json')
+
+def _exclude_project_files(member):
+    return None if any(fnmatch.fnmatch(os.path.basename(member.name), pattern) for pattern in PROJECT_EXCLUDES) else member
+
+def build_backup_archive(files, manifest, project_dir=None):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as tar:
+        for name, data in list(files.items()) + [('manifest.json', json.dumps(manifest, default=str).encode('utf-8'))]:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        if project_dir: tar.add(project_dir, arcname=os.path.basename(project_dir), filter=_exclude_project_files)
+    return buffer.getvalue()
+
+def read_backup_archive(path, names=('manifest.json', 'database.dump', 'users.csv', 'jobs.csv')):
+    files = {}
+    with tarfile.open(path, mode='r:gz') as tar:
+        for name in names:
+            try: files[name] = tar.extractfile(name).read()
+            except KeyError: pass
+    files['manifest'] = json.loads(files.pop('manifest.json'))
+    return files
+
+async def dump_database():
+    env = {**os.environ, 'PGPASSWORD': DB_PASS}
+    process = await asyncio.create_subprocess_exec('pg_dump', '-Fc', '-U', DB_USER, '-d', DB_NAME, env=env,
+                                                   stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    stdout, stderr = await process.communicate()
+    if process.returncode: raise Exception(f"pg_dump failed: {stderr.decode(errors='ignore').strip()}")
+    return stdout
+
+async def restore_database_dump(data):
+    env = {**os.environ, 'PGPASSWORD': DB_PASS}
+    process = await asyncio.create_subprocess_exec('pg_restore', '--clean', '--if-exists', '--no-owner', '-U', DB_USER, '-d', DB_NAME, env=env,
+                                                   stdin=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    _, stderr = await process.communicate(data)
+    if process.returncode: raise Exception(f"pg_restore failed: {stderr.decode(errors='ignore').strip()}")
+
+async def restore_chain(paths):
+    from database import PostgresDB
+    archives = sorted((read_backup_archive(path) | {'path': path} for path in paths), key=lambda a: a['manifest']['until'])
+    fulls = [i for i, archive in enumerate(archives) if archive['manifest']['kind'] == 'full']
+    archives = archives[fulls[-1]:] if fulls else archives
+    if archives and archives[0]['manifest']['kind'] == 'full':
+        print(f"Restoring full dump {archives[0]['path']} ...")
+        await restore_database_dump(archives[0]['database.dump'])
+        archives = archives[1:]
+    db = PostgresDB()
+    try:
+        for archive in archives:
+            restored = await db.import_backup_rows({table: archive[f"{table}.csv"] for table in ('users', 'jobs') if f"{table}.csv" in archive})
+            print(f"Replayed {archive['path']} ({restored} row(s), until {archive['manifest']['until']}).")
+    finally:
+        db.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Backup tools for the downloader bot")
+    sub = parser.add_subparsers(dest="command", required=True)
+    restore_parser = sub.add_parser("restore", help="Restore a full backup and replay the incremental backups after it")
+    restore_parser.add_argument("archives", nargs="+")
+    args = parser.parse_args()
+    if args.command == "restore":
+        asyncio.run(restore_chain(args.archives))
+
+if __name__ == "__main__":
+    sys.exit(main())
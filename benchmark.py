@@ -0,0 +1,891 @@
+import argparse
+import asyncio
+import random
+import string
+import os
+import json
+import time
+import base64
+import gzip
+import socket
+import itertools
+import sys
+import shutil
+import subprocess
+import logging
+import resource
+import tempfile
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, parse_qs, urlparse
+
+import psycopg2
+
+from config import DB_NAME, DB_USER, DB_PASS, DB_HOST, DB_PORT, GROUP_ID, ORDER_TOPIC_ID, ADMIN_IDS, FAILURE_MESSAGE
+
+# --- ابزار بنچمارک ---
+# python benchmark.py db --requests 2000 --concurrency 20
+# python benchmark.py protocol --messages 100000
+# python benchmark.py http --files 4 --size-mb 64 --rate-mbps 40 --drop-after-mb 8
+# python benchmark.py http-check
+# python benchmark.py updates --updates 2000 --users 200 --concurrency 64
+# python benchmark.py e2e --requests 200 --rate 5 --mix instagram=50,youtube=30,repeat=15,broken=5
+# python benchmark.py startup --login-ms 3000
+
+def random_code():
+    return ''.join(random.choices(string.ascii_lowercase + string.digits, k=8))
+
+def print_result(name, count, elapsed):
+    print(f"{name:<28} | {count:>7} req | {elapsed:>8.2f} s | {count / elapsed:>9.1f} req/s")
+
+class LegacyDB:
+    def __init__(self):
+        self.conn_params = {"dbname": DB_NAME, "user": DB_USER, "password": DB_PASS, "host": DB_HOST, "port": DB_PORT}
+
+    def get_conn(self):
+        return psycopg2.connect(**self.conn_params)
+
+    def add_job(self, code, user_id, url):
+        with self.get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute("INSERT INTO jobs (code, user_id, url) VALUES (%s, %s, %s);", (code, user_id, url))
+
+    def get_job_by_code(self, code):
+        with self.get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT user_id, url FROM jobs WHERE code = %s;", (code,))
+                return cur.fetchone()
+
+async def bench_db(args):
+    from database import PostgresDB
+    db = PostgresDB()
+    user_id = 0
+    await db._query(lambda cur: cur.execute("INSERT INTO users (user_id, first_name) VALUES (%s, 'bench') ON CONFLICT DO NOTHING;", (user_id,)))
+    codes = []
+
+    # --- مسیر قدیمی: یک اتصال جدید برای هر درخواست، به صورت blocking روی event loop ---
+    legacy = LegacyDB()
+    started = time.perf_counter()
+    for _ in range(args.requests // 2):
+        code = f"bench_{random_code()}"
+        legacy.add_job(code, user_id, "https://example.com/bench")
+        legacy.get_job_by_code(code)
+        codes.append(code)
+    print_result("connect-per-call (blocking)", args.requests, time.perf_counter() - started)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    async def pooled_request():
+        async with semaphore:
+            code = f"bench_{random_code()}"
+            await db.add_job(code, user_id, "https://example.com/bench")
+            await db.get_job_by_code(code)
+            codes.append(code)
+    started = time.perf_counter()
+    await asyncio.gather(*(pooled_request() for _ in range(args.requests // 2)))
+    print_result(f"pooled (concurrency={args.concurrency})", args.requests, time.perf_counter() - started)
+
+    await db._query(lambda cur: cur.execute("DELETE FROM jobs WHERE code = ANY(%s);", (codes,)))
+    db.close()
+
+def legacy_result_caption(code, index, total, size, method, caption):
+    text = f"✅ Uploaded ({index}/{total})\nCODE: {code}\nSIZE: {size}\nMETHOD: {method}"
+    return text + f"\nCAPTION:{base64.b64encode(caption[:700].encode('utf-8')).decode('utf-8')}" if caption else text
+
+def legacy_parse_result(text):
+    info = {line.split(":", 1)[0].strip(): line.split(":", 1)[1].strip() for line in text.split('\n') if ":" in line}
+    return {'code': info.get("CODE"), 'size': int(info.get("SIZE", 0)), 'method': info.get("METHOD")}
+
+def corrupt(text):
+    position = random.randrange(len(text))
+    return text[:position] + random.choice(string.ascii_letters + string.digits + ":\n") + text[position + 1:]
+
+def bench_protocol(args):
+    from job_protocol import encode_result, parse_message, ProtocolError
+    samples = [(random_code(), random.randint(1, 10), 10, random.randint(1, 2**31), random.choice(["Instagrapi", "yt-dlp", "MajidAPI"]),
+                "caption " * random.randint(0, 80)) for _ in range(args.messages)]
+    formats = {
+        "legacy (line-by-line)": ([legacy_result_caption(*s) for s in samples], legacy_parse_result),
+        "envelope v1 (json+crc32)": ([encode_result(*s[:5]) for s in samples], parse_message),
+    }
+    for name, (messages, parse) in formats.items():
+        started = time.perf_counter()
+        for message in messages: parse(message)
+        print_result(f"{name} parse", len(messages), time.perf_counter() - started)
+        detected = silent = 0
+        for message, sample in zip(messages, samples):
+            try:
+                parsed = parse(corrupt(message))
+                if (parsed['code'], parsed['size'], parsed['method']) != (sample[0], sample[3], sample[4]): silent += 1
+            except (ProtocolError, ValueError, KeyError, IndexError):
+                detected += 1
+        print(f"{'':<28} | avg size {sum(map(len, messages)) / len(messages):>6.0f} chars | 1-char corruption: "
+              f"{detected * 100 / len(messages):.1f}% rejected, {silent * 100 / len(messages):.1f}% silently wrong")
+
+class MediaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, size, rate, drop_after):
+        super().__init__(("127.0.0.1", 0), MediaHandler)
+        self.payload = os.urandom(1024 * 1024) * (size // (1024 * 1024)) + os.urandom(size % (1024 * 1024))
+        self.rate, self.drop_after = rate, drop_after
+        self.connections, self.dropped, self.sent = 0, set(), 0
+        self.lock = threading.Lock()
+
+class MediaHandler(BaseHTTPRequestHandler):
+    # هر connection به rate بایت در ثانیه محدود می‌شود تا رفتار CDN های واقعی شبیه‌سازی شود
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock: self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.startswith('/gzip/'):
+            # مثل CDN هایی که بدون درخواست Range فایل را فشرده می‌فرستند؛ Content-Length اندازه بدنه فشرده است
+            body = gzip.compress(self.server.payload)
+            self.send_response(200)
+            for header, value in (('Content-Length', len(body)), ('Content-Encoding', 'gzip'), ('Accept-Ranges', 'bytes')): self.send_header(header, str(value))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        payload, size = self.server.payload, len(self.server.payload)
+        start, end, status = 0, size - 1, 200
+        match = self.headers.get('Range', '').replace('bytes=', '').split('-') if self.headers.get('Range') else None
+        if match:
+            start, status = int(match[0]), 206
+            end = int(match[1]) if match[1] else size - 1
+        self.send_response(status)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', '"bench"')
+        if status == 206: self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        drop = None
+        with self.server.lock:
+            # اولین اتصال هر بخش (هر نقطه شروع) بعد از drop_after بایت قطع می‌شود
+            if self.server.drop_after and (self.path, start) not in self.server.dropped:
+                self.server.dropped.add((self.path, start))
+                drop = self.server.drop_after
+        position, block, began = start, 64 * 1024, time.perf_counter()
+        while position <= end:
+            if drop is not None and position - start >= drop:
+                self.close_connection = True
+                return
+            data = payload[position:min(position + block, end + 1)]
+            try: self.wfile.write(data)
+            except (BrokenPipeError, ConnectionResetError): return
+            position += len(data)
+            with self.server.lock: self.server.sent += len(data)
+            ahead = (position - start) / self.server.rate - (time.perf_counter() - began)
+            if ahead > 0: time.sleep(ahead)
+
+def legacy_http_download(url, file_path):
+    import requests
+    r = requests.get(url, stream=True, timeout=300)
+    r.raise_for_status()
+    with open(file_path, 'wb') as f:
+        for chunk in r.iter_content(chunk_size=8192): f.write(chunk)
+    r.close()
+
+def bench_http(args):
+    from http_downloader import HttpDownloader
+    size = args.size_mb * 1024 * 1024
+    server = MediaServer(size, args.rate_mbps * 1024 * 1024, args.drop_after_mb * 1024 * 1024)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    downloader = HttpDownloader(connections=args.connections)
+    strategies = {
+        "single GET, 8 KB chunks": lambda url, path: legacy_http_download(url, path),
+        f"pooled, {args.connections} segments": downloader.download,
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        for name, download in strategies.items():
+            server.connections, server.dropped = 0, set()
+            started, failures = time.perf_counter(), 0
+            for i in range(args.files):
+                path = os.path.join(directory, f"{name[:6].strip()}_{i}.bin")
+                try:
+                    download(f"{base_url}/{name[:6].strip()}/{i}", path)
+                    if os.path.getsize(path) != size: failures += 1
+                except Exception:
+                    failures += 1
+                for leftover in (path, path + ".part", path + ".part.json"):
+                    if os.path.exists(leftover): os.remove(leftover)
+            elapsed = time.perf_counter() - started
+            print(f"{name:<28} | {args.files} x {args.size_mb} MB | {elapsed:>7.2f} s | {args.files * args.size_mb / elapsed:>7.1f} MB/s | "
+                  f"{server.connections} connection(s) | {failures} failed")
+    print(downloader.summary())
+    server.shutdown()
+
+def check_http(args):
+    # دانلود چندبخشی وسط کار قطع می‌شود و یک downloader تازه (مثل worker بعد از restart) آن را از .part.json ادامه می‌دهد
+    from http_downloader import HttpDownloader
+    size = args.size_mb * 1024 * 1024
+    server = MediaServer(size, args.rate_mbps * 1024 * 1024, size // 8)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url, failures = f"http://127.0.0.1:{server.server_address[1]}", []
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "resume.bin")
+        try:
+            HttpDownloader(connections=4, segment_min_bytes=1024 * 1024, retries=0).download(f"{base_url}/resume", path)
+            failures.append("interrupted download did not fail")
+        except Exception:
+            pass
+        state = json.load(open(path + ".part.json")) if os.path.exists(path + ".part.json") else {}
+        done, sent_before = sum(segment[2] for segment in state.get('segments', [])), server.sent
+        if not 0 < done < size or len(state.get('segments', [])) != 4: failures.append(f"expected a 4-segment partial state, got {done}/{size} bytes")
+        server.drop_after = 0
+        resumer = HttpDownloader(connections=4, segment_min_bytes=1024 * 1024, retries=0)
+        resumer.download(f"{base_url}/resume", path)
+        with open(path, 'rb') as f: resumed_ok = f.read() == server.payload
+        refetched = server.sent - sent_before
+        if not resumed_ok: failures.append("resumed file differs from the original")
+        if resumer.stats['resumed'] != 1 or refetched != size - done: failures.append(f"resume fetched {refetched} bytes, expected {size - done}")
+        print(f"{'segmented resume':<28} | cut at {done / 1024 ** 2:.1f}/{args.size_mb} MB | resumed with {refetched / 1024 ** 2:.1f} MB | {'ok' if resumed_ok else 'CORRUPT'}")
+        path = os.path.join(directory, "gzip.bin")
+        try:
+            HttpDownloader(connections=4).download(f"{base_url}/gzip/file", path)
+            with open(path, 'rb') as f: gzip_ok = f.read() == server.payload
+        except Exception as e:
+            gzip_ok = False
+            failures.append(f"gzip-encoded download failed: {e}")
+        if not gzip_ok and os.path.exists(path): failures.append("gzip-encoded download differs from the original")
+        print(f"{'gzip content-encoding':<28} | {args.size_mb} MB decoded | {'ok' if gzip_ok else 'FAILED'}")
+    server.shutdown()
+    for failure in failures: print(f"FAILED: {failure}")
+    if failures: sys.exit(1)
+
+class FakeBotAPI:
+    # یک Bot API محلی؛ فقط متدهایی که ربات لازم دارد پیاده شده و ارسال‌ها با تاخیر ثابت شبیه‌سازی می‌شوند
+    def __init__(self, latency, updates=()):
+        self.latency = latency
+        self.updates, self.sent = list(updates), []
+        self.update_event = asyncio.Event()
+        self.message_ids = itertools.count(1)
+        self.server, self.port, self.webhook_task = None, None, None
+
+    async def start(self, port=0):
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    async def deliver_webhook(self, url, connections=40):
+        # مثل Telegram: حداکثر 40 اتصال و update-های هر چت به ترتیب، همیشه روی یک اتصال
+        host, _, rest = url.split('://', 1)[1].partition('/')
+        lanes = {}
+        for update in self.updates: lanes.setdefault(update['message']['chat']['id'] % connections, []).append(update)
+        self.updates = []
+
+        async def deliver(lane):
+            # PTB قبل از بالا آمدن سرور setWebhook را صدا می‌زند؛ مثل Telegram تا آماده شدن سرور دوباره تلاش می‌کنیم
+            for _ in range(100):
+                try:
+                    reader, writer = await asyncio.open_connection(*host.split(':'))
+                    break
+                except ConnectionError:
+                    await asyncio.sleep(0.05)
+            for update in lane:
+                body = json.dumps(update).encode()
+                writer.write(f"POST /{rest} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+                await writer.drain()
+                headers = {}
+                await reader.readline()
+                while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    key, _, value = line.decode().partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                await reader.readexactly(int(headers.get('content-length', 0)))
+            writer.close()
+        await asyncio.gather(*(deliver(lane) for lane in lanes.values()))
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def push_updates(self, updates):
+        self.updates.extend(updates)
+        self.update_event.set()
+
+    def message(self, chat_id, **extra):
+        chat_id = int(chat_id)
+        return {'message_id': next(self.message_ids), 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup'}, **extra}
+
+    @staticmethod
+    def _params(headers, body):
+        content_type = headers.get('content-type', '')
+        if content_type.startswith('application/json'): return json.loads(body or b'{}')
+        if not content_type.startswith('application/x-www-form-urlencoded'): return {}
+        params = {}
+        for key, value in parse_qsl(body.decode()):
+            try: params[key] = json.loads(value)
+            except ValueError: params[key] = value
+        return params
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line: break
+                headers = {}
+                while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    key, _, value = line.decode().partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                result = await self.dispatch(request_line.decode().split(' ')[1].rsplit('/', 1)[-1], self._params(headers, body))
+                payload = json.dumps({'ok': True, 'result': result}).encode()
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n" % len(payload) + payload)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, method, params):
+        if method == 'getMe': return {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        if method == 'getUpdates':
+            offset, timeout = int(params.get('offset') or 0), float(params.get('timeout') or 0)
+            self.updates = [u for u in self.updates if u['update_id'] >= offset]
+            if not self.updates and timeout:
+                self.update_event.clear()
+                try: await asyncio.wait_for(self.update_event.wait(), timeout)
+                except asyncio.TimeoutError: pass
+            return self.updates[:int(params.get('limit') or 100)]
+        if method == 'setWebhook' and params.get('url') and self.updates:
+            self.webhook_task = asyncio.create_task(self.deliver_webhook(params['url']))
+            return True
+        if method == 'getChatMember': return {'status': 'member', 'user': {'id': int(params.get('user_id', 0)), 'is_bot': False, 'first_name': 'user'}}
+        if method.startswith('send') or method.startswith('copy'):
+            await asyncio.sleep(self.latency)
+            self.sent.append((method, params))
+            return self.message(params.get('chat_id', 0), text=params.get('text') or "")
+        return True
+
+def fake_private_update(update_id, user_id, text):
+    user = {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"}
+    return {'update_id': update_id, 'message': {'message_id': update_id, 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'}, 'from': user, 'text': text}}
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def serve_fake_bot_api(port, latency, updates):
+    async def serve():
+        api = FakeBotAPI(latency, updates)
+        await api.start(port)
+        await asyncio.Event().wait()
+    asyncio.run(serve())
+
+async def run_update_mode(mode, concurrency, args):
+    import multiprocessing
+    from telegram.ext import Application, MessageHandler, filters
+    from main_bot import PerUserUpdateProcessor
+    # Bot API جعلی در یک پروسه جدا اجرا می‌شود تا فقط هزینه خود ربات اندازه‌گیری شود
+    api_port, updates = free_port(), [fake_private_update(i + 1, 1000 + i % args.users, "/start") for i in range(args.updates)]
+    api = multiprocessing.Process(target=serve_fake_bot_api, args=(api_port, args.api_latency_ms / 1000, updates), daemon=True)
+    api.start()
+    await asyncio.sleep(1)
+    builder = Application.builder().token("123456:bench").base_url(f"http://127.0.0.1:{api_port}/bot").connection_pool_size(max(concurrency, 8))
+    if concurrency > 1: builder = builder.concurrent_updates(PerUserUpdateProcessor(concurrency))
+    app = builder.build()
+    handled, finished = {}, asyncio.Event()
+
+    async def handle(update, context):
+        await asyncio.sleep(args.handler_ms / 1000)
+        await context.bot.send_message(update.effective_chat.id, "ok")
+        handled.setdefault(update.effective_user.id, []).append(update.update_id)
+        if sum(map(len, handled.values())) == args.updates: finished.set()
+
+    app.add_handler(MessageHandler(filters.ALL, handle))
+    async with app:
+        await app.start()
+        started = time.perf_counter()
+        if mode == "polling":
+            await app.updater.start_polling(poll_interval=0, timeout=1)
+        else:
+            port = free_port()
+            await app.updater.start_webhook(listen="127.0.0.1", port=port, url_path="hook", webhook_url=f"http://127.0.0.1:{port}/hook")
+        await asyncio.wait_for(finished.wait(), timeout=600)
+        elapsed = time.perf_counter() - started
+        await app.updater.stop()
+        await app.stop()
+    api.terminate()
+    in_order = all(ids == sorted(ids) for ids in handled.values())
+    print(f"{f'{mode}, concurrency={concurrency}':<28} | {args.updates:>7} upd | {elapsed:>8.2f} s | {args.updates / elapsed:>9.1f} upd/s | per-user order {'kept' if in_order else 'BROKEN'}")
+
+async def bench_updates(args):
+    for mode, concurrency in (("polling", 1), ("polling", args.concurrency), ("webhook", args.concurrency)):
+        await run_update_mode(mode, concurrency, args)
+
+class LoadTracker:
+    # وضعیت هر درخواست از دید کاربر: کی لینک فرستاده شد و کی آخرین فایل (یا پیام خطا) به دستش رسید
+    def __init__(self):
+        self.requests, self.finished = {}, asyncio.Event()
+        self.expected_total = 0
+
+    def submit(self, user_id, kind, expected):
+        self.requests[user_id] = {'kind': kind, 'expected': expected, 'received': 0, 'submitted': time.perf_counter(), 'done': None, 'failed': False}
+
+    def _finish(self, request, failed=False):
+        if request['done'] is None:
+            request['done'], request['failed'] = time.perf_counter(), failed
+            if sum(1 for r in self.requests.values() if r['done']) == self.expected_total: self.finished.set()
+
+    def delivered(self, user_id):
+        request = self.requests.get(user_id)
+        if not request: return
+        request['received'] += 1
+        if request['received'] >= request['expected']: self._finish(request)
+
+    def failed(self, user_id):
+        if user_id in self.requests: self._finish(self.requests[user_id], failed=True)
+
+class E2EBotAPI(FakeBotAPI):
+    # پیام‌های worker به شکل update گروه تحویل ربات می‌شوند و کاربران جعلی روی اولین دکمه کیفیت کلیک می‌کنند
+    WORKER_USER = {'id': 777000, 'is_bot': False, 'first_name': 'worker'}
+
+    def __init__(self, latency, tracker):
+        super().__init__(latency)
+        self.tracker = tracker
+        self.update_ids = itertools.count(1)
+        self.group_messages = deque(maxlen=200)
+
+    def push(self, **update):
+        self.push_updates([{'update_id': next(self.update_ids), **update}])
+
+    def group_update(self, **fields):
+        message = self.message(GROUP_ID, message_thread_id=ORDER_TOPIC_ID, is_topic_message=True, **{'from': self.WORKER_USER}, **fields)
+        self.push(message=message)
+        return message
+
+    async def dispatch(self, method, params):
+        result = await super().dispatch(method, params)
+        chat_id = int(params['chat_id']) if str(params.get('chat_id', '')).lstrip('-').isdigit() else 0
+        if method in ('sendVideo', 'sendPhoto', 'sendAudio', 'sendDocument') and chat_id > 0:
+            self.tracker.delivered(chat_id)
+        elif method == 'sendMessage' and chat_id == GROUP_ID:
+            self.group_messages.append((datetime.now(timezone.utc), result))
+        elif method == 'sendMessage' and chat_id > 0:
+            if (params.get('text') or "").strip() == FAILURE_MESSAGE.strip(): self.tracker.failed(chat_id)
+            buttons = [button for row in (params.get('reply_markup') or {}).get('inline_keyboard', []) for button in row if str(button.get('callback_data', '')).startswith('quality:')]
+            if buttons:
+                user = {'id': chat_id, 'is_bot': False, 'first_name': f"user{chat_id}"}
+                self.push(callback_query={'id': str(result['message_id']), 'from': user, 'chat_instance': 'bench', 'data': buttons[0]['callback_data'], 'message': result})
+        return result
+
+class FakeTelethonClient:
+    # جایگزین TelegramClient در worker: آپلود با پهنای باند ثابت شبیه‌سازی می‌شود و فایل به شکل update گروه به Bot API جعلی می‌رسد
+    def __init__(self, api, upload_rate):
+        self.api, self.upload_rate = api, upload_rate
+        self.streamed = {}
+
+    async def start(self, phone=None):
+        return self
+
+    async def get_me(self):
+        return SimpleNamespace(first_name="bench-worker")
+
+    async def __call__(self, request):
+        # قطعه‌های آپلود streaming (SaveFilePartRequest / SaveBigFilePartRequest)
+        await asyncio.sleep(len(request.bytes) / self.upload_rate)
+        self.streamed[request.file_id] = self.streamed.get(request.file_id, 0) + len(request.bytes)
+        return True
+
+    async def send_file(self, entity, file, caption=None, progress_callback=None, **kwargs):
+        if isinstance(file, str):
+            name, size = os.path.basename(file), os.path.getsize(file)
+            await asyncio.sleep(size / self.upload_rate)
+            if progress_callback: progress_callback(size, size)
+        else:
+            name, size = file.name, self.streamed.pop(file.id, 0)
+        file_id = f"bench-{random_code()}{random_code()}"
+        media = {'file_id': file_id, 'file_unique_id': file_id, 'file_size': size}
+        extension = os.path.splitext(name)[1].lower()
+        if extension == '.jpg': fields = {'photo': [{**media, 'width': 320, 'height': 320}]}
+        elif extension in ('.mp4', '.mkv', '.mov', '.webm'): fields = {'video': {**media, 'width': 1280, 'height': 720, 'duration': 60}}
+        else: fields = {'document': media}
+        return SimpleNamespace(id=self.api.group_update(caption=caption, **fields)['message_id'])
+
+    async def send_message(self, entity, message, **kwargs):
+        return SimpleNamespace(id=self.api.group_update(text=message)['message_id'])
+
+    async def iter_messages(self, entity, reply_to=None, limit=10):
+        for date, message in list(reversed(self.api.group_messages))[:limit]:
+            yield SimpleNamespace(id=message['message_id'], text=message.get('text'), date=date)
+
+class FakeMedia:
+    # منبع جعلی همه استخراج‌کننده‌ها: پست‌های Instagram و ویدیوهای yt-dlp از MediaServer های محلی خوانده می‌شوند
+    def __init__(self, video_url, photo_url, carousel, extract_latency):
+        self.video_url, self.photo_url = video_url, photo_url
+        self.carousel, self.extract_latency = carousel, extract_latency
+
+    def post(self, shortcode):
+        time.sleep(self.extract_latency)
+        if shortcode.startswith("broken"): raise Exception(f"Media {shortcode} not found")
+        resources = [{'pk': f"{shortcode}{i}", 'media_type': 2 if i % 2 == 0 else 1, 'video_url': f"{self.video_url}/{shortcode}/{i}.mp4",
+                      'thumbnail_url': f"{self.photo_url}/{shortcode}/{i}.jpg"} for i in range(self.carousel)]
+        return {'caption_text': f"Benchmark post {shortcode}", 'resources': resources}
+
+    def media_urls(self, post):
+        return [res['video_url'] if res['media_type'] == 2 else res['thumbnail_url'] for res in post['resources']]
+
+    def video(self, url):
+        time.sleep(self.extract_latency)
+        if "youtube.com" not in url or "broken" in url: raise Exception(f"ERROR: Unsupported URL: {url}")
+        video_id = parse_qs(urlparse(url).query).get('v', ['bench'])[0]
+        formats = [{'format_id': str(height), 'height': height, 'ext': 'mp4', 'vcodec': 'avc1', 'acodec': 'mp4a', 'filesize': height * 20000} for height in (360, 720)]
+        formats.append({'format_id': '140', 'height': None, 'ext': 'm4a', 'vcodec': 'none', 'acodec': 'mp4a', 'filesize': 1000000})
+        return {'id': video_id, 'title': f"Benchmark video {video_id}", 'description': "", 'duration': 60, 'width': 1280, 'height': 720,
+                'webpage_url': url, 'url': f"{self.video_url}/{video_id}.mp4", 'formats': formats}
+
+class FakeModel(dict):
+    def dict(self):
+        return dict(self)
+    model_dump = dict
+
+class FakeInstagrapi:
+    def __init__(self, media):
+        self.media = media
+
+    def media_pk_from_url(self, url):
+        return url.rstrip('/').split('/')[-1]
+
+    def media_info(self, pk):
+        return FakeModel(self.media.post(pk))
+
+class FakeInstaloader:
+    context = None
+
+    def __init__(self, media):
+        self.media = media
+
+    def download_post(self, post, target):
+        os.makedirs(target, exist_ok=True)
+        for i, url in enumerate(self.media.media_urls(post.info)):
+            legacy_http_download(url, os.path.join(target, f"{i:02d}{os.path.splitext(url)[1]}"))
+
+def fake_extractor_modules(media):
+    # به‌جای yt_dlp و instaloader در advanced_worker قرار می‌گیرند
+    class YoutubeDL:
+        def __init__(self, params=None):
+            self.params = params or {}
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            return False
+
+        def sanitize_info(self, info):
+            return info
+
+        def extract_info(self, url, download=True):
+            info = media.video(url)
+            return self.process_ie_result(info, download) if download else info
+
+        def process_ie_result(self, info, download=True):
+            if download:
+                legacy_http_download(info['url'], self.params['outtmpl'] % {'ext': 'mp4'})
+                for hook in self.params.get('progress_hooks', []): hook({'status': 'finished'})
+            return info
+
+    class Post:
+        def __init__(self, shortcode):
+            self.info = media.post(shortcode)
+            self.caption = self.info['caption_text']
+
+        @classmethod
+        def from_shortcode(cls, context, shortcode):
+            return cls(shortcode)
+
+    return SimpleNamespace(YoutubeDL=YoutubeDL), SimpleNamespace(Post=Post)
+
+def fake_provider_get(media):
+    # MajidAPI و NestCode به‌جای اینترنت از FakeMedia جواب می‌گیرند
+    def get(url, timeout=30, **kwargs):
+        target = parse_qs(urlparse(url).query)['url'][0]
+        try: post, error = media.post(target.rstrip('/').split('/')[-1]), None
+        except Exception as e: post, error = None, str(e)
+        if "majidapi" in url: data = {'status': 404, 'result': error} if error else {'status': 200, 'result': {'caption': post['caption_text'], 'carousel': media.media_urls(post)}}
+        else: data = {'status': 'error', 'data': error} if error else {'status': 'success', 'data': {'caption': post['caption_text'], 'medias': media.media_urls(post)}}
+        return SimpleNamespace(json=lambda: data)
+    return get
+
+def fake_instagram_pool(media):
+    from instagram_pool import InstagramPool
+
+    class FakeInstagramPool(InstagramPool):
+        # منطق واقعی pool (نوبت‌دهی، cooldown) حفظ می‌شود؛ فقط login با کلاینت جعلی جایگزین شده
+        def _login(self, backend, account):
+            client = FakeInstagrapi(media) if backend == "instagrapi" else FakeInstaloader(media)
+            account.clients[backend] = client
+            return client
+    return FakeInstagramPool
+
+def traffic_plan(args):
+    weights = {kind: float(weight) for kind, weight in (item.split('=') for item in args.mix.split(','))}
+    rng, history, plan = random.Random(args.seed), [], []
+    for i in range(args.requests):
+        kind = rng.choices(list(weights), list(weights.values()))[0]
+        if kind == "repeat" and history:
+            url, expected = rng.choice(history)
+        elif kind == "youtube":
+            url, expected = f"https://www.youtube.com/watch?v=bench{i}", 1
+        elif kind == "broken":
+            url, expected = f"https://www.instagram.com/p/broken{i}/", 0
+        else:
+            kind, url, expected = "instagram" if kind == "repeat" else kind, f"https://www.instagram.com/p/bench{i}/", args.carousel
+        if kind in ("instagram", "youtube"): history.append((url, expected))
+        plan.append((kind, url, expected, rng.expovariate(args.rate)))
+    return plan
+
+def percentiles(values, points=(50, 95, 99)):
+    ordered = sorted(values)
+    return [ordered[min(len(ordered) - 1, int(len(ordered) * point / 100))] if ordered else 0 for point in points]
+
+def print_percentiles(name, values, unit="s"):
+    p50, p95, p99 = percentiles(values)
+    print(f"{name:<22} | {len(values):>6} | p50 {p50:>7.2f}{unit} | p95 {p95:>7.2f}{unit} | p99 {p99:>7.2f}{unit}")
+
+def throwaway_database(name, drop=False):
+    conn = psycopg2.connect(dbname="postgres", user=DB_USER, password=DB_PASS, host=DB_HOST, port=DB_PORT)
+    conn.autocommit = True
+    with conn.cursor() as cur: cur.execute(f'DROP DATABASE IF EXISTS "{name}" WITH (FORCE);' if drop else f'CREATE DATABASE "{name}";')
+    conn.close()
+
+async def run_e2e(args, database_name):
+    import database
+    import main_bot
+    import advanced_worker
+    from telegram import Update
+    database.DB_NAME = database_name
+    for name in ("main_bot", "advanced_worker", "__main__", "httpx", "telegram"): logging.getLogger(name).setLevel(logging.WARNING if args.verbose else logging.CRITICAL)
+    tracker = LoadTracker()
+    api = E2EBotAPI(args.api_latency_ms / 1000, tracker)
+    await api.start()
+    servers = [MediaServer(args.video_mb * 1024 * 1024, args.download_mbps * 1024 * 1024, 0), MediaServer(args.photo_kb * 1024, args.download_mbps * 1024 * 1024, 0)]
+    for server in servers: threading.Thread(target=server.serve_forever, daemon=True).start()
+    media = FakeMedia(*(f"http://127.0.0.1:{server.server_address[1]}" for server in servers), args.carousel, args.extract_ms / 1000)
+
+    # --- ربات اصلی و worker واقعی، فقط مرزهای بیرونی (Telegram، Instagram، yt-dlp، API ها) جعلی هستند ---
+    main_bot.BOT_API_BASE_URL, main_bot.MAIN_BOT_METRICS_PORT, advanced_worker.WORKER_METRICS_PORT = f"http://127.0.0.1:{api.port}", 0, 0
+    main_bot.InstagramPool = advanced_worker.InstagramPool = fake_instagram_pool(media)
+    advanced_worker.yt_dlp, advanced_worker.instaloader = fake_extractor_modules(media)
+    advanced_worker.TelegramClient = lambda *_, **__: FakeTelethonClient(api, args.upload_mbps * 1024 * 1024)
+    bot = main_bot.AdvancedBot(token="123456:bench", group_id=GROUP_ID, order_topic_id=ORDER_TOPIC_ID, log_topic_id=ORDER_TOPIC_ID, admin_ids=ADMIN_IDS)
+    bot.register_handlers()
+    worker = advanced_worker.TelethonWorker(0, "bench", "")
+    worker.uploader = None  # ارسال موازی روی MTProtoSender واقعی کار می‌کند و اینجا شبیه‌سازی نمی‌شود
+    worker.http.get = fake_provider_get(media)
+    worker.display_dashboard = lambda: asyncio.Event().wait()
+    download_dir = tempfile.mkdtemp(prefix="bench_downloads_")
+    worker.base_download_dir = download_dir
+
+    plan = traffic_plan(args)
+    tracker.expected_total = len(plan)
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    async with bot.app:
+        await bot.on_startup(bot.app)
+        await bot.app.start()
+        await bot.app.updater.start_polling(poll_interval=0, timeout=1, allowed_updates=Update.ALL_TYPES)
+        worker_task = asyncio.create_task(worker.run())
+        await asyncio.sleep(1)
+        started = time.perf_counter()
+        for i, (kind, url, expected, delay) in enumerate(plan):
+            user_id = 100000 + i
+            tracker.submit(user_id, kind, expected)
+            api.push(message={**fake_private_update(0, user_id, url)['message'], 'message_id': next(api.message_ids)})
+            await asyncio.sleep(delay)
+        try: await asyncio.wait_for(tracker.finished.wait(), timeout=args.timeout)
+        except asyncio.TimeoutError: pass
+        elapsed = time.perf_counter() - started
+        worker_task.cancel()
+        await bot.app.updater.stop()
+        await bot.app.stop()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    timings = await bot.db._query(lambda cur: (cur.execute("SELECT timings, EXTRACT(EPOCH FROM claimed_at - created_at) FROM jobs WHERE timings IS NOT NULL;"), cur.fetchall())[1])
+    transactions = await bot.db._query(lambda cur: (cur.execute("SELECT xact_commit FROM pg_stat_database WHERE datname = current_database();"), cur.fetchone()[0])[1])
+    bot.db.close()
+    worker.db.close()
+    await api.stop()
+    for server in servers: server.shutdown()
+    shutil.rmtree(download_dir, ignore_errors=True)
+
+    # --- گزارش ---
+    requests = list(tracker.requests.values())
+    finished = [r for r in requests if r['done']]
+    unexpected = sum(1 for r in finished if r['failed'] != (r['kind'] == "broken"))
+    print(f"{len(requests)} request(s) in {elapsed:.1f} s | finished {len(finished)} | unfinished {len(requests) - len(finished)} | unexpected outcome {unexpected}")
+    print(f"throughput: {len(finished) / elapsed:.2f} jobs/s | {sum(r['received'] for r in finished) / elapsed:.2f} files/s delivered")
+    print(f"{'latency (user view)':<22} | {'count':>6} |")
+    print_percentiles("all", [r['done'] - r['submitted'] for r in finished])
+    for kind in sorted({r['kind'] for r in finished}):
+        print_percentiles(f"  {kind}", [r['done'] - r['submitted'] for r in finished if r['kind'] == kind])
+    stages = {}
+    for row, pending in timings:
+        # pending: از ثبت job در دیتابیس تا claim شدن توسط worker (queue_wait فقط صف داخلی worker است)
+        if pending is not None: stages.setdefault("pending", []).append(float(pending))
+        for stage, seconds in (row or {}).items(): stages.setdefault(stage, []).append(float(seconds))
+    print(f"{'stage (jobs.timings)':<22} | {'count':>6} |")
+    for stage in ("submit", "pending", "queue_wait", "extract", "download", "probe", "upload", "processing", "delivery"):
+        if stage in stages: print_percentiles(f"  {stage}", stages.pop(stage))
+    for stage, values in sorted(stages.items()): print_percentiles(f"  {stage}", values)
+    cpu = usage.ru_utime + usage.ru_stime - usage_before.ru_utime - usage_before.ru_stime
+    print(f"resources: CPU {cpu:.1f} s ({cpu * 100 / elapsed:.0f}% of one core, {cpu * 1000 / max(len(finished), 1):.0f} ms/job) | "
+          f"peak RSS {usage.ru_maxrss / 1024:.0f} MB | threads {threading.active_count()} | DB transactions {transactions}")
+    print(worker.http.summary())
+    print(worker.router.summary())
+    outbox = bot.outbox.summary()
+    print(f"Outbox: sent {outbox['sent']} | failed {outbox['failed']} | retry_after {outbox['retry_after']} | max depth {outbox['max_depth']} | "
+          f"queue wait p50 {outbox['p50']:.2f}s, p95 {outbox['p95']:.2f}s")
+
+def bench_e2e(args):
+    # یک دیتابیس یک‌بار مصرف روی همان سرور PostgreSQL تنظیمات ساخته و در پایان حذف می‌شود
+    database_name = args.database or f"downloader_bench_{os.getpid()}"
+    if not args.database: throwaway_database(database_name)
+    try:
+        asyncio.run(run_e2e(args, database_name))
+    finally:
+        if not args.database: throwaway_database(database_name, drop=True)
+
+HEAVY_MODULES = ("yt_dlp", "instagrapi", "instaloader")
+
+def import_profile(statement):
+    # هر اندازه‌گیری در یک پروسه تازه انجام می‌شود تا cache ماژول‌های قبلی اثر نگذارد
+    code = f"import sys, time; started = time.perf_counter(); {statement}; print(time.perf_counter() - started); print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True)
+    if result.returncode: raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    elapsed, loaded = (result.stdout.splitlines() + [""])[-3:-1] if result.stdout.endswith("\n\n") else result.stdout.splitlines()[-2:]
+    # -X importtime هر ماژول را بعد از زیرماژول‌هایش چاپ می‌کند؛ تورفتگی نام عمق import را نشان می‌دهد
+    children, pending = {}, []
+    for line in result.stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) != 3 or not parts[1].strip().isdigit(): continue
+        depth, name = (len(parts[2]) - len(parts[2].lstrip()) - 1) // 2, parts[2].strip()
+        if depth == 1: pending.append((int(parts[1]) / 1e6, name))
+        elif depth == 0: children[name], pending = pending, []
+    return float(elapsed), [m for m in loaded.split(',') if m], children
+
+async def first_start_reply(args, database_name):
+    import database
+    import main_bot
+    database.DB_NAME = database_name
+    for name in ("main_bot", "__main__", "httpx", "telegram"): logging.getLogger(name).setLevel(logging.CRITICAL)
+    api = E2EBotAPI(args.api_latency_ms / 1000, LoadTracker())
+    await api.start()
+    login_finished = {}
+
+    class SlowLoginPool(fake_instagram_pool(None)):
+        # login واقعی instagrapi چند ثانیه طول می‌کشد و قبلاً شروع به کار ربات را نگه می‌داشت
+        def _login(self, backend, account):
+            time.sleep(args.login_ms / 1000)
+            login_finished[backend] = time.perf_counter()
+            return super()._login(backend, account)
+
+    main_bot.BOT_API_BASE_URL, main_bot.MAIN_BOT_METRICS_PORT, main_bot.InstagramPool = f"http://127.0.0.1:{api.port}", 0, SlowLoginPool
+    started = time.perf_counter()
+    bot = main_bot.AdvancedBot(token="123456:bench", group_id=GROUP_ID, order_topic_id=ORDER_TOPIC_ID, log_topic_id=ORDER_TOPIC_ID, admin_ids=ADMIN_IDS)
+    bot.register_handlers()
+    constructed = time.perf_counter()
+    async with bot.app:
+        await bot.on_startup(bot.app)
+        await bot.app.start()
+        await bot.app.updater.start_polling(poll_interval=0, timeout=1)
+        api.push(message={**fake_private_update(0, 4242, "/start")['message'], 'message_id': next(api.message_ids),
+                          'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]})
+        while not any(method == 'sendMessage' and str(params.get('chat_id')) == "4242" for method, params in api.sent): await asyncio.sleep(0.005)
+        answered = time.perf_counter()
+        await bot.app.updater.stop()
+        await bot.app.stop()
+    bot.db.close()
+    await api.stop()
+    print(f"{'AdvancedBot()':<28} | {constructed - started:>6.2f} s | {bot.startup.report()}")
+    print(f"{'first /start answered':<28} | {answered - started:>6.2f} s after construction")
+    warm_up = f"{login_finished['instagrapi'] - started:>6.2f} s after construction" if login_finished else "still logging in when /start was answered"
+    print(f"{'instagram warm-up':<28} | {warm_up} (background thread, {args.login_ms:.0f} ms simulated login)")
+
+def bench_startup(args):
+    for script in ("main_bot", "advanced_worker"):
+        elapsed, loaded, children = import_profile(f"import {script}")
+        print(f"import {script:<21} | {elapsed:>6.2f} s | heavy modules loaded: {', '.join(loaded) or 'none'}")
+        for seconds, name in sorted(children.get(script, []), reverse=True)[:args.top]:
+            print(f"{'':<28} | {seconds:>6.2f} s | {name}")
+    for module in HEAVY_MODULES:
+        try: elapsed, _, _ = import_profile(f"import {module}")
+        except RuntimeError as e:
+            print(f"deferred {module:<19} | not installed ({e})")
+            continue
+        print(f"deferred {module:<19} | {elapsed:>6.2f} s | imported on first use / in the background")
+    database_name = args.database or f"downloader_bench_{os.getpid()}"
+    if not args.database: throwaway_database(database_name)
+    try:
+        asyncio.run(first_start_reply(args, database_name))
+    finally:
+        if not args.database: throwaway_database(database_name, drop=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the downloader bot")
+    sub = parser.add_subparsers(dest="command", required=True)
+    db_parser = sub.add_parser("db", help="Compare connect-per-call and pooled database layers")
+    db_parser.add_argument("--requests", type=int, default=2000)
+    db_parser.add_argument("--concurrency", type=int, default=20)
+    protocol_parser = sub.add_parser("protocol", help="Compare parse cost and corruption handling of the job message formats")
+    protocol_parser.add_argument("--messages", type=int, default=100000)
+    http_parser = sub.add_parser("http", help="Compare the single-stream and segmented HTTP downloaders against a local throttled server")
+    http_parser.add_argument("--files", type=int, default=4)
+    http_parser.add_argument("--size-mb", type=int, default=64)
+    http_parser.add_argument("--rate-mbps", type=float, default=40, help="Per-connection bandwidth cap of the local server (MB/s)")
+    http_parser.add_argument("--connections", type=int, default=4)
+    http_parser.add_argument("--drop-after-mb", type=int, default=0, help="Drop the first connection of every file after this many MB")
+    check_parser = sub.add_parser("http-check", help="Check that an interrupted segmented download resumes and that gzip-encoded responses download intact")
+    check_parser.add_argument("--size-mb", type=int, default=16)
+    check_parser.add_argument("--rate-mbps", type=float, default=40)
+    updates_parser = sub.add_parser("updates", help="Compare update throughput of sequential polling, concurrent polling and webhook mode against a fake Bot API")
+    updates_parser.add_argument("--updates", type=int, default=2000)
+    updates_parser.add_argument("--users", type=int, default=200)
+    updates_parser.add_argument("--concurrency", type=int, default=64)
+    updates_parser.add_argument("--handler-ms", type=float, default=20, help="Simulated work per update (database, Instagram lookups, ...)")
+    updates_parser.add_argument("--api-latency-ms", type=float, default=30, help="Simulated Bot API round trip per sent message")
+    e2e_parser = sub.add_parser("e2e", help="Run the real main bot and worker end to end against fake Telegram, extractors and media servers")
+    e2e_parser.add_argument("--requests", type=int, default=200)
+    e2e_parser.add_argument("--rate", type=float, default=5, help="Average incoming links per second (Poisson arrivals)")
+    e2e_parser.add_argument("--mix", default="instagram=50,youtube=30,repeat=15,broken=5", help="Traffic mix weights: instagram, youtube, repeat (an earlier link), broken (every provider fails)")
+    e2e_parser.add_argument("--carousel", type=int, default=3, help="Items per Instagram post (videos and photos alternate)")
+    e2e_parser.add_argument("--video-mb", type=int, default=8)
+    e2e_parser.add_argument("--photo-kb", type=int, default=300)
+    e2e_parser.add_argument("--download-mbps", type=float, default=20, help="Per-connection bandwidth of the fake media servers (MB/s)")
+    e2e_parser.add_argument("--upload-mbps", type=float, default=10, help="Simulated Telegram upload bandwidth of the worker (MB/s)")
+    e2e_parser.add_argument("--extract-ms", type=float, default=300, help="Simulated metadata lookup time of every extractor")
+    e2e_parser.add_argument("--api-latency-ms", type=float, default=30)
+    e2e_parser.add_argument("--timeout", type=float, default=600)
+    e2e_parser.add_argument("--seed", type=int, default=1)
+    e2e_parser.add_argument("--database", default="", help="Use this existing scratch database instead of creating and dropping a throwaway one")
+    e2e_parser.add_argument("--verbose", action="store_true", help="Show warnings logged by the bot and the worker")
+    startup_parser = sub.add_parser("startup", help="Profile import time of both processes and time until the main bot answers /start")
+    startup_parser.add_argument("--top", type=int, default=8, help="Slowest top-level imports to list per process")
+    startup_parser.add_argument("--login-ms", type=float, default=3000, help="Simulated Instagram login time during warm-up")
+    startup_parser.add_argument("--api-latency-ms", type=float, default=30)
+    startup_parser.add_argument("--database", default="", help="Use this existing scratch database instead of creating and dropping a throwaway one")
+    args = parser.parse_args()
+    if args.command == "db":
+        asyncio.run(bench_db(args))
+    elif args.command == "protocol":
+        bench_protocol(args)
+    elif args.command == "http":
+        bench_http(args)
+    elif args.command == "http-check":
+        check_http(args)
+    elif args.command == "updates":
+        asyncio.run(bench_updates(args))
+    elif args.command == "e2e":
+        bench_e2e(args)
+    elif args.command == "startup":
+        bench_startup(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,559 @@
+import io
+import json
+import time
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import ThreadedConnectionPool
+
+from config import (DB_NAME, DB_USER, DB_PASS, DB_HOST, DB_PORT,
+                    DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_HEALTHCHECK_SECONDS)
+
+# --- لاگ‌ها در لاگر اسکریپت در حال اجرا (main_bot یا worker) ثبت می‌شوند ---
+logger = logging.getLogger("__main__")
+
+class PooledConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.last_used = time.monotonic()
+
+def job_platform(url):
+    # هر platform در worker سهمیه جدا دارد؛ هنگام ثبت job ذخیره می‌شود تا worker فقط برای platform های خالی claim کند
+    url_lower = url.lower()
+    if "instagram.com" in url_lower: return "instagram"
+    if "youtube.com" in url_lower or "youtu.be" in url_lower: return "youtube"
+    return "generic"
+
+BACKUP_TABLES = {
+    'users': ('user_id', "join_date >= %(since)s AND join_date <= %(until)s"),
+    'jobs': ('code', "(created_at >= %(since)s AND created_at <= %(until)s) OR (completed_at >= %(since)s AND completed_at <= %(until)s)"),
+}
+
+# --- فقط job هایی که worker واقعاً دانلود کرده شمرده می‌شوند؛ follower ها و تحویل از cache نه ---
+# ردیف‌های قدیمی (قبل از worker_id و cache_key) همه دانلود واقعی بوده‌اند
+COUNTER_FUNCTIONS = '''
+CREATE OR REPLACE FUNCTION bot_counters_is_download(status TEXT, leader_code TEXT, worker_id TEXT, cache_key TEXT) RETURNS BOOLEAN AS $$
+    SELECT status = 'completed' AND leader_code IS NULL AND (worker_id IS NOT NULL OR cache_key IS NULL)
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION bot_counters_users() RETURNS trigger AS $$
+BEGIN
+    UPDATE bot_counters SET value = value + (CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END) WHERE name = 'total_users';
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION bot_counters_jobs() RETURNS trigger AS $$
+DECLARE
+    delta_count BIGINT := 0;
+    delta_bytes BIGINT := 0;
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        IF bot_counters_is_download(OLD.status, OLD.leader_code, OLD.worker_id, OLD.cache_key) THEN delta_count := -1; delta_bytes := -COALESCE(OLD.file_size, 0); END IF;
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        IF bot_counters_is_download(NEW.status, NEW.leader_code, NEW.worker_id, NEW.cache_key) THEN delta_count := delta_count + 1; delta_bytes := delta_bytes + COALESCE(NEW.file_size, 0); END IF;
+    END IF;
+    IF delta_count <> 0 THEN UPDATE bot_counters SET value = value + delta_count WHERE name = 'total_downloads'; END IF;
+    IF delta_bytes <> 0 THEN UPDATE bot_counters SET value = value + delta_bytes WHERE name = 'total_bytes'; END IF;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+'''
+
+# jobs_counters_trigger نسخه قبلی است که follower ها و cache را هم می‌شمرد
+COUNTER_TRIGGERS = '''
+DROP TRIGGER IF EXISTS users_counters_trigger ON users;
+CREATE TRIGGER users_counters_trigger AFTER INSERT OR DELETE ON users FOR EACH ROW EXECUTE FUNCTION bot_counters_users();
+DROP TRIGGER IF EXISTS jobs_counters_trigger ON jobs;
+CREATE TRIGGER jobs_download_counters_trigger AFTER INSERT OR UPDATE OF status, file_size, leader_code, worker_id OR DELETE ON jobs
+    FOR EACH ROW EXECUTE FUNCTION bot_counters_jobs();
+'''
+
+# --- هر rollup از ردیف‌های jobs ساخته می‌شود؛ '*' یعنی جمع همه پلتفرم‌ها/روش‌ها ---
+# مثل شمارنده‌ها فقط دانلود واقعی در downloads/bytes/latency می‌آید؛ تحویل از cache و follower ها در deliveries
+ROLLUP_QUERY = '''
+INSERT INTO {table} (bucket, platform, method, downloads, failures, bytes, latency_p50, latency_p95, deliveries)
+SELECT bucket, COALESCE(platform, '*'), COALESCE(method, '*'),
+       COUNT(*) FILTER (WHERE is_download), COUNT(*) FILTER (WHERE status = 'failed'),
+       COALESCE(SUM(file_size) FILTER (WHERE is_download), 0),
+       percentile_cont(0.5) WITHIN GROUP (ORDER BY latency) FILTER (WHERE is_download),
+       percentile_cont(0.95) WITHIN GROUP (ORDER BY latency) FILTER (WHERE is_download),
+       COUNT(*) FILTER (WHERE status = 'completed' AND NOT is_download)
+FROM (SELECT date_trunc('{unit}', completed_at) AS bucket, status, file_size, COALESCE(method, '-') AS method,
+             bot_counters_is_download(status, leader_code, worker_id, cache_key) AS is_download,
+             COALESCE(lower(substring(url from '^[A-Za-z]+://(?:www\\.|m\\.)?([^/:?#]+)')), 'other') AS platform,
+             EXTRACT(EPOCH FROM completed_at - created_at) AS latency
+      FROM jobs WHERE completed_at >= %(since)s AND status IN ('completed', 'failed')) j
+GROUP BY GROUPING SETS ((bucket, platform, method), (bucket, platform), (bucket, method), (bucket))
+ON CONFLICT (bucket, platform, method) DO UPDATE SET downloads = EXCLUDED.downloads, failures = EXCLUDED.failures, bytes = EXCLUDED.bytes,
+    latency_p50 = EXCLUDED.latency_p50, latency_p95 = EXCLUDED.latency_p95, deliveries = EXCLUDED.deliveries;
+'''
+
+class PostgresDB:
+    STATEMENTS = {
+        'add_user': "INSERT INTO users (user_id, first_name, username) VALUES ($1, $2, $3) ON CONFLICT (user_id) DO NOTHING",
+        'add_job': ("INSERT INTO jobs (code, user_id, url, priority, cache_key, leader_code, status, kind, format_option, platform) "
+                    "VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)"),
+        'find_inflight_leader': ("SELECT code, created_at FROM jobs WHERE cache_key = $1 AND status IN ('pending', 'processing') "
+                                 "AND leader_code IS NULL AND created_at > NOW() - make_interval(mins => 30) ORDER BY id LIMIT 1"),
+        'coalesce_pending': "UPDATE jobs SET status = 'coalesced', leader_code = $1 WHERE cache_key = $2 AND status = 'pending' AND code <> $1",
+        'get_followers': "SELECT code, user_id FROM jobs WHERE leader_code = $1",
+        'complete_followers': "UPDATE jobs SET status = $1, completed_at = NOW(), file_size = $2 WHERE leader_code = $3",
+        'add_cached_job': ("INSERT INTO jobs (code, user_id, url, cache_key, status, completed_at, file_size) "
+                           "VALUES ($1, $2, $3, $4, $5, NOW(), $6)"),
+        'notify_job': "SELECT pg_notify('new_job', $1)",
+        'get_job': "SELECT user_id, url, cache_key, title, description FROM jobs WHERE code = $1",
+        'add_job_timings': ("UPDATE jobs SET timings = COALESCE(timings, '{}'::jsonb) || (SELECT jsonb_object_agg(key, COALESCE((timings->>key)::float8, 0) + value::float8) "
+                            "FROM jsonb_each_text($1::jsonb)) WHERE code = $2"),
+        'set_job_metadata': "UPDATE jobs SET title = $1, description = $2, method = $3 WHERE code = $4",
+        'get_cached_media': ("SELECT item_index, total, media_type, file_id, caption, extra_texts, file_size FROM media_cache "
+                             "WHERE cache_key = $1 AND created_at > NOW() - make_interval(hours => $2) ORDER BY item_index"),
+        'touch_cached_media': "UPDATE media_cache SET hits = hits + 1, last_hit_at = NOW() WHERE cache_key = $1",
+        'cache_media_item': ("INSERT INTO media_cache (cache_key, item_index, total, media_type, file_id, caption, extra_texts, file_size) "
+                             "VALUES ($1, $2, $3, $4, $5, $6, $7, $8) ON CONFLICT (cache_key, item_index) DO UPDATE SET "
+                             "total = EXCLUDED.total, media_type = EXCLUDED.media_type, file_id = EXCLUDED.file_id, caption = EXCLUDED.caption, "
+                             "extra_texts = EXCLUDED.extra_texts, file_size = EXCLUDED.file_size, created_at = NOW(), last_hit_at = NOW()"),
+        'get_cached_profile': ("SELECT username, full_name, biography, media_count, follower_count, following_count, profile_pic_url, profile_pic_file_id "
+                               "FROM profile_cache WHERE username = $1 AND fetched_at > NOW() - make_interval(secs => $2)"),
+        'save_profile': ("INSERT INTO profile_cache (username, full_name, biography, media_count, follower_count, following_count, profile_pic_url) "
+                         "VALUES ($1, $2, $3, $4, $5, $6, $7) ON CONFLICT (username) DO UPDATE SET full_name = EXCLUDED.full_name, "
+                         "biography = EXCLUDED.biography, media_count = EXCLUDED.media_count, follower_count = EXCLUDED.follower_count, "
+                         "following_count = EXCLUDED.following_count, profile_pic_url = EXCLUDED.profile_pic_url, profile_pic_file_id = NULL, fetched_at = NOW()"),
+        'get_format_manifest': "SELECT options, CASE WHEN $3 THEN info END FROM format_manifests WHERE cache_key = $1 AND extracted_at > NOW() - make_interval(mins => $2)",
+        'save_format_manifest': ("INSERT INTO format_manifests (cache_key, url, title, options, info) VALUES ($1, $2, $3, $4, $5) "
+                                 "ON CONFLICT (cache_key) DO UPDATE SET url = EXCLUDED.url, title = EXCLUDED.title, options = EXCLUDED.options, "
+                                 "info = EXCLUDED.info, extracted_at = NOW()"),
+        'set_profile_pic_file_id': "UPDATE profile_cache SET profile_pic_file_id = $1 WHERE username = $2",
+        'complete_job': "UPDATE jobs SET status = $1, completed_at = NOW(), file_size = $2 WHERE code = $3",
+        'claim_next_job': ("UPDATE jobs SET status = 'processing', worker_id = $1, claimed_at = NOW(), "
+                           "lease_expires_at = NOW() + make_interval(secs => $2), attempts = attempts + 1 "
+                           "WHERE id = (SELECT id FROM jobs WHERE (status = 'pending' OR (status = 'processing' AND lease_expires_at < NOW())) "
+                           "AND attempts < $3 AND (platform = ANY($4) OR platform IS NULL) ORDER BY priority, id FOR UPDATE SKIP LOCKED LIMIT 1) "
+                           "RETURNING code, url, user_id, attempts, cache_key, kind, format_option"),
+        'claim_job_by_code': ("UPDATE jobs SET status = 'processing', worker_id = $1, claimed_at = NOW(), "
+                              "lease_expires_at = NOW() + make_interval(secs => $2), attempts = attempts + 1 "
+                              "WHERE code = $3 AND status = 'pending' RETURNING code, url, user_id, attempts, cache_key, kind, format_option"),
+        'finish_job': "UPDATE jobs SET status = 'uploaded', lease_expires_at = NULL WHERE code = $1 AND status = 'processing'",
+        'fail_job': "UPDATE jobs SET status = 'failed', completed_at = NOW(), error = $1, lease_expires_at = NULL WHERE code = $2",
+        'renew_leases': "UPDATE jobs SET lease_expires_at = NOW() + make_interval(secs => $2) WHERE worker_id = $1 AND status = 'processing'",
+        'worker_heartbeat': ("INSERT INTO workers (worker_id, hostname, active_jobs, last_heartbeat) VALUES ($1, $2, $3, NOW()) "
+                             "ON CONFLICT (worker_id) DO UPDATE SET active_jobs = EXCLUDED.active_jobs, last_heartbeat = NOW()"),
+    }
+
+    def __init__(self):
+        self.conn_params = {"dbname": DB_NAME, "user": DB_USER, "password": DB_PASS, "host": DB_HOST, "port": DB_PORT}
+        self.pool = ThreadedConnectionPool(DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, connection_factory=PooledConnection, **self.conn_params)
+        self.slots = threading.BoundedSemaphore(DB_POOL_MAX_SIZE)
+        self.init_database()
+
+    def _checkout(self):
+        conn = self.pool.getconn()
+        if conn.closed or time.monotonic() - conn.last_used > DB_HEALTHCHECK_SECONDS:
+            try:
+                with conn.cursor() as cur: cur.execute("SELECT 1;")
+                conn.rollback()
+            except psycopg2.Error as e:
+                logger.warning(f"⚠️ Dropping stale database connection. Error: {e}")
+                self.pool.putconn(conn, close=True)
+                conn = self.pool.getconn()
+        return conn
+
+    @contextmanager
+    def get_conn(self):
+        self.slots.acquire()
+        conn, broken = None, False
+        try:
+            conn = self._checkout()
+            yield conn
+            conn.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        except Exception:
+            if conn and not conn.closed: conn.rollback()
+            raise
+        finally:
+            if conn:
+                conn.last_used = time.monotonic()
+                self.pool.putconn(conn, close=broken or bool(conn.closed))
+            self.slots.release()
+
+    def _run(self, fn, read_only):
+        # بعد از اجرای یک INSERT/UPDATE معلوم نیست COMMIT قبل از قطع اتصال انجام شده یا نه؛ فقط خواندن‌ها و خطای گرفتن اتصال تکرار می‌شوند
+        for attempt in range(2):
+            started = False
+            try:
+                with self.get_conn() as conn:
+                    with conn.cursor() as cur:
+                        started = True
+                        return fn(cur)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                if attempt or (started and not read_only): raise
+                logger.warning(f"⚠️ Database connection lost, reconnecting... Error: {e}")
+
+    async def _query(self, fn, read_only=False):
+        return await asyncio.to_thread(self._run, fn, read_only)
+
+    def _execute(self, cur, name, params=()):
+        if name not in cur.connection.prepared:
+            cur.execute(f"PREPARE {name} AS {self.STATEMENTS[name]};")
+            cur.connection.prepared.add(name)
+        placeholders = f" ({', '.join(['%s'] * len(params))})" if params else ""
+        cur.execute(f"EXECUTE {name}{placeholders};", params)
+
+    def init_database(self):
+        with self.get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_xact_lock(7240016);")
+                cur.execute('CREATE TABLE IF NOT EXISTS users (user_id BIGINT PRIMARY KEY, first_name TEXT, username TEXT, join_date TIMESTAMP WITH TIME ZONE DEFAULT NOW());')
+                cur.execute('CREATE TABLE IF NOT EXISTS jobs (id SERIAL PRIMARY KEY, code TEXT UNIQUE NOT NULL, user_id BIGINT REFERENCES users(user_id), url TEXT NOT NULL, status TEXT DEFAULT \'pending\', created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(), completed_at TIMESTAMP WITH TIME ZONE, file_size BIGINT);')
+                cur.execute("SELECT 1 FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = 'jobs' AND column_name = 'worker_id';")
+                legacy_jobs = not cur.fetchone()
+                cur.execute('ALTER TABLE jobs ADD COLUMN IF NOT EXISTS worker_id TEXT, ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP WITH TIME ZONE, ADD COLUMN IF NOT EXISTS error TEXT, ADD COLUMN IF NOT EXISTS priority SMALLINT NOT NULL DEFAULT 1, ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP WITH TIME ZONE, ADD COLUMN IF NOT EXISTS attempts SMALLINT NOT NULL DEFAULT 0;')
+                if legacy_jobs:
+                    # migration یک‌باره: نسخه قبلی job های ناموفق یا رها شده را pending می‌گذاشت؛ بدون این، صف جدید لینک‌های ماه‌ها قبل را دوباره دانلود می‌کند
+                    cur.execute("UPDATE jobs SET status = 'failed', error = 'Expired when the job queue was introduced' WHERE status = 'pending';")
+                    if cur.rowcount: logger.info(f"Expired {cur.rowcount} pending job(s) left over from the previous job handling.")
+                cur.execute("DROP INDEX IF EXISTS jobs_pending_idx;")
+                cur.execute("CREATE INDEX IF NOT EXISTS jobs_pending_priority_idx ON jobs (priority, id) WHERE status = 'pending';")
+                cur.execute("CREATE INDEX IF NOT EXISTS jobs_lease_idx ON jobs (lease_expires_at) WHERE status = 'processing';")
+                cur.execute('ALTER TABLE jobs ADD COLUMN IF NOT EXISTS cache_key TEXT, ADD COLUMN IF NOT EXISTS leader_code TEXT, ADD COLUMN IF NOT EXISTS title TEXT, ADD COLUMN IF NOT EXISTS description TEXT, ADD COLUMN IF NOT EXISTS method TEXT;')
+                cur.execute("CREATE INDEX IF NOT EXISTS jobs_inflight_cache_key_idx ON jobs (cache_key) WHERE status IN ('pending', 'processing');")
+                cur.execute('CREATE INDEX IF NOT EXISTS jobs_leader_code_idx ON jobs (leader_code) WHERE leader_code IS NOT NULL;')
+                cur.execute('CREATE TABLE IF NOT EXISTS media_cache (cache_key TEXT NOT NULL, item_index INTEGER NOT NULL, total INTEGER NOT NULL, media_type TEXT NOT NULL, file_id TEXT NOT NULL, caption TEXT, extra_texts TEXT[] DEFAULT \'{}\', file_size BIGINT, hits INTEGER DEFAULT 0, created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(), last_hit_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(), PRIMARY KEY (cache_key, item_index));')
+                cur.execute('CREATE INDEX IF NOT EXISTS media_cache_created_idx ON media_cache (created_at);')
+                cur.execute('CREATE TABLE IF NOT EXISTS profile_cache (username TEXT PRIMARY KEY, full_name TEXT, biography TEXT, media_count INTEGER, follower_count BIGINT, following_count BIGINT, profile_pic_url TEXT, profile_pic_file_id TEXT, fetched_at TIMESTAMP WITH TIME ZONE DEFAULT NOW());')
+                cur.execute("ALTER TABLE jobs ADD COLUMN IF NOT EXISTS kind TEXT NOT NULL DEFAULT 'download', ADD COLUMN IF NOT EXISTS format_option TEXT, ADD COLUMN IF NOT EXISTS timings JSONB;")
+                cur.execute("ALTER TABLE jobs ADD COLUMN IF NOT EXISTS platform TEXT;")
+                cur.execute('CREATE TABLE IF NOT EXISTS format_manifests (cache_key TEXT PRIMARY KEY, url TEXT NOT NULL, title TEXT, options JSONB NOT NULL, info JSONB NOT NULL, extracted_at TIMESTAMP WITH TIME ZONE DEFAULT NOW());')
+                cur.execute('CREATE TABLE IF NOT EXISTS backups (id SERIAL PRIMARY KEY, kind TEXT NOT NULL, since_at TIMESTAMP WITH TIME ZONE, until_at TIMESTAMP WITH TIME ZONE NOT NULL, row_count INTEGER, archive_size BIGINT, created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW());')
+                cur.execute('CREATE TABLE IF NOT EXISTS workers (worker_id TEXT PRIMARY KEY, hostname TEXT, active_jobs INTEGER DEFAULT 0, started_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(), last_heartbeat TIMESTAMP WITH TIME ZONE DEFAULT NOW());')
+                cur.execute('ALTER TABLE workers ADD COLUMN IF NOT EXISTS pid INTEGER;')
+                cur.execute('CREATE INDEX IF NOT EXISTS jobs_completed_at_idx ON jobs (completed_at) WHERE completed_at IS NOT NULL;')
+                for table in ('stats_hourly', 'stats_daily'):
+                    cur.execute(f'CREATE TABLE IF NOT EXISTS {table} (bucket TIMESTAMP WITH TIME ZONE NOT NULL, platform TEXT NOT NULL, method TEXT NOT NULL, downloads INTEGER NOT NULL DEFAULT 0, failures INTEGER NOT NULL DEFAULT 0, bytes BIGINT NOT NULL DEFAULT 0, latency_p50 REAL, latency_p95 REAL, PRIMARY KEY (bucket, platform, method));')
+                cur.execute('CREATE TABLE IF NOT EXISTS bot_counters (name TEXT PRIMARY KEY, value BIGINT NOT NULL DEFAULT 0);')
+                cur.execute(COUNTER_FUNCTIONS)
+                # migration یک‌باره: شمارنده‌ها زیر قفل از نو حساب و trigger ها ساخته می‌شوند؛ در start های بعدی به trigger ها دست نمی‌خورد
+                cur.execute("SELECT 1 FROM pg_trigger WHERE tgname = 'jobs_download_counters_trigger' AND tgrelid = 'jobs'::regclass;")
+                if not cur.fetchone():
+                    cur.execute("LOCK TABLE users, jobs IN SHARE ROW EXCLUSIVE MODE;")
+                    cur.execute("INSERT INTO bot_counters (name, value) SELECT 'total_users', COUNT(*) FROM users UNION ALL "
+                                "SELECT 'total_downloads', COUNT(*) FROM jobs WHERE bot_counters_is_download(status, leader_code, worker_id, cache_key) UNION ALL "
+                                "SELECT 'total_bytes', COALESCE(SUM(file_size), 0) FROM jobs WHERE bot_counters_is_download(status, leader_code, worker_id, cache_key) "
+                                "ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value;")
+                    cur.execute(COUNTER_TRIGGERS)
+                # migration یک‌باره: rollup های قدیمی تحویل از cache و follower ها را هم دانلود شمرده بودند؛ از کل تاریخچه از نو ساخته می‌شوند
+                cur.execute("SELECT 1 FROM information_schema.columns WHERE table_name = 'stats_daily' AND column_name = 'deliveries';")
+                if not cur.fetchone():
+                    for table, unit in (('stats_hourly', 'hour'), ('stats_daily', 'day')):
+                        cur.execute(f'ALTER TABLE {table} ADD COLUMN deliveries INTEGER NOT NULL DEFAULT 0;')
+                        cur.execute(f'DELETE FROM {table};')
+                        cur.execute(ROLLUP_QUERY.format(table=table, unit=unit), {'since': '-infinity'})
+
+    async def add_user_if_not_exists(self, user):
+        def query(cur):
+            self._execute(cur, 'add_user', (user.id, user.first_name, user.username))
+            return cur.rowcount > 0
+        return await self._query(query)
+
+    async def add_job(self, code, user_id, url, cache_key=None, leader_code=None, priority=1, notify=True, kind='download', format_option=None):
+        def query(cur):
+            self._execute(cur, 'add_job', (code, user_id, url, priority, cache_key, leader_code, 'coalesced' if leader_code else 'pending', kind, format_option, job_platform(url)))
+            if notify: self._execute(cur, 'notify_job', (code,))
+        await self._query(query)
+
+    async def get_job_by_code(self, code):
+        def query(cur):
+            self._execute(cur, 'get_job', (code,))
+            result = cur.fetchone()
+            return {'user_id': result[0], 'url': result[1], 'cache_key': result[2], 'title': result[3], 'description': result[4]} if result else None
+        return await self._query(query, read_only=True)
+
+    async def add_job_timings(self, code, timings):
+        if timings: await self._query(lambda cur: self._execute(cur, 'add_job_timings', (json.dumps(timings), code)))
+
+    async def set_job_metadata(self, code, title, description, method):
+        await self._query(lambda cur: self._execute(cur, 'set_job_metadata', (title, description, method, code)))
+
+    async def add_cached_job(self, code, user_id, url, cache_key, file_size, status='completed'):
+        await self._query(lambda cur: self._execute(cur, 'add_cached_job', (code, user_id, url, cache_key, status, file_size)))
+
+    async def get_cached_media(self, cache_key, ttl_hours):
+        def query(cur):
+            self._execute(cur, 'get_cached_media', (cache_key, ttl_hours))
+            rows = cur.fetchall()
+            if not rows or len(rows) != rows[0][1]: return None
+            self._execute(cur, 'touch_cached_media', (cache_key,))
+            return [{'media_type': r[2], 'file_id': r[3], 'caption': r[4], 'extra_texts': r[5] or [], 'file_size': r[6]} for r in rows]
+        return await self._query(query)
+
+    async def cache_media_item(self, cache_key, index, total, media_type, file_id, caption, extra_texts, file_size):
+        await self._query(lambda cur: self._execute(cur, 'cache_media_item', (cache_key, index, total, media_type, file_id, caption, list(extra_texts), file_size)))
+
+    async def invalidate_cached_media(self, cache_key):
+        await self._query(lambda cur: cur.execute("DELETE FROM media_cache WHERE cache_key = %s;", (cache_key,)))
+
+    async def evict_media_cache(self, ttl_hours, max_entries):
+        def query(cur):
+            cur.execute("DELETE FROM media_cache WHERE created_at < NOW() - make_interval(hours => %s);", (ttl_hours,))
+            removed = cur.rowcount
+            cur.execute("DELETE FROM media_cache WHERE cache_key IN (SELECT cache_key FROM media_cache GROUP BY cache_key ORDER BY MAX(last_hit_at) DESC OFFSET %s);", (max_entries,))
+            return removed + cur.rowcount
+        return await self._query(query)
+
+    async def get_media_cache_statistics(self):
+        def query(cur):
+            cur.execute("SELECT COUNT(DISTINCT cache_key), COALESCE(SUM(hits) FILTER (WHERE item_index = 1), 0) FROM media_cache;")
+            entries, total_hits = cur.fetchone()
+            return {'entries': entries, 'total_hits': total_hits}
+        return await self._query(query, read_only=True)
+
+    async def get_cached_profile(self, username, ttl_seconds):
+        def query(cur):
+            self._execute(cur, 'get_cached_profile', (username.lower(), ttl_seconds))
+            result = cur.fetchone()
+            if not result: return None
+            return dict(zip(('username', 'full_name', 'biography', 'media_count', 'follower_count', 'following_count', 'profile_pic_url', 'profile_pic_file_id'), result))
+        return await self._query(query, read_only=True)
+
+    async def save_profile(self, profile):
+        params = (profile['username'].lower(), profile.get('full_name'), profile.get('biography'), profile.get('media_count'),
+                  profile.get('follower_count'), profile.get('following_count'), str(profile.get('profile_pic_url_hd') or profile.get('profile_pic_url') or ''))
+        await self._query(lambda cur: self._execute(cur, 'save_profile', params))
+
+    async def get_format_manifest(self, cache_key, ttl_minutes, with_info=False):
+        def query(cur):
+            self._execute(cur, 'get_format_manifest', (cache_key, ttl_minutes, with_info))
+            result = cur.fetchone()
+            return {'options': result[0], 'info': result[1]} if result else None
+        return await self._query(query, read_only=True)
+
+    async def save_format_manifest(self, cache_key, url, title, options, info_json):
+        await self._query(lambda cur: self._execute(cur, 'save_format_manifest', (cache_key, url, title, json.dumps(options), info_json)))
+
+    async def set_profile_pic_file_id(self, username, file_id):
+        await self._query(lambda cur: self._execute(cur, 'set_profile_pic_file_id', (file_id, username.lower())))
+
+    async def update_job_on_complete(self, code, status, file_size):
+        def query(cur):
+            self._execute(cur, 'complete_job', (status, file_size, code))
+            self._execute(cur, 'complete_followers', (status, file_size, code))
+        await self._query(query)
+
+    async def find_inflight_leader(self, cache_key):
+        def query(cur):
+            self._execute(cur, 'find_inflight_leader', (cache_key,))
+            result = cur.fetchone()
+            return {'code': result[0], 'created_at': result[1]} if result else None
+        return await self._query(query, read_only=True)
+
+    async def get_followers(self, code):
+        def query(cur):
+            self._execute(cur, 'get_followers', (code,))
+            return [{'code': r[0], 'user_id': r[1]} for r in cur.fetchall()]
+        return await self._query(query, read_only=True)
+
+    async def fail_followers(self, code):
+        def query(cur):
+            cur.execute("UPDATE jobs SET status = 'failed', completed_at = NOW(), error = 'Leader job failed' WHERE leader_code = %s RETURNING code, user_id;", (code,))
+            return [{'code': r[0], 'user_id': r[1]} for r in cur.fetchall()]
+        return await self._query(query)
+
+    async def get_cached_media_since(self, cache_key, since):
+        def query(cur):
+            cur.execute("SELECT media_type, file_id, caption, extra_texts FROM media_cache WHERE cache_key = %s AND created_at >= %s ORDER BY item_index;", (cache_key, since))
+            return [{'media_type': r[0], 'file_id': r[1], 'caption': r[2], 'extra_texts': r[3] or []} for r in cur.fetchall()]
+        return await self._query(query, read_only=True)
+
+    def _claimed_job(self, cur):
+        result = cur.fetchone()
+        if not result: return None
+        job = {'code': result[0], 'url': result[1], 'user_id': result[2], 'attempts': result[3], 'coalesced': 0,
+               'cache_key': result[4], 'kind': result[5], 'format_option': result[6]}
+        if result[4]:
+            self._execute(cur, 'coalesce_pending', (job['code'], result[4]))
+            job['coalesced'] = cur.rowcount
+        return job
+
+    async def claim_next_job(self, worker_id, lease_seconds, max_attempts, platforms):
+        def query(cur):
+            self._execute(cur, 'claim_next_job', (worker_id, lease_seconds, max_attempts, list(platforms)))
+            return self._claimed_job(cur)
+        return await self._query(query)
+
+    async def claim_job_by_code(self, code, worker_id, lease_seconds):
+        def query(cur):
+            self._execute(cur, 'claim_job_by_code', (worker_id, lease_seconds, code))
+            return self._claimed_job(cur)
+        return await self._query(query)
+
+    async def finish_job(self, code):
+        await self._query(lambda cur: self._execute(cur, 'finish_job', (code,)))
+
+    async def fail_job(self, code, error):
+        await self._query(lambda cur: self._execute(cur, 'fail_job', (error, code)))
+
+    async def heartbeat(self, worker_id, hostname, active_jobs, lease_seconds):
+        def query(cur):
+            self._execute(cur, 'worker_heartbeat', (worker_id, hostname, active_jobs))
+            self._execute(cur, 'renew_leases', (worker_id, lease_seconds))
+        await self._query(query)
+
+    async def fail_abandoned_jobs(self, max_attempts):
+        # job pending که تلاش‌هایش تمام شده هم هیچ‌وقت claim نمی‌شود
+        def query(cur):
+            cur.execute("UPDATE jobs SET status = 'failed', completed_at = NOW(), error = 'Lease expired too many times', lease_expires_at = NULL "
+                        "WHERE ((status = 'processing' AND lease_expires_at < NOW()) OR status = 'pending') AND attempts >= %s RETURNING code;", (max_attempts,))
+            return [row[0] for row in cur.fetchall()]
+        return await self._query(query)
+
+    async def get_live_workers(self, stale_seconds):
+        def query(cur):
+            cur.execute("SELECT worker_id, active_jobs FROM workers WHERE last_heartbeat > NOW() - make_interval(secs => %s) ORDER BY worker_id;", (stale_seconds,))
+            return cur.fetchall()
+        return await self._query(query, read_only=True)
+
+    async def register_worker(self, worker_id, hostname, pid, stale_seconds, is_previous_run):
+        # heartbeat تازه یعنی پروسه دیگری با همین شناسه زنده است، مگر is_previous_run(hostname, pid) بگوید پروسه قبلی همین worker بوده
+        def query(cur):
+            cur.execute("INSERT INTO workers (worker_id, hostname, last_heartbeat) VALUES (%s, %s, NULL) ON CONFLICT (worker_id) DO NOTHING;", (worker_id, hostname))
+            cur.execute("SELECT hostname, pid, last_heartbeat > NOW() - make_interval(secs => %s) FROM workers WHERE worker_id = %s FOR UPDATE;", (stale_seconds, worker_id))
+            owner_host, owner_pid, live = cur.fetchone()
+            if live and not is_previous_run(owner_host, owner_pid): return False
+            cur.execute("UPDATE workers SET hostname = %s, pid = %s, active_jobs = 0, started_at = NOW(), last_heartbeat = NOW() WHERE worker_id = %s;", (hostname, pid, worker_id))
+            return True
+        return await self._query(query)
+
+    async def requeue_interrupted_jobs(self, worker_id, max_attempts):
+        # job هایی که تلاش‌هایشان تمام شده مثل fail_abandoned_jobs شکست می‌خورند؛ pending ماندنشان کاربر را بی‌جواب می‌گذارد
+        def query(cur):
+            cur.execute("UPDATE jobs SET status = 'failed', completed_at = NOW(), error = 'Interrupted too many times', lease_expires_at = NULL "
+                        "WHERE status = 'processing' AND worker_id = %s AND attempts >= %s RETURNING code;", (worker_id, max_attempts))
+            failed = [row[0] for row in cur.fetchall()]
+            cur.execute("UPDATE jobs SET status = 'pending', worker_id = NULL, claimed_at = NULL WHERE status = 'processing' AND worker_id = %s;", (worker_id,))
+            return cur.rowcount, failed
+        return await self._query(query)
+
+    async def listen(self, channel, callback):
+        loop = asyncio.get_running_loop()
+        def connect():
+            conn = psycopg2.connect(**self.conn_params)
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cur: cur.execute(f"LISTEN {channel};")
+            return conn
+        async def reconnect():
+            while True:
+                try:
+                    conn = await asyncio.to_thread(connect)
+                    break
+                except psycopg2.Error as e:
+                    logger.error(f"❌ Could not (re)connect LISTEN {channel}. Retrying in 5s. Error: {e}")
+                    await asyncio.sleep(5)
+            def on_readable():
+                try:
+                    conn.poll()
+                except psycopg2.Error as e:
+                    logger.warning(f"⚠️ LISTEN {channel} connection lost. Error: {e}")
+                    loop.remove_reader(conn.fileno())
+                    conn.close()
+                    loop.create_task(reconnect())
+                    callback(None)
+                    return
+                while conn.notifies:
+                    callback(conn.notifies.pop(0).payload)
+            loop.add_reader(conn.fileno(), on_readable)
+            logger.info(f"✅ Listening for '{channel}' notifications.")
+            callback(None)
+        await reconnect()
+
+    async def get_backup_state(self):
+        def query(cur):
+            cur.execute("SELECT MAX(until_at), MAX(until_at) FILTER (WHERE kind = 'full'), NOW() FROM backups;")
+            last_until, last_full, now = cur.fetchone()
+            return {'last_until': last_until, 'last_full': last_full, 'now': now}
+        return await self._query(query, read_only=True)
+
+    async def record_backup(self, kind, since, until, row_count, archive_size):
+        await self._query(lambda cur: cur.execute("INSERT INTO backups (kind, since_at, until_at, row_count, archive_size) VALUES (%s, %s, %s, %s, %s);",
+                                                  (kind, since, until, row_count, archive_size)))
+
+    async def backup_cutoff(self):
+        # تراکنشی که الان باز است ممکن است بعد از snapshot بکاپ commit شود، با زمان‌هایی قبل از آن؛
+        # بکاپ بعدی از شروع قدیمی‌ترین تراکنش باز ادامه می‌دهد (ردیف تکراری در restore با upsert بی‌ضرر است)
+        def query(cur):
+            cur.execute("SELECT LEAST(NOW(), MIN(xact_start)) FROM pg_stat_activity WHERE datname = current_database() AND pid <> pg_backend_pid();")
+            return cur.fetchone()[0]
+        return await self._query(query, read_only=True)
+
+    async def export_changes(self, since):
+        # cutoff باید قبل از گرفتن snapshot خوانده شود
+        cutoff = await self.backup_cutoff()
+        def query(cur):
+            cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;")
+            cur.execute("SELECT NOW();")
+            until, tables, row_count = cur.fetchone()[0], {}, 0
+            for table, (_, condition) in BACKUP_TABLES.items():
+                buffer = io.BytesIO()
+                select = cur.mogrify(f"SELECT * FROM {table} WHERE {condition}", {'since': since, 'until': until}).decode()
+                cur.copy_expert(f"COPY ({select}) TO STDOUT WITH CSV HEADER", buffer)
+                tables[table], row_count = buffer.getvalue(), row_count + max(cur.rowcount, 0)
+            return until, cutoff, tables, row_count
+        return await self._query(query, read_only=True)
+
+    async def import_backup_rows(self, tables):
+        def query(cur):
+            restored = 0
+            for table, (key, _) in BACKUP_TABLES.items():
+                data = tables.get(table)
+                if not data: continue
+                columns = [c.strip().strip('"') for c in data.split(b'\n', 1)[0].decode().split(',')]
+                column_list = ', '.join(columns)
+                updates = ', '.join(f"{c} = EXCLUDED.{c}" for c in columns if c != key)
+                cur.execute(f"CREATE TEMP TABLE restore_{table} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP;")
+                cur.copy_expert(f"COPY restore_{table} ({column_list}) FROM STDIN WITH CSV HEADER", io.BytesIO(data))
+                cur.execute(f"INSERT INTO {table} ({column_list}) SELECT {column_list} FROM restore_{table} ON CONFLICT ({key}) DO UPDATE SET {updates};")
+                restored += cur.rowcount
+            cur.execute("SELECT setval('jobs_id_seq', GREATEST((SELECT MAX(id) FROM jobs), 1));")
+            return restored
+        return await self._query(query)
+
+    async def get_bot_statistics(self):
+        def query(cur):
+            cur.execute("SELECT name, value FROM bot_counters;")
+            counters = dict(cur.fetchall())
+            return {'total_users': counters.get('total_users', 0), 'total_downloads': counters.get('total_downloads', 0),
+                    'total_volume_gb': counters.get('total_bytes', 0) / (1024**3)}
+        return await self._query(query, read_only=True)
+
+    async def refresh_statistics_rollups(self):
+        def query(cur):
+            for table, unit in (('stats_hourly', 'hour'), ('stats_daily', 'day')):
+                cur.execute(f"SELECT COALESCE(MAX(bucket), '-infinity') FROM {table};")
+                cur.execute(ROLLUP_QUERY.format(table=table, unit=unit), {'since': cur.fetchone()[0]})
+        await self._query(query)
+
+    async def get_statistics_rollup(self, table, since_hours, platform='*', method='*'):
+        def query(cur):
+            cur.execute(f"SELECT bucket, downloads, failures, bytes, latency_p50, latency_p95, deliveries FROM {table} "
+                        "WHERE bucket > NOW() - make_interval(hours => %s) AND platform = %s AND method = %s ORDER BY bucket DESC;",
+                        (since_hours, platform, method))
+            return [dict(zip(('bucket', 'downloads', 'failures', 'bytes', 'p50', 'p95', 'deliveries'), row)) for row in cur.fetchall()]
+        return await self._query(query, read_only=True)
+
+    async def get_statistics_breakdown(self, days):
+        def query(cur):
+            breakdown = {}
+            for dimension, condition in (('platform', "method = '*' AND platform <> '*'"), ('method', "platform = '*' AND method <> '*'")):
+                cur.execute(f"SELECT {dimension}, SUM(downloads), SUM(failures), SUM(bytes) FROM stats_daily "
+                            f"WHERE bucket > NOW() - make_interval(days => %s) AND {condition} GROUP BY 1 ORDER BY 2 DESC LIMIT 10;", (days,))
+                breakdown[dimension] = [dict(zip(('name', 'downloads', 'failures', 'bytes'), row)) for row in cur.fetchall()]
+            return breakdown
+        return await self._query(query, read_only=True)
+
+    def close(self):
+        self.pool.closeall()
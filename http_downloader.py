@@ -0,0 +1,177 @@
+import os
+import json
+import math
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
+
+from config import (DOWNLOAD_CONNECTIONS, DOWNLOAD_SEGMENT_MIN_MB, DOWNLOAD_MIN_CHUNK_KB,
+                    DOWNLOAD_MAX_CHUNK_KB, DOWNLOAD_RETRIES)
+
+# --- دانلودر HTTP با session مشترک، تقسیم فایل به چند بخش (Range) و ادامه دانلود ---
+# وضعیت هر دانلود نیمه‌کاره کنار فایل در <file>.part.json ذخیره می‌شود تا بعد از قطعی ادامه پیدا کند
+
+logger = logging.getLogger("__main__")
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36"
+TRANSIENT_ERRORS = (requests.RequestException, Urllib3HTTPError, ConnectionError, TimeoutError)
+
+class RangeNotSupported(Exception):
+    pass
+
+class AdaptiveChunk:
+    def __init__(self, minimum, maximum):
+        self.minimum, self.maximum, self.size = minimum, maximum, minimum
+
+    def update(self, elapsed, received):
+        if received == self.size and elapsed < 0.05: self.size = min(self.size * 2, self.maximum)
+        elif elapsed > 0.5: self.size = max(self.size // 2, self.minimum)
+
+class HttpDownloader:
+    def __init__(self, connections=DOWNLOAD_CONNECTIONS, segment_min_bytes=DOWNLOAD_SEGMENT_MIN_MB * 1024 ** 2,
+                 min_chunk=DOWNLOAD_MIN_CHUNK_KB * 1024, max_chunk=DOWNLOAD_MAX_CHUNK_KB * 1024, retries=DOWNLOAD_RETRIES, pool_size=32):
+        self.connections, self.segment_min_bytes = max(1, connections), segment_min_bytes
+        self.min_chunk, self.max_chunk, self.retries = min_chunk, max(min_chunk, max_chunk), retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                              max_retries=Retry(total=retries, read=0, backoff_factor=0.5, status_forcelist=(502, 503, 504), allowed_methods=frozenset(["GET", "HEAD"])))
+        for prefix in ("http://", "https://"): self.session.mount(prefix, adapter)
+        self.session.headers["User-Agent"] = USER_AGENT
+        self.lock = threading.Lock()
+        self.stats = {'files': 0, 'bytes': 0, 'segmented': 0, 'resumed': 0, 'retries': 0}
+
+    def get(self, url, timeout=30, **kwargs):
+        return self.session.get(url, timeout=timeout, **kwargs)
+
+    def open(self, url, headers=None, timeout=300):
+        response = self.session.get(url, stream=True, timeout=timeout, headers=headers)
+        try: response.raise_for_status()
+        except Exception:
+            response.close()
+            raise
+        return response
+
+    def _plan(self, size):
+        count = max(1, min(self.connections, size // self.segment_min_bytes))
+        length = math.ceil(size / count)
+        return [[start, min(start + length, size) - 1, 0] for start in range(0, size, length)]
+
+    def _load_state(self, state_path, part_path, url):
+        try:
+            with open(state_path) as f: state = json.load(f)
+            if state.get('url') == url and state.get('ranges') and os.path.exists(part_path): return state
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def _save_state(self, state, state_path, force=False):
+        now = time.monotonic()
+        with self.lock:
+            if not force and now - state.get('_saved', 0) < 1: return
+            state['_saved'] = now
+            with open(state_path + ".tmp", 'w') as f: json.dump({k: v for k, v in state.items() if k != '_saved'}, f)
+            os.replace(state_path + ".tmp", state_path)
+
+    def _fetch_segment(self, url, state, index, part_path, state_path, response=None):
+        segment, attempts = state['segments'][index], 0
+        while True:
+            start, end, done = segment
+            if end is not None and start + done > end:
+                if response: response.close()
+                return
+            try:
+                if response is None:
+                    headers = {'Range': f"bytes={start + done}-{'' if end is None else end}"}
+                    if state.get('validator'): headers['If-Range'] = state['validator']
+                    response = self.open(url, headers)
+                    if response.status_code != 206: raise RangeNotSupported(f"Server answered a range request with HTTP {response.status_code}")
+                chunk, remaining = AdaptiveChunk(self.min_chunk, self.max_chunk), None if end is None else end - start - done + 1
+                with open(part_path, 'r+b') as f:
+                    f.seek(start + done)
+                    while remaining is None or remaining > 0:
+                        began = time.monotonic()
+                        wanted = chunk.size if remaining is None else min(chunk.size, remaining)
+                        data = response.raw.read(wanted, decode_content=True)
+                        if not data: break
+                        f.write(data)
+                        segment[2] += len(data)
+                        if remaining is not None: remaining -= len(data)
+                        chunk.update(time.monotonic() - began, len(data))
+                        if state['ranges']: self._save_state(state, state_path)
+                if remaining: raise ConnectionError(f"Connection closed with {remaining} byte(s) of segment {index} left")
+                return
+            except TRANSIENT_ERRORS as e:
+                attempts += 1
+                if not state['ranges'] or attempts > self.retries: raise
+                with self.lock: self.stats['retries'] += 1
+                logger.warning(f"Segment {index} of {os.path.basename(part_path)} interrupted at {segment[0] + segment[2]}, resuming (attempt {attempts}). Error: {e}")
+                time.sleep(min(0.5 * 2 ** (attempts - 1), 10))
+            finally:
+                if response: response.close()
+                response = None
+
+    def download(self, url, file_path, response=None):
+        part_path, state_path = file_path + ".part", file_path + ".part.json"
+        state = self._load_state(state_path, part_path, url)
+        if state:
+            if response: response.close()
+            response = None
+            with self.lock: self.stats['resumed'] += 1
+            logger.info(f"Resuming {os.path.basename(file_path)} from {sum(s[2] for s in state['segments'])}/{state['size']} bytes.")
+        else:
+            response = response or self.open(url)
+            # با gzip و ... بدنه از حالت فشرده باز می‌شود و اندازه‌اش با Content-Length یکی نیست؛ نه Range و نه چک اندازه معنی دارد
+            identity = response.headers.get('Content-Encoding', 'identity').lower() == 'identity'
+            size = int(response.headers.get('Content-Length') or 0) if identity else 0
+            ranges = bool(size) and response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+            state = {'url': url, 'size': size, 'ranges': ranges, 'validator': response.headers.get('ETag') or response.headers.get('Last-Modified'),
+                     'segments': self._plan(size) if ranges else [[0, None, 0]]}
+            with open(part_path, 'wb') as f:
+                if ranges: f.truncate(size)
+            if ranges: self._save_state(state, state_path, force=True)
+        try:
+            segments = state['segments']
+            if len(segments) == 1:
+                self._fetch_segment(url, state, 0, part_path, state_path, response)
+            else:
+                with self.lock: self.stats['segmented'] += 1
+                with ThreadPoolExecutor(max_workers=len(segments)) as pool:
+                    futures = [pool.submit(self._fetch_segment, url, state, i, part_path, state_path, response if i == 0 else None) for i in range(len(segments))]
+                    for future in futures: future.result()
+        except RangeNotSupported as e:
+            logger.warning(f"{e}; downloading {os.path.basename(file_path)} over a single connection instead.")
+            for path in (state_path, part_path):
+                if os.path.exists(path): os.remove(path)
+            return self.download_single(url, file_path)
+        except Exception:
+            if state['ranges']: self._save_state(state, state_path, force=True)
+            raise
+        if state['size'] and os.path.getsize(part_path) != state['size']: raise IOError(f"Downloaded size {os.path.getsize(part_path)} does not match {state['size']}")
+        os.replace(part_path, file_path)
+        if os.path.exists(state_path): os.remove(state_path)
+        with self.lock:
+            self.stats['files'] += 1
+            self.stats['bytes'] += os.path.getsize(file_path)
+        return file_path
+
+    def download_single(self, url, file_path):
+        part_path = file_path + ".part"
+        state = {'url': url, 'size': 0, 'ranges': False, 'validator': None, 'segments': [[0, None, 0]]}
+        open(part_path, 'wb').close()
+        self._fetch_segment(url, state, 0, part_path, None, self.open(url))
+        os.replace(part_path, file_path)
+        with self.lock:
+            self.stats['files'] += 1
+            self.stats['bytes'] += os.path.getsize(file_path)
+        return file_path
+
+    def summary(self):
+        with self.lock: stats = dict(self.stats)
+        return (f"HTTP: {stats['files']} file(s), {stats['bytes'] / 1024 ** 2:.1f} MB | segmented {stats['segmented']} | "
+                f"resumed {stats['resumed']} | segment retries {stats['retries']}")
@@ -0,0 +1,148 @@
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+from startup import LazyModule
+from config import (INSTAGRAM_USERNAME, INSTAGRAM_PASSWORD, INSTAGRAM_ACCOUNTS,
+                    INSTAGRAM_BACKOFF_SECONDS, INSTAGRAM_MAX_BACKOFF_SECONDS, INSTAGRAM_CHECKOUT_TIMEOUT)
+
+# --- لاگ‌ها در لاگر اسکریپت در حال اجرا (main_bot یا worker) ثبت می‌شوند ---
+logger = logging.getLogger("__main__")
+
+instaloader = LazyModule("instaloader")
+instagrapi = LazyModule("instagrapi")
+
+RATE_LIMIT_ERRORS = ("PleaseWaitFewMinutes", "RateLimitError", "ClientThrottledError", "TooManyRequestsException", "InstagramPoolExhausted")
+CHALLENGE_ERRORS = ("ChallengeRequired", "ChallengeUnknownStep", "SelectContactPointRecoveryForm", "RecaptchaChallengeForm", "FeedbackRequired")
+LOGIN_ERRORS = ("LoginRequired", "LoginRequiredException", "BadPassword", "BadCredentialsException", "TwoFactorRequired")
+
+class InstagramPoolExhausted(Exception):
+    pass
+
+def error_kind(error):
+    name, text = type(error).__name__, str(error)
+    if name in CHALLENGE_ERRORS or "challenge_required" in text: return "challenge"
+    if name in RATE_LIMIT_ERRORS or "429" in text or "Please wait" in text: return "rate_limit"
+    if name in LOGIN_ERRORS or "login_required" in text: return "login"
+    return None
+
+class InstagramAccount:
+    def __init__(self, username, password):
+        self.username, self.password = username, password
+        self.clients = {}
+        self.busy = set()
+        self.stale = set()
+        self.cooldown_until, self.strikes, self.uses = 0.0, 0, 0
+
+class InstagramPool:
+    def __init__(self, session_prefix="", accounts=None):
+        accounts = accounts or INSTAGRAM_ACCOUNTS or [{"username": INSTAGRAM_USERNAME, "password": INSTAGRAM_PASSWORD}]
+        self.accounts = [InstagramAccount(a["username"], a["password"]) for a in accounts]
+        self.session_prefix = session_prefix
+        self.condition = threading.Condition()
+        self.next_index = 0
+
+    def _session_file(self, backend, account):
+        return f"{self.session_prefix}{backend}_session_{account.username}" + (".json" if backend == "instagrapi" else "")
+
+    def _login(self, backend, account):
+        session_file = self._session_file(backend, account)
+        reuse = os.path.exists(session_file) and backend not in account.stale
+        if backend == "instagrapi":
+            client = instagrapi.Client()
+            if reuse:
+                client.load_settings(session_file)
+                client.username, client.password = account.username, account.password
+            else:
+                if os.path.exists(session_file): client.load_settings(session_file)
+                client.login(account.username, account.password, relogin=backend in account.stale)
+                client.dump_settings(session_file)
+        else:
+            client = instaloader.Instaloader(download_videos=True, download_pictures=True, download_video_thumbnails=False, save_metadata=False, compress_json=False)
+            if reuse:
+                client.load_session_from_file(account.username, session_file)
+            else:
+                client.login(account.username, account.password)
+                client.save_session_to_file(session_file)
+        account.stale.discard(backend)
+        account.clients[backend] = client
+        logger.info(f"✅ {backend} session for {account.username} {'reused' if reuse else 'created'}.")
+        return client
+
+    def _acquire(self, backend):
+        deadline = time.monotonic() + INSTAGRAM_CHECKOUT_TIMEOUT
+        with self.condition:
+            while True:
+                now, count = time.monotonic(), len(self.accounts)
+                for offset in range(count):
+                    account = self.accounts[(self.next_index + offset) % count]
+                    if backend not in account.busy and account.cooldown_until <= now:
+                        self.next_index = (self.next_index + offset + 1) % count
+                        account.busy.add(backend)
+                        account.uses += 1
+                        return account
+                cooling = [a.cooldown_until - now for a in self.accounts if a.cooldown_until > now]
+                remaining = deadline - now
+                if remaining <= 0 or (len(cooling) == count and min(cooling) > remaining):
+                    raise InstagramPoolExhausted(f"No Instagram account available for {backend} (busy or cooling down).")
+                self.condition.wait(min(cooling + [remaining]))
+
+    def _release(self, account, backend, error=None):
+        kind = error_kind(error) if error else None
+        with self.condition:
+            account.busy.discard(backend)
+            if error is None:
+                account.strikes = 0
+            elif kind:
+                account.strikes += 1
+                backoff = INSTAGRAM_MAX_BACKOFF_SECONDS if kind == "challenge" else min(INSTAGRAM_BACKOFF_SECONDS * 2 ** (account.strikes - 1), INSTAGRAM_MAX_BACKOFF_SECONDS)
+                account.cooldown_until = time.monotonic() + backoff
+                if kind == "login":
+                    account.clients.pop(backend, None)
+                    account.stale.add(backend)
+                logger.warning(f"Instagram account {account.username} hit {kind} on {backend}; backing off for {backoff}s.")
+            self.condition.notify_all()
+
+    @contextmanager
+    def checkout(self, backend="instagrapi"):
+        account = self._acquire(backend)
+        try:
+            client = account.clients.get(backend) or self._login(backend, account)
+            yield client
+        except Exception as e:
+            if backend not in account.clients and not error_kind(e): e = Exception(f"login_required: {e}")
+            self._release(account, backend, e)
+            raise
+        self._release(account, backend)
+
+    def warm_up(self, backends=("instagrapi",)):
+        for account in self.accounts:
+            for backend in backends:
+                with self.condition:
+                    # اگر یک checkout زودتر login کرده یا در حال login است، دوباره login نمی‌کنیم
+                    if backend in account.clients or backend in account.busy: continue
+                    account.busy.add(backend)
+                try:
+                    self._login(backend, account)
+                    self._release(account, backend)
+                except Exception as e:
+                    logger.error(f"❌ Could not log in {account.username} with {backend}. Error: {e}")
+                    self._release(account, backend, Exception(f"login_required: {e}"))
+
+    def warm_up_in_background(self, backends=("instagrapi",)):
+        # checkout هایی که قبل از تمام شدن login برسند، تا آزاد شدن همان account صبر می‌کنند
+        thread = threading.Thread(target=self.warm_up, args=(backends,), name="instagram-warm-up", daemon=True)
+        thread.start()
+        return thread
+
+    def summary(self):
+        now, lines = time.monotonic(), []
+        with self.condition:
+            for account in self.accounts:
+                line = f"{account.username:<20} uses {account.uses:<6} | {', '.join(sorted(account.clients)) or 'no session'}"
+                if account.cooldown_until > now: line += f" | cooling {int(account.cooldown_until - now)}s"
+                if account.busy: line += f" | busy: {', '.join(sorted(account.busy))}"
+                lines.append(line)
+        return "\n".join(lines)
@@ -67,6 +67,8 @@ REQS_SCRIPT_URL="https://raw.githubusercontent.com/mehrshadmadani/telegram-downl
 WORKER_SCRIPT_URL="https://raw.githubusercontent.com/mehrshadmadani/telegram-downloader-bot/main/advanced_worker.py"
 MAIN_BOT_SCRIPT_URL="https://raw.githubusercontent.com/mehrshadmadani/telegram-downloader-bot/main/main_bot.py"
 VERSION_URL="https://raw.githubusercontent.com/mehrshadmadani/telegram-downloader-bot/main/version.txt"
+SHARED_MODULES_BASE_URL="https://raw.githubusercontent.com/mehrshadmadani/telegram-downloader-bot/main"
+SHARED_MODULES="database.py instagram_pool.py backup.py job_protocol.py metrics.py http_downloader.py startup.py"
 WORKER_SCREEN_NAME="worker_session"
 MAIN_BOT_SCREEN_NAME="main_bot_session"
 
@@ -112,6 +114,7 @@ update_script() {
     if [ \$? -eq 0 ]; then
         print_success "\$service_name script updated successfully."
         if [[ "\$service_name" == "worker" ]] || [[ "\$service_name" == "main" ]]; then
+            update_shared_modules
             print_warning "Restart the service to apply changes: 'coka restart \$service_name'"
         fi
     else
@@ -119,6 +122,13 @@ update_script() {
     fi
 }
 
+update_shared_modules() {
+    for module in \$SHARED_MODULES; do
+        print_info "Updating shared module \$module..."
+        curl -s -L "\$SHARED_MODULES_BASE_URL/\$module?v=\$(date +%s)" -o "\$BOT_DIR/\$module" || print_error "Failed to download \$module."
+    done
+}
+
 update_manager() {
     print_info "Checking for new version from GitHub..."
     LATEST_VERSION=\$(curl -sL "\$VERSION_URL?v=\$(date +%s)" | head -n 1)
@@ -0,0 +1,81 @@
+import re
+import json
+import zlib
+import base64
+
+# --- پروتکل پیام‌های بین ربات اصلی و worker ---
+# خط اول برای خوانایی در گروه باقی می‌ماند، خط دوم یک JSON نسخه‌دار با checksum است:
+#   ⬇️ NEW JOB
+#   {"v":1,"t":"job","code":"ab12cd34","url":"https://...","user_id":123}#1a2b3c4d
+
+PROTOCOL_VERSION = 1
+HEADERS = {'job': "⬇️ NEW JOB", 'result': "✅ Uploaded", 'failure': "❌ JOB FAILED", 'formats': "🎛 FORMATS READY"}
+FIELDS = {
+    'job': {'code': str, 'url': str, 'user_id': int},
+    'result': {'code': str, 'index': int, 'total': int, 'size': int, 'method': str},
+    'failure': {'code': str, 'reason': str},
+    'formats': {'code': str},
+}
+ENVELOPE_PATTERN = re.compile(r'^(\{.*\})#([0-9a-f]{8})$')
+LEGACY_KEYS = {'URL': 'url', 'CODE': 'code', 'USER_ID': 'user_id', 'SIZE': 'size', 'METHOD': 'method', 'REASON': 'reason', 'CAPTION': 'caption'}
+
+class ProtocolError(Exception):
+    pass
+
+def encode_message(kind, **payload):
+    body = json.dumps({'v': PROTOCOL_VERSION, 't': kind, **payload}, ensure_ascii=False, separators=(',', ':'))
+    header = HEADERS[kind] + (f" ({payload['index']}/{payload['total']})" if kind == 'result' else "")
+    return f"{header}\n{body}#{zlib.crc32(body.encode('utf-8')):08x}"
+
+def encode_job(code, url, user_id):
+    return encode_message('job', code=code, url=url, user_id=user_id)
+
+def encode_result(code, index, total, size, method, profile=None):
+    payload = {'code': code, 'index': index, 'total': total, 'size': size, 'method': method}
+    if profile: payload['profile'] = profile
+    return encode_message('result', **payload)
+
+def encode_failure(code, reason):
+    return encode_message('failure', code=code, reason=reason[:300])
+
+def encode_formats_ready(code):
+    return encode_message('formats', code=code)
+
+def _message_kind(first_line):
+    return next((kind for kind, header in HEADERS.items() if first_line.startswith(header)), None)
+
+def _validate(kind, message):
+    for field, field_type in FIELDS[kind].items():
+        if field not in message: raise ProtocolError(f"Missing field '{field}' in {kind} message")
+        try: message[field] = field_type(message[field])
+        except (TypeError, ValueError): raise ProtocolError(f"Invalid value for '{field}' in {kind} message")
+    return message
+
+def _parse_legacy(kind, lines):
+    message = {LEGACY_KEYS[key.strip()]: value.strip() for key, value in (line.split(":", 1) for line in lines[1:] if ":" in line) if key.strip() in LEGACY_KEYS}
+    if kind == 'result':
+        match = re.search(r'\((\d+)/(\d+)\)', lines[0])
+        message['index'], message['total'] = (int(match.group(1)), int(match.group(2))) if match else (1, 1)
+        if 'caption' in message:
+            try: message['caption'] = base64.b64decode(message['caption']).decode('utf-8').strip()
+            except ValueError: message.pop('caption')
+    return message
+
+def parse_message(text):
+    lines = (text or "").strip().split('\n')
+    kind = _message_kind(lines[0])
+    if not kind: raise ProtocolError("Not a job protocol message")
+    match = ENVELOPE_PATTERN.match(lines[-1].strip()) if len(lines) > 1 else None
+    if not match:
+        message = _parse_legacy(kind, lines)
+    else:
+        body, checksum = match.groups()
+        if f"{zlib.crc32(body.encode('utf-8')):08x}" != checksum: raise ProtocolError("Checksum mismatch")
+        try: message = json.loads(body)
+        except ValueError: raise ProtocolError("Malformed message body")
+        version = message.get('v')
+        if not isinstance(version, int) or isinstance(version, bool): raise ProtocolError(f"Malformed protocol version {version!r}")
+        if version > PROTOCOL_VERSION: raise ProtocolError(f"Unsupported protocol version {version}")
+        if message.get('t') != kind: raise ProtocolError("Message type does not match its header")
+    message['kind'] = kind
+    return _validate(kind, message)
@@ -1,26 +1,41 @@
 import os
-import psycopg2
+import time
+import asyncio
 import random
 import string
-import base64
 import re
 import logging
-import subprocess
+import weakref
+import itertools
+from collections import deque
 from functools import wraps
 from datetime import datetime, timedelta
-import yt_dlp
-from instagrapi import Client as InstagrapiClient
-
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, MessageHandler, CommandHandler, filters, ContextTypes, CallbackQueryHandler
-from telegram.constants import ChatMemberStatus
-from telegram.error import BadRequest
-from config import (BOT_TOKEN, BACKUP_BOT_TOKEN, GROUP_ID, DB_NAME, DB_USER, DB_PASS, DB_HOST, DB_PORT,
+from urllib.parse import urlparse, parse_qsl, urlencode
+
+# startup قبل از بقیه import می‌شود تا زمان import کتابخانه‌ها هم در گزارش راه‌اندازی بیاید
+from startup import StartupProfile
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import Application, MessageHandler, CommandHandler, filters, ContextTypes, CallbackQueryHandler, ChatMemberHandler, BaseUpdateProcessor
+from telegram.constants import ChatMemberStatus, ChatType
+from telegram.error import BadRequest, RetryAfter
+from database import PostgresDB
+from instagram_pool import InstagramPool
+from backup import build_backup_archive, dump_database
+from job_protocol import encode_job, parse_message, ProtocolError
+from metrics import Metrics, JobTrace
+from config import (BOT_TOKEN, BACKUP_BOT_TOKEN, GROUP_ID,
                     ORDER_TOPIC_ID, LOG_TOPIC_ID, ADMIN_IDS, FORCED_JOIN_CHANNELS,
-                    INSTAGRAM_USERNAME, INSTAGRAM_PASSWORD,
                     BUTTON_TEXT, BUTTON_URL, FOOTER_TEXT, USER_COOLDOWN_SECONDS,
-                    START_MESSAGE, SUBMIT_MESSAGE, FAILURE_MESSAGE,
-                    AUTO_BACKUP_INTERVAL_MINUTES)
+                    START_MESSAGE, SUBMIT_MESSAGE, FAILURE_MESSAGE, QUALITY_PROMPT_VIDEO, QUALITY_PROMPT_AUDIO,
+                    QUALITY_SELECTION, FORMAT_MANIFEST_TTL_MINUTES,
+                    AUTO_BACKUP_INTERVAL_MINUTES, FULL_BACKUP_INTERVAL_HOURS, JOB_TRANSPORT,
+                    MEDIA_CACHE_TTL_HOURS, MEDIA_CACHE_MAX_ENTRIES,
+                    MEMBERSHIP_CACHE_TTL_SECONDS, MEMBERSHIP_NEGATIVE_TTL_SECONDS,
+                    PROFILE_CACHE_TTL_MINUTES, OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE,
+                    OUTBOUND_CHAT_BURST, OUTBOUND_GROUP_RATE_PER_MINUTE, OUTBOUND_MAX_IN_FLIGHT,
+                    METRICS_HOST, MAIN_BOT_METRICS_PORT, UPDATE_MODE, WEBHOOK_URL, WEBHOOK_LISTEN,
+                    WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET_TOKEN, WEBHOOK_CERT, WEBHOOK_KEY, MAX_CONCURRENT_UPDATES,
+                    BOT_API_BASE_URL)
 
 # --- سیستم لاگ‌گیری ---
 logger = logging.getLogger(__name__)
@@ -35,57 +50,180 @@ file_handler_main = logging.FileHandler('main_bot.log', encoding='utf-8')
 file_handler_main.setFormatter(formatter)
 logger.addHandler(file_handler_main)
 
-class PostgresDB:
-    def __init__(self):
-        self.conn_params = {"dbname": DB_NAME, "user": DB_USER, "password": DB_PASS, "host": DB_HOST, "port": DB_PORT}
-        self.init_database()
-
-    def get_conn(self):
-        return psycopg2.connect(**self.conn_params)
-
-    def init_database(self):
-        with self.get_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute('CREATE TABLE IF NOT EXISTS users (user_id BIGINT PRIMARY KEY, first_name TEXT, username TEXT, join_date TIMESTAMP WITH TIME ZONE DEFAULT NOW());')
-                cur.execute('CREATE TABLE IF NOT EXISTS jobs (id SERIAL PRIMARY KEY, code TEXT UNIQUE NOT NULL, user_id BIGINT REFERENCES users(user_id), url TEXT NOT NULL, status TEXT DEFAULT \'pending\', created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(), completed_at TIMESTAMP WITH TIME ZONE, file_size BIGINT);')
-
-    def add_user_if_not_exists(self, user: Update.effective_user):
-        sql = 'INSERT INTO users (user_id, first_name, username) VALUES (%s, %s, %s) ON CONFLICT (user_id) DO NOTHING;'
-        with self.get_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute(sql, (user.id, user.first_name, user.username))
-                return cur.rowcount > 0
-
-    def add_job(self, code, user_id, url):
-        with self.get_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute("INSERT INTO jobs (code, user_id, url) VALUES (%s, %s, %s);", (code, user_id, url))
-
-    def get_job_by_code(self, code):
-        with self.get_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT user_id, url FROM jobs WHERE code = %s;", (code,))
-                result = cur.fetchone()
-                return {'user_id': result[0], 'url': result[1]} if result else None
-
-    def update_job_on_complete(self, code, status, file_size):
-        sql = "UPDATE jobs SET status = %s, completed_at = NOW(), file_size = %s WHERE code = %s;"
-        with self.get_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute(sql, (status, file_size, code))
-
-    def get_bot_statistics(self):
-        stats = {}
-        with self.get_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT COUNT(*) FROM users;")
-                stats['total_users'] = cur.fetchone()[0]
-                cur.execute("SELECT COUNT(*) FROM jobs WHERE status = 'completed';")
-                stats['total_downloads'] = cur.fetchone()[0]
-                cur.execute("SELECT SUM(file_size) FROM jobs WHERE status = 'completed';")
-                total_size_bytes = cur.fetchone()[0]
-                stats['total_volume_gb'] = (total_size_bytes or 0) / (1024**3)
-        return stats
+class MembershipCache:
+    def __init__(self, positive_ttl, negative_ttl):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.entries = {}
+        self.stats = {'hits': 0, 'api_calls': 0}
+
+    def get(self, user_id, channel):
+        entry = self.entries.get((user_id, channel.lower()))
+        if entry and entry[1] > time.monotonic():
+            self.stats['hits'] += 1
+            return entry[0]
+        return None
+
+    def set(self, user_id, channel, is_member):
+        if len(self.entries) > 50000:
+            now = time.monotonic()
+            self.entries = {key: entry for key, entry in self.entries.items() if entry[1] > now}
+        ttl = self.positive_ttl if is_member else self.negative_ttl
+        self.entries[(user_id, channel.lower())] = (is_member, time.monotonic() + ttl)
+
+    def invalidate(self, user_id, channel=None):
+        for key in [key for key in self.entries if key[0] == user_id and (channel is None or key[1] == channel.lower())]:
+            self.entries.pop(key, None)
+
+    async def is_member(self, bot, user_id, channel):
+        cached = self.get(user_id, channel)
+        if cached is not None: return cached
+        self.stats['api_calls'] += 1
+        try:
+            member = await bot.get_chat_member(chat_id=channel, user_id=user_id)
+        except Exception as e:
+            logger.warning(f"Could not check membership of {user_id} in {channel}: {e}")
+            return False
+        is_member = member.status not in [ChatMemberStatus.LEFT, ChatMemberStatus.BANNED]
+        self.set(user_id, channel, is_member)
+        return is_member
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate, self.capacity = rate, capacity
+        self.tokens, self.updated, self.blocked_until = capacity, time.monotonic(), 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+
+    def delay(self):
+        now = self._refill()
+        return max(self.blocked_until - now, (1 - self.tokens) / self.rate if self.tokens < 1 else 0.0, 0.0)
+
+    def consume(self):
+        self._refill()
+        self.tokens -= 1
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def idle(self):
+        return self._refill() >= self.blocked_until and self.tokens >= self.capacity
+
+class OutboundDispatcher:
+    INTERACTIVE, MEDIA, TEXT = 0, 1, 2
+
+    def __init__(self, global_rate, chat_rate, chat_burst, group_rate_per_minute, max_in_flight):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate, self.chat_burst, self.group_rate = chat_rate, chat_burst, group_rate_per_minute / 60
+        self.max_in_flight = max_in_flight
+        self.chat_buckets = {}
+        self.sequence = itertools.count()
+        self.queue, self.in_flight = None, None
+        self.stats = {'sent': 0, 'failed': 0, 'retry_after': 0, 'max_depth': 0}
+        self.latencies = deque(maxlen=500)
+
+    def start(self):
+        self.queue, self.in_flight = asyncio.PriorityQueue(), asyncio.Semaphore(self.max_in_flight)
+        asyncio.create_task(self._run())
+
+    def _bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 10000:
+                self.chat_buckets = {key: b for key, b in self.chat_buckets.items() if not b.idle()}
+            bucket = TokenBucket(self.group_rate, 3) if chat_id < 0 else TokenBucket(self.chat_rate, self.chat_burst)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def send(self, method, chat_id, priority=TEXT, **kwargs):
+        if self.queue is None: return await method(chat_id=chat_id, **kwargs)
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((priority, next(self.sequence), {'method': method, 'chat_id': chat_id, 'kwargs': kwargs, 'future': future, 'enqueued': time.monotonic(), 'attempts': 0}))
+        self.stats['max_depth'] = max(self.stats['max_depth'], self.queue.qsize())
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            entry = await self.queue.get()
+            chat_bucket = self._bucket(entry[2]['chat_id'])
+            wait = chat_bucket.delay()
+            if wait > 0:
+                loop.call_later(wait, self.queue.put_nowait, entry)
+                continue
+            while (wait := self.global_bucket.delay()) > 0: await asyncio.sleep(wait)
+            self.global_bucket.consume()
+            chat_bucket.consume()
+            await self.in_flight.acquire()
+            asyncio.create_task(self._deliver(entry))
+
+    async def _deliver(self, entry):
+        item = entry[2]
+        future = item['future']
+        try:
+            result = await item['method'](chat_id=item['chat_id'], **item['kwargs'])
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else float(e.retry_after)
+            self.stats['retry_after'] += 1
+            self._bucket(item['chat_id']).block(retry_after)
+            item['attempts'] += 1
+            logger.warning(f"Flood limit hit for chat {item['chat_id']}, retrying in {retry_after:.0f}s (attempt {item['attempts']}).")
+            if item['attempts'] <= 3: self.queue.put_nowait(entry)
+            elif not future.done(): future.set_exception(e)
+        except Exception as e:
+            self.stats['failed'] += 1
+            if not future.done(): future.set_exception(e)
+        else:
+            self.stats['sent'] += 1
+            self.latencies.append(time.monotonic() - item['enqueued'])
+            if not future.done(): future.set_result(result)
+        finally:
+            self.in_flight.release()
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        percentile = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))] if latencies else 0
+        return {**self.stats, 'depth': self.queue.qsize() if self.queue else 0, 'p50': percentile(0.5), 'p95': percentile(0.95)}
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # update-های کاربران مختلف همزمان پردازش می‌شوند ولی update-های یک کاربر در چت خصوصی
+    # و فایل‌های یک job در گروه به ترتیب رسیدن پردازش می‌شوند
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self.user_locks = weakref.WeakValueDictionary()
+
+    @staticmethod
+    def ordering_key(update):
+        if not isinstance(update, Update) or not update.effective_user: return None
+        if update.callback_query or (update.effective_chat and update.effective_chat.type == ChatType.PRIVATE): return update.effective_user.id
+        if update.message and update.message.caption:
+            try: return ("job", parse_message(update.message.caption)['code'])
+            except ProtocolError: return None
+        return None
+
+    async def process_update(self, update, coroutine):
+        # قفل کاربر قبل از semaphore گرفته می‌شود؛ وگرنه update های منتظر یک کاربر پرکار سهمیه همزمانی بقیه را اشغال می‌کنند
+        key = self.ordering_key(update)
+        if key is None: return await super().process_update(update, coroutine)
+        lock = self.user_locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self.user_locks[key] = lock
+        async with lock:
+            await super().process_update(update, coroutine)
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
 
 def membership_required(func):
     @wraps(func)
@@ -93,14 +231,8 @@ def membership_required(func):
         user = update.effective_user
         if not user or not FORCED_JOIN_CHANNELS:
             return await func(self, update, context, *args, **kwargs)
-        channels_to_join = []
-        for channel in FORCED_JOIN_CHANNELS:
-            try:
-                member = await context.bot.get_chat_member(chat_id=channel, user_id=user.id)
-                if member.status in [ChatMemberStatus.LEFT, ChatMemberStatus.BANNED]:
-                    channels_to_join.append(channel)
-            except:
-                channels_to_join.append(channel)
+        results = await asyncio.gather(*(self.membership_cache.is_member(context.bot, user.id, channel) for channel in FORCED_JOIN_CHANNELS))
+        channels_to_join = [channel for channel, is_member in zip(FORCED_JOIN_CHANNELS, results) if not is_member]
         if channels_to_join:
             buttons = [[InlineKeyboardButton(f"عضویت در {channel.lstrip('@')}", url=f"https://t.me/{channel.lstrip('@')}")] for channel in channels_to_join]
             buttons.append([InlineKeyboardButton("✅ بررسی عضویت", callback_data="check_membership")])
@@ -109,7 +241,7 @@ def membership_required(func):
             if update.callback_query:
                 await update.callback_query.answer("هنوز عضو تمام کانال‌ها نیستید!", show_alert=True)
             else:
-                await update.message.reply_text(text, reply_markup=reply_markup)
+                await self.outbox.send(context.bot.send_message, user.id, OutboundDispatcher.INTERACTIVE, text=text, reply_markup=reply_markup)
             return
         if update.callback_query:
             await update.callback_query.answer("عضویت شما تایید شد!")
@@ -117,58 +249,188 @@ def membership_required(func):
         return await func(self, update, context, *args, **kwargs)
     return wrapper
 
+TRACKING_PARAMS = {'igsh', 'igshid', 'si', 'feature', 'fbclid', 'gclid', 'ref', 'ref_src', 'pp', 'img_index'}
+
+def normalize_url(url):
+    parsed = urlparse(url.strip())
+    host = parsed.netloc.lower().split('@')[-1].split(':')[0]
+    for prefix in ('www.', 'm.'):
+        if host.startswith(prefix): host = host[len(prefix):]
+    path = parsed.path.rstrip('/')
+    query = [(k, v) for k, v in parse_qsl(parsed.query) if k.lower() not in TRACKING_PARAMS and not k.lower().startswith('utm_')]
+    if host.endswith('instagram.com'):
+        for pattern, kind in [(r'^/(?:[^/]+/)?(?:p|reel|reels|tv)/([^/]+)', 'media'), (r'^/stories/highlights/([^/]+)', 'highlight'),
+                              (r'^/stories/[^/]+/(\d+)', 'story'), (r'^/s/([^/]+)', 's'), (r'^/([A-Za-z0-9._]+)$', 'profile')]:
+            match = re.match(pattern, path)
+            if match: return f"instagram:{kind}:{match.group(1).lower() if kind == 'profile' else match.group(1)}"
+    if host in ('youtube.com', 'music.youtube.com', 'youtu.be'):
+        video_id = dict(query).get('v') if path == '/watch' else None
+        match = re.match(r'^/(?:shorts/|embed/|live/)?([A-Za-z0-9_-]{11})$', path)
+        if not video_id and match: video_id = match.group(1)
+        if video_id: return f"youtube:{video_id}"
+    return f"{host}{path}" + (f"?{urlencode(sorted(query))}" if query else "")
+
+def format_profile_caption(profile):
+    return (f"👤 **{profile.get('full_name')}** (`@{profile.get('username')}`)\n\n"
+            f"**Bio:**\n{profile.get('biography')}\n\n"
+            f"----------------------------------------\n"
+            f"**Posts:** {profile.get('media_count')} | "
+            f"**Followers:** {profile.get('follower_count')} | "
+            f"**Following:** {profile.get('following_count')}\n\n{FOOTER_TEXT}")
+
 class AdvancedBot:
     def __init__(self, token, group_id, order_topic_id, log_topic_id, admin_ids):
+        self.startup = StartupProfile()
+        self.startup.mark("imports")
         self.token = token
         self.group_id = int(group_id)
         self.order_topic_id = int(order_topic_id)
         self.log_topic_id = int(log_topic_id)
         self.admin_ids = admin_ids
         self.db = PostgresDB()
-        self.app = Application.builder().token(self.token).build()
-        self.instagrapi_client = self.setup_instagrapi_client()
+        self.startup.mark("database")
+        self.cache_stats = {'hits': 0, 'misses': 0}
+        self.url_locks = weakref.WeakValueDictionary()
+        self.membership_cache = MembershipCache(MEMBERSHIP_CACHE_TTL_SECONDS, MEMBERSHIP_NEGATIVE_TTL_SECONDS)
+        self.outbox = OutboundDispatcher(OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, OUTBOUND_GROUP_RATE_PER_MINUTE, OUTBOUND_MAX_IN_FLIGHT)
+        self.metrics = Metrics("downloader_bot")
+        self.metrics.gauge_callback("outbox_depth", lambda: self.outbox.queue.qsize() if self.outbox.queue else 0, "Messages waiting in the outbound dispatcher")
+        self.metrics.gauge_callback("media_cache_hits", lambda: self.cache_stats['hits'], "Requests served from the media cache since start")
+        self.metrics.gauge_callback("media_cache_misses", lambda: self.cache_stats['misses'], "Requests that missed the media cache since start")
+        builder = Application.builder().token(self.token).post_init(self.on_startup).connection_pool_size(OUTBOUND_MAX_IN_FLIGHT + 8)
+        if MAX_CONCURRENT_UPDATES > 1: builder = builder.concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        if BOT_API_BASE_URL: builder = builder.base_url(f"{BOT_API_BASE_URL.rstrip('/')}/bot").base_file_url(f"{BOT_API_BASE_URL.rstrip('/')}/file/bot")
+        self.app = builder.build()
+        self.backup_bot = None  # فقط هنگام اولین بکاپ ساخته می‌شود تا اتصال‌های HTTP آن راه‌اندازی را کند نکند
+        self.instagram = InstagramPool(session_prefix="main_bot_")
+        self.instagram.warm_up_in_background(("instagrapi",))
+        self.startup.mark("application")
 
-    def setup_instagrapi_client(self):
-        try:
-            client = InstagrapiClient()
-            session_file = f"main_bot_instagrapi_session.json"
-            if os.path.exists(session_file):
-                client.load_settings(session_file)
-            client.login(INSTAGRAM_USERNAME, INSTAGRAM_PASSWORD)
-            client.dump_settings(session_file)
-            logger.info("✅ Main Bot Instagrapi session loaded/created.")
-            return client
-        except Exception as e:
-            logger.error(f"❌ Main Bot could not login to Instagram. Error: {e}")
-            return None
+    async def on_startup(self, application):
+        self.outbox.start()
+        try: await self.metrics.serve(METRICS_HOST, MAIN_BOT_METRICS_PORT)
+        except OSError as e: logger.error(f"Could not start the metrics endpoint. Error: {e}")
+        self.startup.mark("bot api")
+        logger.info(f"⏱ Startup: {self.startup.report()}")
+
+    def fetch_instagram_profile(self, username):
+        with self.instagram.checkout("instagrapi") as client:
+            return client.user_info_by_username(username).model_dump()
     
     @membership_required
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        is_new_user = self.db.add_user_if_not_exists(user)
+        is_new_user = await self.db.add_user_if_not_exists(user)
         if is_new_user and self.log_topic_id:
             username = f"@{user.username}" if user.username else "ندارد"
             log_message = (f"🎉 کاربر جدید\n\nنام: {user.first_name}\nنام کاربری: {username}\nآیدی: [{user.id}](tg://user?id={user.id})")
-            await context.bot.send_message(chat_id=self.group_id, text=log_message, message_thread_id=self.log_topic_id, parse_mode='Markdown')
+            await self.outbox.send(context.bot.send_message, self.group_id, OutboundDispatcher.TEXT, text=log_message, message_thread_id=self.log_topic_id, parse_mode='Markdown')
         chat_id = update.effective_chat.id
-        if update.message:
-            await update.message.reply_text(START_MESSAGE)
-        else:
-            await context.bot.send_message(chat_id=chat_id, text=START_MESSAGE)
+        reply_to = update.message.message_id if update.message else None
+        await self.outbox.send(context.bot.send_message, chat_id, OutboundDispatcher.INTERACTIVE, text=START_MESSAGE, reply_to_message_id=reply_to)
 
     async def manage_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         if update.effective_user.id not in self.admin_ids: return
-        buttons = [[InlineKeyboardButton("📊 آمار ربات", callback_data="bot_stats")]]
+        buttons = [[InlineKeyboardButton("📊 آمار ربات", callback_data="bot_stats")],
+                   [InlineKeyboardButton("📈 ۲۴ ساعت اخیر", callback_data="stats_hourly"), InlineKeyboardButton("📅 ۷ روز اخیر", callback_data="stats_daily")],
+                   [InlineKeyboardButton("🧩 پلتفرم‌ها و روش‌ها", callback_data="stats_breakdown")],
+                   [InlineKeyboardButton("🗄 آمار کش", callback_data="cache_stats")]]
         reply_markup = InlineKeyboardMarkup(buttons)
         await update.message.reply_text("🔐 به پنل مدیریت خوش آمدید:", reply_markup=reply_markup)
 
     async def stats_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
         await query.answer("در حال محاسبه آمار...")
-        stats = self.db.get_bot_statistics()
+        stats = await self.db.get_bot_statistics()
         text = f"📊 **آمار کلی ربات**\n━━━━━━━━━━━━━━━━━━\n👥 **کل کاربران:** {stats.get('total_users', 0)}\n📥 **کل دانلودها:** {stats.get('total_downloads', 0)}\n💾 **حجم کل:** {stats.get('total_volume_gb', 0):.2f} GB"
         await query.edit_message_text(text, parse_mode='Markdown')
 
+    async def rollup_stats_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        await query.answer()
+        if query.data == "stats_breakdown":
+            breakdown = await self.db.get_statistics_breakdown(7)
+            lines = ["🧩 **پلتفرم‌ها و روش‌ها (۷ روز اخیر)**", "━━━━━━━━━━━━━━━━━━"]
+            for dimension, title in (('platform', "🌐 **پلتفرم‌ها:**"), ('method', "🛠 **روش‌های دانلود:**")):
+                lines.append(title)
+                lines += [f"`{row['name']}`: {row['downloads']} دانلود | {row['failures']} خطا | {row['bytes'] / 1024**3:.2f} GB" for row in breakdown[dimension]] or ["—"]
+        else:
+            hourly = query.data == "stats_hourly"
+            rows = await self.db.get_statistics_rollup('stats_hourly' if hourly else 'stats_daily', 24 if hourly else 24 * 7)
+            lines = ["📈 **آمار ۲۴ ساعت اخیر**" if hourly else "📅 **آمار ۷ روز اخیر**", "━━━━━━━━━━━━━━━━━━"]
+            for row in rows:
+                label = row['bucket'].strftime("%H:00" if hourly else "%Y-%m-%d")
+                latency = f" | p50 {row['p50']:.0f}s p95 {row['p95']:.0f}s" if row['p50'] is not None else ""
+                lines.append(f"`{label}`: {row['downloads']} ✅ {row['failures']} ❌ {row['deliveries']} ♻️ | {row['bytes'] / 1024**3:.2f} GB{latency}")
+            if not rows: lines.append("—")
+        lines.append("\nℹ️ هر ۵ دقیقه به‌روزرسانی می‌شود.")
+        await query.edit_message_text("\n".join(lines), parse_mode='Markdown')
+
+    async def cache_stats_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        await query.answer()
+        stats = await self.db.get_media_cache_statistics()
+        lookups = self.cache_stats['hits'] + self.cache_stats['misses']
+        hit_rate = self.cache_stats['hits'] * 100 / lookups if lookups else 0
+        text = (f"🗄 **آمار کش فایل‌ها**\n━━━━━━━━━━━━━━━━━━\n📦 **لینک‌های ذخیره‌شده:** {stats.get('entries', 0)}\n"
+                f"♻️ **کل استفاده‌ها از کش:** {stats.get('total_hits', 0)}\n"
+                f"🎯 **نرخ برخورد (از آخرین اجرا):** {hit_rate:.1f}% ({self.cache_stats['hits']}/{lookups})\n"
+                f"👥 **بررسی عضویت:** {self.membership_cache.stats['hits']} از کش | {self.membership_cache.stats['api_calls']} درخواست API")
+        outbox = self.outbox.summary()
+        text += (f"\n\n📮 **صف ارسال:** {outbox['depth']} در صف (بیشینه {outbox['max_depth']})\n"
+                 f"✉️ **ارسال‌شده:** {outbox['sent']} | ❌ {outbox['failed']} | ⏳ RetryAfter: {outbox['retry_after']}\n"
+                 f"⏱ **تأخیر تحویل:** p50 {outbox['p50']:.2f}s | p95 {outbox['p95']:.2f}s")
+        await query.edit_message_text(text, parse_mode='Markdown')
+
+    async def send_media_to_user(self, bot, user_id, media_type, file_id, caption_text, extra_texts=()):
+        reply_markup = None
+        if BUTTON_TEXT and BUTTON_URL:
+            keyboard = [[InlineKeyboardButton(BUTTON_TEXT, url=BUTTON_URL)]]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+        actions = {'video': bot.send_video, 'audio': bot.send_audio, 'photo': bot.send_photo, 'document': bot.send_document}
+        kwargs = {media_type: file_id, 'caption': caption_text, 'parse_mode': 'Markdown', 'reply_markup': reply_markup}
+        if media_type: await self.outbox.send(actions[media_type], user_id, OutboundDispatcher.MEDIA, **kwargs)
+        for text in extra_texts:
+            await self.outbox.send(bot.send_message, user_id, OutboundDispatcher.TEXT, text=text, disable_web_page_preview=True)
+
+    def url_lock(self, cache_key):
+        lock = self.url_locks.get(cache_key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self.url_locks[cache_key] = lock
+        return lock
+
+    async def deliver_from_cache(self, bot, user_id, code, url, cache_key, cached_items):
+        try:
+            for item in cached_items:
+                await self.send_media_to_user(bot, user_id, item['media_type'], item['file_id'], item['caption'], item['extra_texts'])
+        except BadRequest as e:
+            logger.warning(f"Cached file_id for {cache_key} rejected, dropping cache entry. Error: {e}")
+            await self.db.invalidate_cached_media(cache_key)
+            return False
+        self.cache_stats['hits'] += 1
+        await self.db.add_cached_job(code, user_id, url, cache_key, sum(item['file_size'] or 0 for item in cached_items))
+        logger.info(f"[{code}] Served {len(cached_items)} item(s) from cache for {cache_key}.")
+        return True
+
+    async def deliver_profile_from_cache(self, bot, user_id, code, url, cache_key, profile):
+        try:
+            await self.send_media_to_user(bot, user_id, 'photo', profile['profile_pic_file_id'], format_profile_caption(profile))
+        except BadRequest as e:
+            logger.warning(f"Cached profile picture for {cache_key} rejected. Error: {e}")
+            await self.db.set_profile_pic_file_id(profile['username'], None)
+            return False
+        self.cache_stats['hits'] += 1
+        await self.db.add_cached_job(code, user_id, url, cache_key, 0)
+        logger.info(f"[{code}] Served profile {profile['username']} from profile cache.")
+        return True
+
+    async def find_cached_delivery(self, cache_key):
+        if cache_key.startswith("instagram:profile:"):
+            profile = await self.db.get_cached_profile(cache_key.split(':', 2)[2], PROFILE_CACHE_TTL_MINUTES * 60)
+            return (None, profile) if profile and profile['profile_pic_file_id'] else (None, None)
+        return await self.db.get_cached_media(cache_key, MEDIA_CACHE_TTL_HOURS), None
+
     @membership_required
     async def handle_url(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
@@ -178,136 +440,233 @@ class AdvancedBot:
             cooldown = timedelta(seconds=USER_COOLDOWN_SECONDS)
             if last_request_time and (now - last_request_time) < cooldown:
                 remaining_time = cooldown - (now - last_request_time)
-                await update.message.reply_text(f"⏳ برای ارسال لینک بعدی، لطفاً **{int(remaining_time.total_seconds()) + 1}** ثانیه دیگر صبر کنید.", parse_mode='Markdown')
+                await self.outbox.send(context.bot.send_message, user.id, OutboundDispatcher.INTERACTIVE, text=f"⏳ برای ارسال لینک بعدی، لطفاً **{int(remaining_time.total_seconds()) + 1}** ثانیه دیگر صبر کنید.",
+                                       parse_mode='Markdown', reply_to_message_id=update.message.message_id)
                 return
             context.user_data['last_request_time'] = now
-        self.db.add_user_if_not_exists(user)
+        await self.db.add_user_if_not_exists(user)
         url = update.message.text.strip()
         code = ''.join(random.choices(string.ascii_lowercase + string.digits, k=8))
-        self.db.add_job(code, user.id, url)
-        message_for_worker = f"⬇️ NEW JOB\nURL: {url}\nCODE: {code}\nUSER_ID: {user.id}"
-        await context.bot.send_message(chat_id=self.group_id, text=message_for_worker, message_thread_id=self.order_topic_id)
+        cache_key = normalize_url(url)
+        trace = JobTrace(self.metrics, code)
+        with trace.span("submit"):
+            if QUALITY_SELECTION and not cache_key.startswith("instagram:"):
+                manifest = await self.db.get_format_manifest(cache_key, FORMAT_MANIFEST_TTL_MINUTES)
+                if manifest:
+                    await self.db.add_cached_job(code, user.id, url, f"{cache_key}|formats", 0, status='extracted')
+                    await self.offer_quality_options(context.bot, user.id, code, url, cache_key, manifest['options'], update.message.message_id)
+                else:
+                    await self.submit_job(context.bot, user.id, code, url, f"{cache_key}|formats", update.message.message_id, kind='extract')
+            else:
+                await self.submit_job(context.bot, user.id, code, url, cache_key, update.message.message_id)
+        await self.db.add_job_timings(code, trace.stages)
+
+    async def submit_job(self, bot, user_id, code, url, cache_key, reply_to=None, kind='download', format_option=None):
+        # زیر قفل فقط تصمیم گرفته می‌شود (cache، follower یا leader جدید)؛ ارسال‌ها با محدودیت هر چت کند هستند و بعد از آزاد شدن قفل انجام می‌شوند
+        cached_items, profile, leader, delivered = None, None, None, []
+        async with self.url_lock(cache_key):
+            if kind == 'download':
+                cached_items, profile = await self.find_cached_delivery(cache_key)
+                if not cached_items and not profile: self.cache_stats['misses'] += 1
+            if not cached_items and not profile:
+                leader = await self.db.find_inflight_leader(cache_key)
+                if leader:
+                    await self.db.add_job(code, user_id, url, cache_key=cache_key, leader_code=leader['code'], notify=False, kind=kind, format_option=format_option)
+                    # آیتم‌هایی که تا اینجا cache شده‌اند؛ بقیه را fan-out گروه به این follower هم می‌فرستد
+                    delivered = await self.db.get_cached_media_since(cache_key, leader['created_at']) if kind == 'download' else []
+                else:
+                    # leader باید قبل از آزاد شدن قفل ثبت شود؛ وگرنه درخواست همزمان بعدی هم leader پیدا نمی‌کند و دوباره دانلود می‌شود
+                    priority = 0 if user_id in self.admin_ids else 1
+                    await self.db.add_job(code, user_id, url, cache_key=cache_key, priority=priority, notify=JOB_TRANSPORT != "telegram", kind=kind, format_option=format_option)
+        if profile or cached_items:
+            delivered_from_cache = (await self.deliver_profile_from_cache(bot, user_id, code, url, cache_key, profile) if profile
+                                    else await self.deliver_from_cache(bot, user_id, code, url, cache_key, cached_items))
+            # file_id رد شد و از cache حذف شد؛ دوباره ثبت می‌شود و این بار miss حساب می‌شود
+            if not delivered_from_cache: await self.submit_job(bot, user_id, code, url, cache_key, reply_to, kind, format_option)
+            return
+        if leader:
+            await self.outbox.send(bot.send_message, user_id, OutboundDispatcher.INTERACTIVE, text=SUBMIT_MESSAGE.format(code=code),
+                                   parse_mode='Markdown', reply_to_message_id=reply_to)
+            for item in delivered:
+                await self.send_media_to_user(bot, user_id, item['media_type'], item['file_id'], item['caption'], item['extra_texts'])
+            logger.info(f"[{code}] Coalesced into in-flight job {leader['code']} ({len(delivered)} item(s) already delivered).")
+            return
+        if JOB_TRANSPORT == "telegram":
+            message_for_worker = encode_job(code, url, user_id)
+            await self.outbox.send(bot.send_message, self.group_id, OutboundDispatcher.INTERACTIVE, text=message_for_worker, message_thread_id=self.order_topic_id)
         submit_text = SUBMIT_MESSAGE.format(code=code)
-        await update.message.reply_text(submit_text, parse_mode='Markdown')
+        await self.outbox.send(bot.send_message, user_id, OutboundDispatcher.INTERACTIVE, text=submit_text, parse_mode='Markdown', reply_to_message_id=reply_to)
+
+    async def offer_quality_options(self, bot, user_id, code, url, cache_key, options, reply_to=None):
+        if not options:
+            new_code = ''.join(random.choices(string.ascii_lowercase + string.digits, k=8))
+            return await self.submit_job(bot, user_id, new_code, url, cache_key, reply_to)
+        buttons = [InlineKeyboardButton((f"🎬 {option['height']}p" if option['height'] else "🎵 فقط صدا") + (f" (~{option['size'] / (1024 * 1024):.1f}MB)" if option['size'] else ""),
+                                        callback_data=f"quality:{code}:{option['id']}") for option in options]
+        text = QUALITY_PROMPT_VIDEO if any(option['height'] for option in options) else QUALITY_PROMPT_AUDIO
+        await self.outbox.send(bot.send_message, user_id, OutboundDispatcher.INTERACTIVE, text=text.strip(),
+                               reply_markup=InlineKeyboardMarkup([buttons[i:i + 2] for i in range(0, len(buttons), 2)]), reply_to_message_id=reply_to)
+
+    async def quality_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        _, code, option = query.data.split(':', 2)
+        job_info = await self.db.get_job_by_code(code)
+        if not job_info or job_info['user_id'] != query.from_user.id:
+            await query.answer("این درخواست منقضی شده است، لطفاً لینک را دوباره ارسال کنید.", show_alert=True)
+            return
+        await query.answer()
+        await query.edit_message_reply_markup(reply_markup=None)
+        cache_key = (job_info['cache_key'] or normalize_url(job_info['url'])).rsplit('|', 1)[0]
+        new_code = ''.join(random.choices(string.ascii_lowercase + string.digits, k=8))
+        await self.submit_job(context.bot, query.from_user.id, new_code, job_info['url'], f"{cache_key}|{option}", format_option=option)
+
+    async def handle_formats_ready(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not update.message or not update.message.text or update.message.message_thread_id != self.order_topic_id:
+            return
+        try:
+            code = parse_message(update.message.text)['code']
+            job_info = await self.db.get_job_by_code(code)
+            if not job_info: return
+            cache_key = job_info['cache_key'].rsplit('|', 1)[0]
+            manifest = await self.db.get_format_manifest(cache_key, FORMAT_MANIFEST_TTL_MINUTES)
+            followers = await self.db.get_followers(code)
+            await self.db.update_job_on_complete(code, 'extracted', 0)
+            for recipient in [{'code': code, 'user_id': job_info['user_id']}] + followers:
+                await self.offer_quality_options(context.bot, recipient['user_id'], recipient['code'], job_info['url'], cache_key, manifest['options'] if manifest else [])
+        except ProtocolError as e:
+            logger.warning(f"Ignoring unparsable formats message: {e}")
+        except Exception as e:
+            logger.error(f"Error in handle_formats_ready: {e}")
 
     async def handle_failed_job(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not update.message or not update.message.text or update.message.message_thread_id != self.order_topic_id:
             return
         try:
-            lines = update.message.text.split('\n')
-            code = next(l.split(":", 1)[1].strip() for l in lines if l.startswith("CODE:"))
-            job_info = self.db.get_job_by_code(code)
+            code = parse_message(update.message.text)['code']
+            job_info = await self.db.get_job_by_code(code)
             if job_info and job_info.get('user_id'):
-                user_id = job_info['user_id']
-                logger.info(f"Notifying user {user_id} about failed job {code}.")
-                await context.bot.send_message(chat_id=user_id, text=FAILURE_MESSAGE)
+                followers = await self.db.fail_followers(code)
+                for user_id in dict.fromkeys([job_info['user_id']] + [f['user_id'] for f in followers]):
+                    logger.info(f"Notifying user {user_id} about failed job {code}.")
+                    await self.outbox.send(context.bot.send_message, user_id, OutboundDispatcher.TEXT, text=FAILURE_MESSAGE)
+        except ProtocolError as e:
+            logger.warning(f"Ignoring unparsable failure message: {e}")
         except Exception as e:
             logger.error(f"Error in handle_failed_job: {e}")
 
     async def handle_group_files(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not update.message or not update.message.caption or update.message.message_thread_id != self.order_topic_id:
             return
-        info = {}
+        result = {}
         try:
-            caption_lines = update.message.caption.split('\n')
-            info = {line.split(":", 1)[0].strip(): line.split(":", 1)[1].strip() for line in caption_lines if ":" in line}
-            code, size, method = info.get("CODE"), int(info.get("SIZE", 0)), info.get("METHOD")
-            job_info = self.db.get_job_by_code(code)
+            result = parse_message(update.message.caption)
+            if result['kind'] != 'result': return
+            code, size, method, index, total = result['code'], result['size'], result['method'], result['index'], result['total']
+            job_info = await self.db.get_job_by_code(code)
             if not job_info: return
-            user_id, original_url = job_info['user_id'], job_info['url']
-            self.db.update_job_on_complete(code, 'completed', size)
+            user_id = job_info['user_id']
+            await self.db.update_job_on_complete(code, 'completed', size)
             footer = f"\n\n{FOOTER_TEXT}"
-            async def send_media_to_user(media_type, file_id, caption_text):
-                reply_markup = None
-                if BUTTON_TEXT and BUTTON_URL:
-                    keyboard = [[InlineKeyboardButton(BUTTON_TEXT, url=BUTTON_URL)]]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                actions = {'video': context.bot.send_video, 'audio': context.bot.send_audio, 'photo': context.bot.send_photo, 'document': context.bot.send_document}
-                kwargs = {'chat_id': user_id, media_type: file_id, 'caption': caption_text, 'parse_mode': 'Markdown', 'reply_markup': reply_markup}
-                if media_type: await actions[media_type](**kwargs)
+            extra_texts = []
             media_type = next((mt for mt in ['video', 'audio', 'photo', 'document'] if getattr(update.message, mt)), None)
             file_id = getattr(update.message, media_type).file_id if media_type != 'photo' else getattr(update.message, media_type)[-1].file_id
             if method == "Instagram Profile":
-                if not self.instagrapi_client: raise Exception("Main bot's Instagrapi client not ready.")
-                username = base64.b64decode(info["CAPTION"]).decode('utf-8').strip()
-                user_info = self.instagrapi_client.user_info_by_username(username).model_dump()
-                full_caption = (f"👤 **{user_info.get('full_name')}** (`@{user_info.get('username')}`)\n\n"
-                                f"**Bio:**\n{user_info.get('biography')}\n\n"
-                                f"----------------------------------------\n"
-                                f"**Posts:** {user_info.get('media_count')} | "
-                                f"**Followers:** {user_info.get('follower_count')} | "
-                                f"**Following:** {user_info.get('following_count')}" + footer)
-                await send_media_to_user('photo', file_id, full_caption)
+                username = result.get('profile') or result.get('caption', '')
+                profile = await self.db.get_cached_profile(username, PROFILE_CACHE_TTL_MINUTES * 60)
+                if not profile:
+                    profile = await asyncio.to_thread(self.fetch_instagram_profile, username)
+                    await self.db.save_profile(profile)
+                full_caption = format_profile_caption(profile)
+                media_type = 'photo'
+                await self.db.set_profile_pic_file_id(username, file_id)
             else:
-                full_description, title = "", ""
-                try:
-                    with yt_dlp.YoutubeDL({'quiet': True, 'ignoreerrors': True, 'cookiefile': 'cookies.txt'}) as ydl:
-                        meta = ydl.extract_info(original_url, download=False)
-                        if meta:
-                            full_description, title = meta.get('description', ''), meta.get('title', '')
-                except Exception:
-                    try: title = base64.b64decode(info["CAPTION"]).decode('utf-8').strip()
-                    except: title = "فایل شما"
-                item_info_str = next((line for line in caption_lines if line.startswith("✅ Uploaded")), "")
-                match = re.search(r'\((\d+)/(\d+)\)', item_info_str)
-                slide_info = f"\n\nاسلاید {match.group(1)} از {match.group(2)}" if match else ""
+                full_description, title = job_info.get('description') or "", job_info.get('title') or ""
+                if not full_description and not title:
+                    title = result.get('caption') or "فایل شما"
+                slide_info = f"\n\nاسلاید {index} از {total}"
                 if full_description and len(full_description) > 1000:
-                    short_caption = (title + slide_info + footer).strip()
-                    await send_media_to_user(media_type, file_id, short_caption)
-                    for i in range(0, len(full_description), 4096):
-                        await context.bot.send_message(chat_id=user_id, text=full_description[i:i+4096], disable_web_page_preview=True)
+                    full_caption = (title + slide_info + footer).strip()
+                    extra_texts = [full_description[i:i+4096] for i in range(0, len(full_description), 4096)]
                 else:
                     caption_content = full_description if full_description else title
                     full_caption = (caption_content + slide_info + footer).strip()
-                    await send_media_to_user(media_type, file_id, full_caption)
+            trace = JobTrace(self.metrics, code)
+            # follower هایی که بعد از این قفل اضافه شوند این آیتم را از cache می‌گیرند، قبلی‌ها در این لیست هستند
+            async with self.url_lock(job_info.get('cache_key') or code):
+                followers = await self.db.get_followers(code)
+                if job_info.get('cache_key') and media_type:
+                    await self.db.cache_media_item(job_info['cache_key'], index, total, media_type, file_id, full_caption, extra_texts, size)
+
+            async def deliver(recipient):
+                try:
+                    await self.send_media_to_user(context.bot, recipient, media_type, file_id, full_caption, extra_texts)
+                    self.metrics.inc("deliveries_total", help_text="Items delivered to users by outcome", method=method, outcome="success")
+                except Exception as send_err:
+                    self.metrics.inc("deliveries_total", method=method, outcome="failure")
+                    logger.error(f"[{code}] Could not deliver item {index}/{total} to {recipient}: {send_err}")
+            with trace.span("delivery"):
+                await asyncio.gather(*(deliver(recipient) for recipient in dict.fromkeys([user_id] + [f['user_id'] for f in followers])))
+            await self.db.add_job_timings(code, trace.stages)
+        except ProtocolError as e:
+            logger.warning(f"Ignoring group file with unparsable caption: {e}")
         except Exception as e:
-            logger.error(f"❌ Error processing group file for code {info.get('CODE', 'N/A')}: {e}", exc_info=True)
+            logger.error(f"❌ Error processing group file for code {result.get('code', 'N/A')}: {e}", exc_info=True)
 
     async def check_membership_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        self.membership_cache.invalidate(update.effective_user.id)
         await self.start_command(update, context)
 
-    async def _perform_backup_and_send(self, context: ContextTypes.DEFAULT_TYPE):
-        logger.info("Starting backup process...")
+    async def handle_chat_member_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        change = update.chat_member
+        if not change: return
+        chat_keys = {str(change.chat.id)} | ({f"@{change.chat.username}".lower()} if change.chat.username else set())
+        for channel in FORCED_JOIN_CHANNELS:
+            if str(channel).lower() in chat_keys:
+                is_member = change.new_chat_member.status not in [ChatMemberStatus.LEFT, ChatMemberStatus.BANNED]
+                self.membership_cache.set(change.new_chat_member.user.id, str(channel), is_member)
+
+    async def _perform_backup_and_send(self, context: ContextTypes.DEFAULT_TYPE, kind=None):
         timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        sql_file, archive_file = f"backup_{timestamp}.sql", f"bot_backup_{timestamp}.tar.gz"
-        project_dir, parent_dir = os.getcwd(), os.path.dirname(os.getcwd())
-        dir_name = os.path.basename(project_dir)
         try:
-            pg_dump_cmd = f"pg_dump -U {DB_USER} -d {DB_NAME} > {sql_file}"
-            env = os.environ.copy()
-            env['PGPASSWORD'] = DB_PASS
-            subprocess.run(pg_dump_cmd, shell=True, check=True, env=env, capture_output=True)
-            logger.info(f"Successfully created SQL dump: {sql_file}")
-            tar_cmd = (f"tar -czvf {archive_file} --exclude='venv' --exclude='__pycache__' "
-                       f"--exclude='downloads' --exclude='*.log' --exclude='*.session*' "
-                       f"--exclude='*.json' {dir_name}/{sql_file} {dir_name}")
-            subprocess.run(tar_cmd, shell=True, check=True, cwd=parent_dir, capture_output=True)
-            logger.info(f"Successfully created archive: {archive_file}")
-            backup_bot = Application.builder().token(BACKUP_BOT_TOKEN).build().bot
-            safe_archive_name = archive_file.replace("_", "-")
-            safe_timestamp = timestamp.replace("_", "-")
-            caption = f"✅ بکاپ ربات\n\n🗓 تاریخ: {safe_timestamp}\n📦 فایل: `{safe_archive_name}`"
-            with open(os.path.join(parent_dir, archive_file), 'rb') as backup_file_obj:
-                for admin_id in self.admin_ids:
-                    try:
-                        backup_file_obj.seek(0)
-                        await backup_bot.send_document(chat_id=admin_id, document=backup_file_obj, caption=caption, parse_mode='Markdown')
-                    except Exception as send_err:
-                        logger.error(f"Could not send backup to admin {admin_id}: {send_err}")
+            state = await self.db.get_backup_state()
+            full_due = not state['last_full'] or state['now'] - state['last_full'] >= timedelta(hours=FULL_BACKUP_INTERVAL_HOURS)
+            kind = 'full' if kind == 'full' or full_due else 'incremental'
+            logger.info(f"Starting {kind} backup process...")
+            if kind == 'full':
+                since, until, cutoff = None, state['now'], await self.db.backup_cutoff()
+                files, row_count = {'database.dump': await dump_database()}, None
+            else:
+                since = state['last_until']
+                until, cutoff, tables, row_count = await self.db.export_changes(since)
+                if not row_count:
+                    logger.info("No rows changed since the last backup, skipping.")
+                    return True, None
+                files = {f"{table}.csv": data for table, data in tables.items()}
+            manifest = {'kind': kind, 'since': since.isoformat() if since else None, 'until': until.isoformat(), 'rows': row_count}
+            archive = await asyncio.to_thread(build_backup_archive, files, manifest, os.getcwd() if kind == 'full' else None)
+            archive_file = f"bot-backup-{'full' if kind == 'full' else 'inc'}-{timestamp.replace('_', '-')}.tar.gz"
+            logger.info(f"Built {kind} backup archive {archive_file} ({len(archive) / 1024:.1f} KB).")
+            if self.backup_bot is None:
+                backup_bot = Bot(BACKUP_BOT_TOKEN)
+                await backup_bot.initialize()
+                self.backup_bot = backup_bot
+            kind_label = "کامل" if kind == 'full' else f"افزایشی ({row_count} ردیف)"
+            caption = f"✅ بکاپ ربات\n\n🗓 تاریخ: {timestamp.replace('_', '-')}\n🗂 نوع: {kind_label}\n📦 فایل: `{archive_file}`"
+            delivered = 0
+            for admin_id in self.admin_ids:
+                try:
+                    await self.backup_bot.send_document(chat_id=admin_id, document=archive, filename=archive_file, caption=caption, parse_mode='Markdown')
+                    delivered += 1
+                except Exception as send_err:
+                    logger.error(f"Could not send backup to admin {admin_id}: {send_err}")
+            if not delivered: return False, "Backup archive could not be delivered to any admin."
+            # بکاپ بعدی از cutoff شروع می‌شود، نه until؛ until فقط ترتیب archive ها در restore را مشخص می‌کند
+            await self.db.record_backup(kind, since, cutoff, row_count, len(archive))
             return True, None
-        except subprocess.CalledProcessError as e:
-            error_message = f"Backup shell command failed. stderr: {e.stderr.decode()}"
-            logger.error(error_message)
-            return False, error_message
         except Exception as e:
             error_message = f"An unexpected error occurred during backup: {e}"
             logger.error(error_message, exc_info=True)
             return False, error_message
-        finally:
-            sql_file_path, archive_file_path = os.path.join(project_dir, sql_file), os.path.join(parent_dir, archive_file)
-            if os.path.exists(sql_file_path): os.remove(sql_file_path)
-            if os.path.exists(archive_file_path): os.remove(archive_file_path)
-            logger.info("Backup cleanup complete.")
 
     async def backup_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
@@ -315,26 +674,48 @@ class AdvancedBot:
             await update.message.reply_text("⛔️ شما اجازه استفاده از این دستور را ندارید.")
             return
         await update.message.reply_text("⏳ در حال شروع فرآیند بکاپ‌گیری دستی...")
-        success, error_message = await self._perform_backup_and_send(context)
+        kind = 'incremental' if context.args and context.args[0].lower() in ('inc', 'incremental') else 'full'
+        success, error_message = await self._perform_backup_and_send(context, kind)
         if success:
             await update.message.reply_text("✅ فرآیند بکاپ‌گیری با موفقیت انجام شد و فایل برای ادمین‌ها ارسال گردید.")
         else:
             await update.message.reply_text(f"❌ بکاپ‌گیری با خطا مواجه شد.\n\nجزئیات در فایل `main_bot.log` ثبت شد.")
 
+    async def evict_media_cache_job(self, context: ContextTypes.DEFAULT_TYPE):
+        removed = await self.db.evict_media_cache(MEDIA_CACHE_TTL_HOURS, MEDIA_CACHE_MAX_ENTRIES)
+        if removed: logger.info(f"Evicted {removed} media cache row(s).")
+
+    async def refresh_statistics_job(self, context: ContextTypes.DEFAULT_TYPE):
+        try:
+            await self.db.refresh_statistics_rollups()
+        except Exception as e:
+            logger.error(f"Could not refresh statistics rollups: {e}")
+
     async def scheduled_backup_job(self, context: ContextTypes.DEFAULT_TYPE):
         logger.info("Running scheduled backup job...")
         await self._perform_backup_and_send(context)
 
-    def run(self):
+    def register_handlers(self):
         self.app.add_handler(CommandHandler("start", self.start_command))
         self.app.add_handler(CommandHandler("manage", self.manage_command))
         self.app.add_handler(CommandHandler("backup", self.backup_command))
         self.app.add_handler(CallbackQueryHandler(self.stats_callback, pattern="^bot_stats$"))
+        self.app.add_handler(CallbackQueryHandler(self.rollup_stats_callback, pattern="^stats_(hourly|daily|breakdown)$"))
+        self.app.add_handler(CallbackQueryHandler(self.cache_stats_callback, pattern="^cache_stats$"))
         self.app.add_handler(CallbackQueryHandler(self.check_membership_callback, pattern="^check_membership$"))
-        self.app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_url))
+        self.app.add_handler(CallbackQueryHandler(self.quality_callback, pattern="^quality:"))
+        self.app.add_handler(ChatMemberHandler(self.handle_chat_member_update, ChatMemberHandler.CHAT_MEMBER))
+        self.app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE, self.handle_url))
         self.app.add_handler(MessageHandler((filters.VIDEO | filters.AUDIO | filters.PHOTO | filters.Document.ALL) & filters.Chat(self.group_id) & filters.CAPTION, self.handle_group_files))
         self.app.add_handler(MessageHandler(filters.TEXT & filters.Chat(self.group_id) & filters.Regex(r"^❌ JOB FAILED"), self.handle_failed_job))
-        
+        self.app.add_handler(MessageHandler(filters.TEXT & filters.Chat(self.group_id) & filters.Regex(r"^🎛 FORMATS READY"), self.handle_formats_ready))
+
+    def run(self):
+        self.register_handlers()
+        if self.app.job_queue:
+            self.app.job_queue.run_repeating(self.evict_media_cache_job, interval=3600, first=60)
+            self.app.job_queue.run_repeating(self.refresh_statistics_job, interval=300, first=30)
+
         if AUTO_BACKUP_INTERVAL_MINUTES > 0:
             job_queue = self.app.job_queue
             if job_queue:
@@ -344,8 +725,13 @@ class AdvancedBot:
         else:
             logger.info("ℹ️ Auto backup is disabled.")
 
-        logger.info("🚀 Main Bot is running...")
-        self.app.run_polling()
+        logger.info(f"🚀 Main Bot is running ({UPDATE_MODE}, up to {MAX_CONCURRENT_UPDATES} concurrent updates)...")
+        if UPDATE_MODE == "webhook":
+            self.app.run_webhook(listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, url_path=WEBHOOK_PATH, webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                                 secret_token=WEBHOOK_SECRET_TOKEN or None, cert=WEBHOOK_CERT or None, key=WEBHOOK_KEY or None, allowed_updates=Update.ALL_TYPES)
+        else:
+            self.app.run_polling(allowed_updates=Update.ALL_TYPES)
+        self.db.close()
 
 if __name__ == "__main__":
     bot = AdvancedBot(token=BOT_TOKEN, group_id=GROUP_ID, order_topic_id=ORDER_TOPIC_ID, log_topic_id=LOG_TOPIC_ID, admin_ids=ADMIN_IDS)
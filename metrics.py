@@ -0,0 +1,115 @@
+import time
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+
+# --- متریک‌های Prometheus و زمان‌بندی مراحل هر job ---
+# خروجی متنی روی http://<METRICS_HOST>:<port>/metrics در دسترس است
+
+logger = logging.getLogger("__main__")
+
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+SPEED_BUCKETS = (64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2)
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs: return ""
+    escape = lambda v: v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}"
+
+class Metrics:
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.counters, self.gauges, self.histograms = {}, {}, {}
+        self.collectors = {}
+        self.help = {}
+
+    def _name(self, name, help_text, kind):
+        full_name = f"{self.namespace}_{name}"
+        self.help.setdefault(full_name, (help_text or name.replace('_', ' '), kind))
+        return full_name
+
+    def inc(self, name, value=1, help_text=None, **labels):
+        name = self._name(name, help_text, "counter")
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[_label_key(labels)] = series.get(_label_key(labels), 0) + value
+
+    def set(self, name, value, help_text=None, **labels):
+        name = self._name(name, help_text, "gauge")
+        with self.lock: self.gauges.setdefault(name, {})[_label_key(labels)] = value
+
+    def gauge_callback(self, name, func, help_text=None):
+        self.collectors[self._name(name, help_text, "gauge")] = func
+
+    def observe(self, name, value, buckets=SECONDS_BUCKETS, help_text=None, **labels):
+        name = self._name(name, help_text, "histogram")
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            entry = series.get(_label_key(labels))
+            if entry is None: entry = series[_label_key(labels)] = {'buckets': buckets, 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(entry['buckets']):
+                if value <= bound: entry['counts'][i] += 1
+            entry['sum'] += value
+            entry['count'] += 1
+
+    def render(self):
+        lines, collected = [], {}
+        for name, func in self.collectors.items():
+            try: collected[name] = {(): func()}
+            except Exception as e: logger.warning(f"Metric collector {name} failed: {e}")
+        with self.lock:
+            self.gauges.update(collected)
+            for name, series in list(self.counters.items()) + list(self.gauges.items()):
+                help_text, kind = self.help[name]
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+                lines += [f"{name}{_format_labels(key)} {value}" for key, value in series.items()]
+            for name, series in self.histograms.items():
+                help_text, _ = self.help[name]
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+                for key, entry in series.items():
+                    lines += [f"{name}_bucket{_format_labels(key, [('le', str(bound))])} {count}" for bound, count in zip(entry['buckets'], entry['counts'])]
+                    lines += [f"{name}_bucket{_format_labels(key, [('le', '+Inf')])} {entry['count']}",
+                              f"{name}_sum{_format_labels(key)} {entry['sum']:.6f}", f"{name}_count{_format_labels(key)} {entry['count']}"]
+        return "\n".join(lines) + "\n"
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = (await asyncio.wait_for(reader.readline(), timeout=5)).decode(errors='ignore')
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b'\r\n', b'\n', b''): pass
+            path = request_line.split(' ')[1] if request_line.count(' ') >= 2 else ''
+            status, body = ("200 OK", self.render()) if path.split('?')[0] in ('/metrics', '/') else ("404 Not Found", "not found\n")
+            payload = body.encode('utf-8')
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        if not port: return None
+        server = await asyncio.start_server(self._handle, host, port)
+        logger.info(f"📈 Metrics endpoint listening on http://{host}:{port}/metrics")
+        return server
+
+class JobTrace:
+    def __init__(self, metrics, code):
+        self.metrics, self.code = metrics, code
+        self.started = time.monotonic()
+        self.stages, self.bytes = {}, 0
+
+    def add(self, stage, seconds):
+        self.stages[stage] = round(self.stages.get(stage, 0) + seconds, 3)
+        self.metrics.observe("stage_seconds", seconds, help_text="Time spent in each job pipeline stage", stage=stage)
+
+    @contextmanager
+    def span(self, stage):
+        started = time.monotonic()
+        try: yield
+        finally: self.add(stage, time.monotonic() - started)
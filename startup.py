@@ -0,0 +1,54 @@
+import time
+import logging
+import importlib
+import threading
+
+# --- import تنبل ماژول‌های سنگین و گزارش زمان راه‌اندازی هر پروسه ---
+# yt_dlp، instagrapi و instaloader هر کدام چند صد میلی‌ثانیه import می‌شوند و برای جواب دادن به /start لازم نیستند
+
+logger = logging.getLogger("__main__")
+
+PROCESS_STARTED = time.monotonic()
+
+class LazyModule:
+    # ماژول در اولین دسترسی به یکی از attribute هایش import می‌شود
+    def __init__(self, name):
+        self._name, self._module = name, None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    started = time.monotonic()
+                    self._module = importlib.import_module(self._name)
+                    logger.info(f"Imported {self._name} on first use in {time.monotonic() - started:.2f}s")
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+class StartupProfile:
+    # زمان هر مرحله راه‌اندازی از شروع پروسه (import شدن همین ماژول) اندازه‌گیری می‌شود
+    def __init__(self, started=PROCESS_STARTED):
+        self.started = self.last = started
+        self.phases = []
+
+    def mark(self, phase):
+        now = time.monotonic()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self):
+        return " | ".join(f"{phase} {seconds:.2f}s" for phase, seconds in self.phases) + f" | ready after {self.last - self.started:.2f}s"
+
+def preload_in_background(*modules):
+    # بعد از آماده شدن پروسه import می‌شوند تا اولین job منتظر import نماند
+    def preload():
+        for module in modules:
+            if isinstance(module, LazyModule):
+                try: module._load()
+                except ImportError as e: logger.error(f"Could not import {module._name}. Error: {e}")
+    thread = threading.Thread(target=preload, name="preload-modules", daemon=True)
+    thread.start()
+    return thread